@@ -0,0 +1,54 @@
+import argparse
+import hashlib
+import random
+import timeit
+
+from hypogenic.LLM_cache import FrozenDict, canonical_hash
+
+
+def main():
+    # Time per cache key of a single-message query, for the legacy `hash(FrozenDict)` keys
+    # and the `canonical_hash` keys of cache_key_mode "v1", and for hashing the canonical
+    # encoding with other digests.
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--message_chars", type=int, nargs="+", default=[1000, 10000, 50000]
+    )
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    for message_chars in args.message_chars:
+        query = FrozenDict(
+            {
+                "messages": [
+                    {"role": "system", "content": "You are a helpful assistant."},
+                    {
+                        "role": "user",
+                        "content": "".join(
+                            rng.choices("abcdefgh \n\"'\\", k=message_chars)
+                        ),
+                    },
+                ],
+                "model": "gpt-4o-mini",
+                "max_tokens": 4000,
+                "temperature": 1e-5,
+                "cache_seed": 0,
+            }
+        )
+        content = query["messages"][1]["content"].encode("utf-8")
+        timings = {
+            "legacy": lambda: hash(query),
+            "v1": lambda: canonical_hash(query),
+            "sha256 of content": lambda: hashlib.sha256(content).digest(),
+            "blake2b of content": lambda: hashlib.blake2b(content).digest(),
+        }
+        results = ", ".join(
+            f"{name} {timeit.timeit(fn, number=args.number) / args.number * 1e6:.1f}us"
+            for name, fn in timings.items()
+        )
+        print(f"{message_chars} chars: {results}")
+
+
+if __name__ == "__main__":
+    main()
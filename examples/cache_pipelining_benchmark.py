@@ -0,0 +1,60 @@
+import argparse
+import logging
+import random
+import time
+
+from hypogenic.LLM_cache import LocalModelAPICache
+from hypogenic.logger_config import LoggerConfig
+
+logger = LoggerConfig.get_logger("HypoGenic")
+LoggerConfig.setup_logger(
+    logging.WARNING,
+)
+
+
+def main():
+    # Time of APICache.batched_generate for a batch of messages against a Redis server, when
+    # no message is cached (lookups, API call and writes) and when all of them are. The API
+    # call returns immediately, so the times are the cache overhead.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_messages", type=int, default=10000)
+    parser.add_argument("--message_chars", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=6832)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    cache = LocalModelAPICache(port=args.port)
+    cache.batched_api_call = lambda messages, **kwargs: [
+        f"response {idx}" for idx in range(len(messages))
+    ]
+
+    rng = random.Random(0)
+    messages = [
+        [
+            {
+                "role": "user",
+                "content": f"{idx} "
+                + "".join(rng.choices("abcdefgh ", k=args.message_chars)),
+            }
+        ]
+        for idx in range(args.num_messages)
+    ]
+
+    for _ in range(args.repeats):
+        # a new cache seed, so no message is cached yet
+        cache_seed = rng.randrange(2**62)
+        start_time = time.time()
+        cache.batched_generate(messages, cache_seed=cache_seed, model="benchmark")
+        cold_time = time.time() - start_time
+
+        start_time = time.time()
+        cache.batched_generate(messages, cache_seed=cache_seed, model="benchmark")
+        warm_time = time.time() - start_time
+
+        print(
+            f"{args.num_messages} messages: uncached {cold_time:.3f}s, cached {warm_time:.3f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
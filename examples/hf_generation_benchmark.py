@@ -0,0 +1,107 @@
+import argparse
+import logging
+import time
+
+from hypogenic.LLM_wrapper import LocalHFWrapper
+from hypogenic.logger_config import LoggerConfig
+
+logger = LoggerConfig.get_logger("HypoGenic")
+LoggerConfig.setup_logger(
+    logging.INFO,
+)
+
+SYSTEM_PROMPT = (
+    "You are a deceptive detection agent and want to determine whether a hotel review is truthful or deceptive. "
+    "In other words, we want to know whether the review is written by someone who had real experiences with the hotel. "
+    "From past experiences, you learned a pattern. You need to determine whether each of the patterns holds for the "
+    "current hotel review, and also predict whether the current hotel review is truthful or deceptive. "
+    "Give an answer. The answer should be one word (truthful or deceptive). "
+    "Give your final answer in the format of {Final answer: answer}"
+)
+
+HYPOTHESES = [
+    "Reviews that mention specific details about the room layout, such as the view from the window or the location of the bathroom, are more likely to be truthful.",
+    "Reviews that use excessive superlatives and exclamation marks without concrete details are more likely to be deceptive.",
+    "Reviews that describe interactions with named staff members or specific events during the stay are more likely to be truthful.",
+    "Reviews that repeatedly mention the full hotel name and city are more likely to be deceptive.",
+]
+
+REVIEWS = [
+    "We stayed for three nights in October. The room on the 12th floor faced the lake and the elevator was a bit slow.",
+    "Absolutely the best hotel ever!!! Amazing service, amazing rooms, amazing everything! I will definitely come back!",
+    "The front desk clerk, Maria, helped us find a late dinner spot after our flight was delayed by four hours.",
+    "The Hotel Allegro Chicago is the perfect place to stay in Chicago. The Hotel Allegro Chicago has great rooms.",
+    "Parking was expensive at $45 per night, but the bed was comfortable and the shower had good pressure.",
+]
+
+
+def build_messages(num_examples):
+    messages = []
+    for hyp_idx, hypothesis in enumerate(HYPOTHESES):
+        for example_idx in range(num_examples):
+            review = REVIEWS[example_idx % len(REVIEWS)]
+            messages.append(
+                [
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {
+                        "role": "user",
+                        "content": f"Our learned patterns: {hypothesis}\n"
+                        + f"A hotel review is the following: {review} (review #{example_idx})\n"
+                        + "Given the pattern you learned above, give an answer of whether the hotel review above is deceptive or truthful.",
+                    },
+                ]
+            )
+    return messages
+
+
+def run(model_name, messages, max_tokens, batch_size=1, prefix_caching=False):
+    wrapper = LocalHFWrapper(
+        model_name, batch_size=batch_size, prefix_caching=prefix_caching
+    )
+    # load the model before timing
+    wrapper.batched_generate(messages[:2], max_tokens=1)
+
+    tokenizer = wrapper.api.tokenizer
+    num_prompt_tokens = sum(
+        len(tokenizer.apply_chat_template(m, tokenize=True, add_generation_prompt=True))
+        for m in messages
+    )
+
+    start_time = time.time()
+    responses = wrapper.batched_generate(messages, max_tokens=max_tokens)
+    elapsed = time.time() - start_time
+
+    num_generated_tokens = sum(len(tokenizer.encode(r)) for r in responses)
+    logger.info(
+        f"batch_size={batch_size}, prefix_caching={prefix_caching}: {len(messages)} prompts in {elapsed:.1f}s, "
+        + f"{(num_prompt_tokens + num_generated_tokens) / elapsed:.1f} tokens/s "
+        + f"({num_prompt_tokens} prompt tokens, {num_generated_tokens} generated tokens)"
+    )
+    return responses
+
+
+def main():
+    # Throughput of HF generation on inference-style prompts for different micro-batch
+    # sizes, and with prefix grouping. Runs on CPU with a small instruct model. Needs torch,
+    # transformers and network access to download the model. It has not been run for the
+    # micro-batching and prefix grouping changes yet, so there are no reference numbers; the
+    # grouping itself is timed by prefix_grouping_benchmark.py, which needs neither.
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_name", type=str, default="HuggingFaceTB/SmolLM2-135M-Instruct"
+    )
+    parser.add_argument("--num_examples", type=int, default=16)
+    parser.add_argument("--max_tokens", type=int, default=8)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4, 16])
+    args = parser.parse_args()
+
+    messages = build_messages(args.num_examples)
+    for batch_size in args.batch_sizes:
+        run(
+            args.model_name, messages, max_tokens=args.max_tokens, batch_size=batch_size
+        )
+    run(args.model_name, messages, max_tokens=args.max_tokens, prefix_caching=True)
+
+
+if __name__ == "__main__":
+    main()
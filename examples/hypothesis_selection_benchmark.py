@@ -0,0 +1,81 @@
+import argparse
+import logging
+import time
+
+import numpy as np
+
+from hypogenic.algorithm.inference import OneStepAdaptiveInference
+from hypogenic.logger_config import LoggerConfig
+
+logger = LoggerConfig.get_logger("HypoGenic")
+LoggerConfig.setup_logger(
+    logging.INFO,
+)
+
+
+def make_bank(num_hypotheses, num_examples, rng):
+    # hypotheses are correct on random subsets of a few "topics", so similar ones cluster
+    num_topics = max(2, num_hypotheses // 10)
+    topics = rng.random((num_topics, num_examples)) < 0.3
+    membership = rng.integers(0, num_topics, size=num_hypotheses)
+    noise = rng.random((num_hypotheses, num_examples)) < 0.1
+    correct = topics[membership] ^ noise
+    accuracies = correct.mean(axis=1)
+
+    overlaps = correct.astype(np.float64) @ correct.T.astype(np.float64)
+    norms = np.sqrt(np.diag(overlaps))
+    similarity_matrix = overlaps / np.outer(norms, norms)
+    np.fill_diagonal(similarity_matrix, 0.0)
+    return similarity_matrix, accuracies
+
+
+def main():
+    # Runtime and objective value (total accuracy of the selected hypotheses) of the exact
+    # ILP and the greedy selection used by the adaptive inference methods.
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--bank_sizes", type=int, nargs="+", default=[20, 50, 100, 200, 500, 1000]
+    )
+    parser.add_argument("--num_examples", type=int, default=200)
+    parser.add_argument("--threshold", type=float, default=0.7)
+    parser.add_argument(
+        "--max_ilp_hypotheses",
+        type=int,
+        default=500,
+        help="Skip the ILP for larger banks",
+    )
+    parser.add_argument("--time_budget", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=49)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    # the selection methods do not use the model, data or prompts
+    inference = OneStepAdaptiveInference(None, None, None, None)
+
+    for num_hypotheses in args.bank_sizes:
+        similarity_matrix, accuracies = make_bank(
+            num_hypotheses, args.num_examples, rng
+        )
+        similarities = similarity_matrix.sum(axis=1)
+        methods = ["greedy"]
+        if num_hypotheses <= args.max_ilp_hypotheses:
+            methods.append("ilp")
+        for method in methods:
+            start_time = time.time()
+            selected = inference.select_hypotheses(
+                similarity_matrix,
+                accuracies,
+                similarities,
+                args.threshold,
+                method=method,
+                time_budget=args.time_budget,
+            )
+            elapsed = time.time() - start_time
+            logger.info(
+                f"{num_hypotheses} hypotheses, {method}: {elapsed:.3f}s, "
+                + f"{len(selected)} selected, objective {accuracies[selected].sum():.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import argparse
+import random
+import time
+
+from hypogenic.LLM_wrapper.prefix_grouping import group_by_prefix
+
+
+def main():
+    # Time of grouping inference-style token id prompts by shared prefix, and the prefix tokens
+    # the groups save. Every prompt starts with the same system prompt, followed by one of
+    # num_hypotheses hypothesis blocks and a distinct example.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_prompts", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--num_hypotheses", type=int, default=20)
+    parser.add_argument("--system_tokens", type=int, default=200)
+    parser.add_argument("--hypothesis_tokens", type=int, default=100)
+    parser.add_argument("--example_tokens", type=int, default=50)
+    parser.add_argument("--min_prefix_len", type=int, default=32)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    system = [rng.randrange(32000) for _ in range(args.system_tokens)]
+    hypotheses = [
+        [rng.randrange(32000) for _ in range(args.hypothesis_tokens)]
+        for _ in range(args.num_hypotheses)
+    ]
+    for num_prompts in args.num_prompts:
+        prompts = [
+            system
+            + hypotheses[idx % args.num_hypotheses]
+            + [rng.randrange(32000) for _ in range(args.example_tokens)]
+            for idx in range(num_prompts)
+        ]
+        start_time = time.time()
+        groups = group_by_prefix(prompts, args.min_prefix_len)
+        elapsed = time.time() - start_time
+
+        saved = sum((len(indices) - 1) * prefix_len for prefix_len, indices in groups)
+        total = sum(len(prompt) for prompt in prompts)
+        print(
+            f"{num_prompts} prompts: {elapsed:.2f}s, {len(groups)} groups, "
+            + f"{saved} of {total} prompt tokens saved ({saved / total:.1%})"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import argparse
+import logging
+import random
+import time
+
+from hypogenic.algorithm.summary_information import SummaryInformation
+from hypogenic.extract_label import extract_label_register
+from hypogenic.logger_config import LoggerConfig
+from hypogenic.prompt import BasePrompt
+from hypogenic.tasks import BaseTask
+
+logger = LoggerConfig.get_logger("HypoGenic")
+LoggerConfig.setup_logger(
+    logging.INFO,
+)
+
+
+def prompts_per_second(build_prompt, num_prompts, duration):
+    start_time = time.time()
+    num_built = 0
+    while num_built == 0 or time.time() - start_time < duration:
+        build_prompt(num_built % num_prompts)
+        num_built += 1
+    return num_built / (time.time() - start_time)
+
+
+def main():
+    # Prompt building throughput (prompts/s) of BasePrompt, without any model calls.
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--task_config_path", type=str, default="./data/hotel_reviews/config.yaml"
+    )
+    parser.add_argument("--num_train", type=int, default=200)
+    parser.add_argument("--num_test", type=int, default=None)
+    parser.add_argument("--num_hypotheses", type=int, default=20)
+    parser.add_argument(
+        "--num_correct_examples",
+        type=int,
+        default=5,
+        help="Correct examples per hypothesis shown in the adaptive inference prompt",
+    )
+    parser.add_argument("--generation_batch_size", type=int, default=10)
+    parser.add_argument(
+        "--duration", type=float, default=3.0, help="Seconds per prompt type"
+    )
+    parser.add_argument("--seed", type=int, default=49)
+    args = parser.parse_args()
+
+    task = BaseTask(args.task_config_path, from_register=extract_label_register)
+    train_data, test_data, _ = task.get_data(
+        args.num_train, args.num_test, 0, args.seed
+    )
+    prompt_class = BasePrompt(task)
+
+    rng = random.Random(args.seed)
+    hyp_bank = {}
+    for idx in range(args.num_hypotheses):
+        hypothesis = f"Hypothesis {idx + 1} about the {task.task_name} examples."
+        correct_examples = [
+            (example_idx, train_data["label"][example_idx])
+            for example_idx in rng.sample(
+                range(len(train_data)), min(args.num_correct_examples, len(train_data))
+            )
+        ]
+        hyp_bank[hypothesis] = SummaryInformation(
+            hypothesis=hypothesis, correct_examples=correct_examples
+        )
+    first_hypothesis = next(iter(hyp_bank))
+    num_batches = len(train_data) // args.generation_batch_size
+
+    benchmarks = {
+        "inference": (
+            lambda idx: prompt_class.inference(
+                {first_hypothesis: hyp_bank[first_hypothesis]}, test_data, idx
+            ),
+            len(test_data),
+        ),
+        "one_step_adaptive_inference": (
+            lambda idx: prompt_class.one_step_adaptive_inference(
+                hyp_bank, train_data, test_data, idx
+            ),
+            len(test_data),
+        ),
+        "batched_generation": (
+            lambda idx: prompt_class.batched_generation(
+                train_data.loc[
+                    list(
+                        range(
+                            idx * args.generation_batch_size,
+                            (idx + 1) * args.generation_batch_size,
+                        )
+                    )
+                ]
+                .copy()
+                .reset_index(drop=True),
+                5,
+            ),
+            num_batches,
+        ),
+    }
+    for name, (build_prompt, num_prompts) in benchmarks.items():
+        rate = prompts_per_second(build_prompt, num_prompts, args.duration)
+        logger.info(f"{name}: {rate:.0f} prompts/s")
+
+
+if __name__ == "__main__":
+    main()
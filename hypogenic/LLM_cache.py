@@ -1,24 +1,68 @@
-""" A redis-based cache wrapper for GPT-3/Jurassic-1 API to avoid duplicate requests """
+""" A cache wrapper for GPT-3/Jurassic-1 API to avoid duplicate requests """
 
 """ Modified based on Yiming Zhang's implementation for openai api cache"""
 import hashlib
 import collections
 import pickle
+import zlib
 import logging
 from .logger_config import LoggerConfig
 import time
 import threading
 from abc import ABC
+from concurrent.futures import Future
+from typing import Dict, Hashable, List
 
-import redis
+from .LLM_cache_backend import build_cache_backend
 
-import anthropic
-import openai
-from openai import OpenAI
 
 logger_name = "HypoGenic - LLM_cache"
 
 
+CACHE_KEY_VERSION = b"v1:"
+
+# Cache entries start with this magic followed by one byte naming the codec.
+# Entries without it are legacy `pickle.dumps((query, resp))` values.
+CACHE_ENTRY_MAGIC = b"HG1"
+CACHE_ENTRY_CODECS = {None: b"n", "zlib": b"d", "zstd": b"z"}
+
+
+def _update_canonical(hasher, data):
+    # Length-prefixed encoding: strings are fed to the hasher as-is, without
+    # the escaping pass that `str()` or `json.dumps` would need.
+    if isinstance(data, FrozenDict):
+        data = data.data
+    if isinstance(data, str):
+        encoded = data.encode("utf-8", "surrogatepass")
+        hasher.update(b"s%d:" % len(encoded))
+        hasher.update(encoded)
+    elif isinstance(data, collections.abc.Mapping):
+        hasher.update(b"d%d:" % len(data))
+        for key in sorted(data):
+            _update_canonical(hasher, key)
+            _update_canonical(hasher, data[key])
+    elif isinstance(data, (list, tuple)):
+        hasher.update(b"l%d:" % len(data))
+        for item in data:
+            _update_canonical(hasher, item)
+    elif data is None or isinstance(data, (bool, int, float)):
+        hasher.update(b"v%s;" % repr(data).encode("utf-8"))
+    else:
+        _update_canonical(hasher, str(data))
+
+
+def canonical_hash(data) -> bytes:
+    """
+    Fixed-length, versioned cache key.
+
+    Mappings are serialized with sorted keys, so the key does not depend on
+    argument order.
+    """
+    hasher = hashlib.sha256()
+    _update_canonical(hasher, data)
+    return CACHE_KEY_VERSION + hasher.digest()
+
+
 def deterministic_hash(data) -> int:
     try:
         data_str = str(data).encode("utf-8")
@@ -69,8 +113,43 @@ class APICache(ABC):
     service = ""
     exceptions_to_catch = tuple()
 
-    def __init__(self, **redis_kwargs: dict):
-        self.r = redis.Redis(host="localhost", **redis_kwargs)
+    def __init__(
+        self,
+        cache_backend="redis",
+        lru_cache_size=0,
+        cache_key_mode="migrate",
+        cache_compression=None,
+        verify_cache=False,
+        **redis_kwargs: dict,
+    ):
+        """
+        Parameters:
+            cache_backend: Name of the storage backend, "redis" (default) or "sqlite".
+            lru_cache_size: Number of entries to keep in an in-process LRU layer. 0 disables it.
+            cache_key_mode: How cache keys are computed.
+                "v1": fixed-length `canonical_hash` keys.
+                "legacy": the old `hash(FrozenDict)` keys.
+                "migrate" (default): `canonical_hash` keys, falling back to legacy keys on a miss
+                and copying legacy hits to the new key, so existing caches keep working.
+            cache_compression: Compress cached entries with "zstd" (needs `zstandard`) or "zlib". None by default.
+            verify_cache: If true, store the full query in every entry and check it for equality on hits.
+                Otherwise only a fingerprint of the query is stored next to the response.
+            redis_kwargs: Arguments for the backend, e.g. `port` for redis or `cache_path` for sqlite.
+        """
+        if cache_key_mode not in ["v1", "legacy", "migrate"]:
+            raise ValueError(f"Unknown cache_key_mode {cache_key_mode}")
+        self.cache_key_mode = cache_key_mode
+        if cache_compression not in CACHE_ENTRY_CODECS:
+            raise ValueError(f"Unknown cache_compression {cache_compression}")
+        self.cache_compression = cache_compression
+        self.verify_cache = verify_cache
+        self.r = build_cache_backend(
+            cache_backend=cache_backend, lru_cache_size=lru_cache_size, **redis_kwargs
+        )
+
+        # Queries currently being requested, shared by concurrent calls
+        self.inflight: Dict[Hashable, Future] = {}
+        self.inflight_lock = threading.Lock()
 
         self.costs = []
 
@@ -80,60 +159,242 @@ class APICache(ABC):
     def batched_api_call(self, *args, **kwargs):
         raise NotImplementedError("batched_api_call() is not implemented")
 
+    def _cache_key(self, query: FrozenDict):
+        if self.cache_key_mode == "legacy":
+            return hash(query)
+        return canonical_hash(query)
+
+    def _fingerprint(self, query: FrozenDict, hashval):
+        # v1 keys already are the canonical hash of the query
+        return hashval if isinstance(hashval, bytes) else canonical_hash(query)
+
+    def _encode_entry(self, query: FrozenDict, hashval, resp) -> bytes:
+        ident = query if self.verify_cache else self._fingerprint(query, hashval)
+        data = pickle.dumps((ident, resp), protocol=pickle.HIGHEST_PROTOCOL)
+        if self.cache_compression == "zlib":
+            data = zlib.compress(data)
+        elif self.cache_compression == "zstd":
+            import zstandard
+
+            data = zstandard.ZstdCompressor().compress(data)
+        return (
+            CACHE_ENTRY_MAGIC + CACHE_ENTRY_CODECS[self.cache_compression] + data
+        )
+
+    def _decode_entry(self, cache: bytes):
+        if not cache.startswith(CACHE_ENTRY_MAGIC):
+            return pickle.loads(cache)
+        codec = cache[len(CACHE_ENTRY_MAGIC) : len(CACHE_ENTRY_MAGIC) + 1]
+        data = cache[len(CACHE_ENTRY_MAGIC) + 1 :]
+        if codec == CACHE_ENTRY_CODECS["zlib"]:
+            data = zlib.decompress(data)
+        elif codec == CACHE_ENTRY_CODECS["zstd"]:
+            import zstandard
+
+            data = zstandard.ZstdDecompressor().decompress(data)
+        return pickle.loads(data)
+
+    def _match_cache(self, query: FrozenDict, hashval, cache, logger):
+        if cache is None:
+            return False, None
+        ident, resp_cached = self._decode_entry(cache)
+        if isinstance(ident, bytes):
+            # Entries written without verification only hold a fingerprint
+            matched = ident == self._fingerprint(query, hashval)
+        else:
+            matched = ident == query
+        if matched:
+            logger.debug(
+                f"Matched cache for query with cache seed {query['cache_seed']}"
+            )
+            return True, resp_cached
+        logger.debug(
+            f"Hash matches for query and cache, but contents are not equal. "
+            + "Overwriting cache."
+        )
+        return False, None
+
+    def _read_cache(self, queries: List[FrozenDict]):
+        """
+        Looks up all queries with batched backend reads.
+
+        Returns:
+            hashvals: the cache key of every query
+            hits: `(True, response)` for every cached query, `(False, None)` otherwise
+        """
+        logger = LoggerConfig.get_logger(name=logger_name)
+        hashvals = [self._cache_key(query) for query in queries]
+        hits = [
+            self._match_cache(query, hashval, cache, logger)
+            for query, hashval, cache in zip(
+                queries, hashvals, self.r.get_many(hashvals)
+            )
+        ]
+
+        if self.cache_key_mode == "migrate":
+            missing = [idx for idx, (hit, _) in enumerate(hits) if not hit]
+            legacy_caches = (
+                self.r.get_many([hash(queries[idx]) for idx in missing])
+                if len(missing) > 0
+                else []
+            )
+            migrated = []
+            for idx, cache in zip(missing, legacy_caches):
+                hits[idx] = self._match_cache(
+                    queries[idx], hashvals[idx], cache, logger
+                )
+                if hits[idx][0]:
+                    migrated.append(
+                        (
+                            hashvals[idx],
+                            self._encode_entry(queries[idx], hashvals[idx], hits[idx][1]),
+                        )
+                    )
+            if len(migrated) > 0:
+                logger.debug(f"Migrating {len(migrated)} legacy cache entries")
+                self.r.set_many(migrated)
+
+        return hashvals, hits
+
     def batched_generate(
-        self, messages, max_concurrent=3, overwrite_cache: bool = False, cache_seed=None, **kwargs
+        self,
+        messages,
+        max_concurrent=3,
+        overwrite_cache: bool = False,
+        cache_seed=None,
+        batched_api_call=None,
+        **kwargs,
     ):
+        """Requests all messages not found in cache in one batch, and returns the responses.
+
+        Args:
+            batched_api_call: Optional replacement for `self.batched_api_call` for this call,
+              e.g. an offline batch job. It is not part of the cache key.
+        """
         logger = LoggerConfig.get_logger(name=logger_name)
+        if batched_api_call is None:
+            batched_api_call = self.batched_api_call
         need_to_req_msgs = []
         responses = ["" for _ in range(len(messages))]
-        hashvals = []
-        queries = []
-        for idx, msg in enumerate(messages):
-            query = FrozenDict({**kwargs, "messages": msg, "cache_seed": cache_seed})
-            hashval = hash(query)
-            cache = self.r.hget(hashval, "data")
-
-            queries.append(query)
-            hashvals.append(hashval)
-            if overwrite_cache:
-                logger.debug("Overwriting cache")
-            elif cache is not None:
-                query_cached, resp_cached = pickle.loads(cache)
-                if query_cached == query:
-                    logger.debug(f"Matched cache for query with cache seed {cache_seed}")
-                    responses[idx] = resp_cached
-                    continue
-                logger.debug(
-                    f"Hash matches for query and cache, but contents are not equal. "
-                    + "Overwriting cache."
-                )
+        queries = [
+            FrozenDict({**kwargs, "messages": msg, "cache_seed": cache_seed})
+            for msg in messages
+        ]
+
+        if overwrite_cache:
+            logger.debug("Overwriting cache")
+            hashvals = [self._cache_key(query) for query in queries]
+            hits = [(False, None) for _ in range(len(queries))]
+        else:
+            # Fetch every entry in a single round trip instead of one lookup per message
+            hashvals, hits = self._read_cache(queries)
+
+        for idx, (hit, resp_cached) in enumerate(hits):
+            if hit:
+                responses[idx] = resp_cached
             else:
-                logger.debug(f"Matching hash not found for query")
-            need_to_req_msgs.append(idx)
+                need_to_req_msgs.append(idx)
+
+        if overwrite_cache:
+            to_req_msgs, owned, waiting = need_to_req_msgs, {}, {}
+        else:
+            to_req_msgs, owned, waiting = self._claim_requests(
+                [hashvals[idx] for idx in need_to_req_msgs], need_to_req_msgs
+            )
 
         logger.debug(f"Request Completion from {self.service} API...")
 
         logger.info(
-            f"Need to request {len(need_to_req_msgs)} / {len(messages)} messages"
+            f"Need to request {len(to_req_msgs)} / {len(messages)} messages"
+            + (
+                f" ({len(need_to_req_msgs) - len(to_req_msgs)} duplicate or already in flight)"
+                if len(to_req_msgs) < len(need_to_req_msgs)
+                else ""
+            )
         )
 
-        resps = self.batched_api_call(
-            [messages[i] for i in need_to_req_msgs],
-            max_concurrent=max_concurrent,
-            **kwargs,
-        )
+        try:
+            resps = batched_api_call(
+                [messages[i] for i in to_req_msgs],
+                max_concurrent=max_concurrent,
+                **kwargs,
+            )
+            if len(resps) != len(to_req_msgs):
+                raise ValueError(
+                    f"{self.service} API returned {len(resps)} responses for {len(to_req_msgs)} messages"
+                )
+        except BaseException as e:
+            self._release_requests(owned, exception=e)
+            raise
 
-        for idx, resp in zip(need_to_req_msgs, resps):
+        items = []
+        resp_by_hashval = {}
+        for idx, resp in zip(to_req_msgs, resps):
             query = queries[idx]
             hashval = hashvals[idx]
             responses[idx] = resp
+            resp_by_hashval[hashval] = resp
 
-            data = pickle.dumps((query, resp))
-            logger.debug(f"Writing query and resp to Redis")
-            self.r.hset(hashval, "data", data)
+            items.append((hashval, self._encode_entry(query, hashval, resp)))
+        try:
+            if len(items) > 0:
+                logger.debug(f"Writing {len(items)} queries and resps to cache")
+                self.r.set_many(items)
+        finally:
+            self._release_requests(owned, results=resp_by_hashval)
+
+        if overwrite_cache:
+            # every duplicate was requested and keeps its own response
+            return responses
+
+        # Fan out responses to duplicates and to queries requested by other calls
+        for hashval, future in waiting.items():
+            resp_by_hashval[hashval] = future.result()
+        for idx in need_to_req_msgs:
+            responses[idx] = resp_by_hashval[hashvals[idx]]
 
         return responses
 
+    def _claim_requests(self, hashvals, indices):
+        """
+        Collapses duplicate queries and registers the remaining ones as in flight.
+
+        Parameters:
+            hashvals: cache keys of the queries that missed the cache
+            indices: position of every query in the batch
+
+        Returns:
+            to_request: indices of the queries this call has to request
+            owned: futures this call must resolve, keyed by cache key
+            waiting: futures of queries already requested by a concurrent call
+        """
+        to_request = []
+        owned = {}
+        waiting = {}
+        with self.inflight_lock:
+            for hashval, idx in zip(hashvals, indices):
+                if hashval in owned or hashval in waiting:
+                    continue
+                if hashval in self.inflight:
+                    waiting[hashval] = self.inflight[hashval]
+                else:
+                    owned[hashval] = self.inflight[hashval] = Future()
+                    to_request.append(idx)
+        return to_request, owned, waiting
+
+    def _release_requests(self, owned, results=None, exception=None):
+        with self.inflight_lock:
+            for hashval, future in owned.items():
+                self.inflight.pop(hashval, None)
+                if exception is None and hashval in results:
+                    future.set_result(results[hashval])
+                else:
+                    future.set_exception(
+                        exception
+                        if exception is not None
+                        else Exception("No response received for query")
+                    )
+
     def generate(self, overwrite_cache: bool=False, cache_seed=None, **kwargs):
         """Makes an API request if not found in cache, and returns the response.
 
@@ -147,29 +408,35 @@ class APICache(ABC):
         """
         logger = LoggerConfig.get_logger(name=logger_name)
         query = FrozenDict({**kwargs, "cache_seed": cache_seed})
-        hashval = hash(query)
-        cache = self.r.hget(hashval, "data")
         if overwrite_cache:
             logger.debug("Overwriting cache")
-        elif cache is not None:
-            query_cached, resp_cached = pickle.loads(cache)
-            if query_cached == query:
-                logger.debug(f"Matched cache for query with cache seed {cache_seed}")
-                return resp_cached
-            logger.debug(
-                f"Hash matches for query and cache, but contents are not equal. "
-                + "Overwriting cache."
-            )
+            hashval = self._cache_key(query)
+            owned = {}
         else:
+            [hashval], [(hit, resp_cached)] = self._read_cache([query])
+            if hit:
+                return resp_cached
             logger.debug(f"Matching hash not found for query")
 
+            _, owned, waiting = self._claim_requests([hashval], [0])
+            if hashval in waiting:
+                logger.debug(f"Waiting for identical query already in flight")
+                return waiting[hashval].result()
+
         logger.debug(f"Request Completion from {self.service} API...")
 
-        resp = self.api_call(**kwargs)
+        try:
+            resp = self.api_call(**kwargs)
+        except BaseException as e:
+            self._release_requests(owned, exception=e)
+            raise
 
-        data = pickle.dumps((query, resp))
-        logger.debug(f"Writing query and resp to Redis")
-        self.r.hset(hashval, "data", data)
+        data = self._encode_entry(query, hashval, resp)
+        logger.debug(f"Writing query and resp to cache")
+        try:
+            self.r.set(hashval, data)
+        finally:
+            self._release_requests(owned, results={hashval: resp})
 
         return resp
 
@@ -190,6 +457,7 @@ class OpenAIAPICache(APICache):
 
         Args:
             port: Port of the Redis backend.
+            cache_backend: "redis" or "sqlite".
             mode: "completion" or "chat", determines which API to call
         """
         super().__init__(**redis_kwargs)
@@ -205,6 +473,7 @@ class ClaudeAPICache(APICache):
 
         Args:
             port: Port of the Redis backend.
+            cache_backend: "redis" or "sqlite".
             client: Authenticated Claude client
         """
         super().__init__(**redis_kwargs)
@@ -220,6 +489,7 @@ class LocalModelAPICache(APICache):
 
         Args:
             port: Port of the Redis backend.
+            cache_backend: "redis" or "sqlite".
             client: intiailzed LocalModel
         """
         super().__init__(**redis_kwargs)
@@ -0,0 +1,198 @@
+""" Storage backends for the LLM response cache """
+
+import collections
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Hashable, List, Optional, Tuple
+
+import redis
+
+from .register import Register
+from .logger_config import LoggerConfig
+
+logger_name = "HypoGenic - LLM_cache_backend"
+
+cache_backend_register = Register(name="cache_backend")
+
+
+class CacheBackend(ABC):
+    """Abstract key-value store used by `APICache`.
+
+    Keys are whatever `APICache` uses as a hash value, values are serialized bytes.
+    Backends only need to implement the batched operations.
+    """
+
+    @abstractmethod
+    def get_many(self, keys: List[Hashable]) -> List[Optional[bytes]]:
+        """Returns the stored value for every key, or `None` for missing keys."""
+        pass
+
+    @abstractmethod
+    def set_many(self, items: List[Tuple[Hashable, bytes]]):
+        """Stores every `(key, value)` pair."""
+        pass
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        return self.get_many([key])[0]
+
+    def set(self, key: Hashable, value: bytes):
+        self.set_many([(key, value)])
+
+
+@cache_backend_register.register("redis")
+class RedisCacheBackend(CacheBackend):
+    """Redis hash store. Batched operations are sent as a single pipeline."""
+
+    def __init__(self, host="localhost", **redis_kwargs):
+        self.r = redis.Redis(host=host, **redis_kwargs)
+
+    def get_many(self, keys):
+        pipe = self.r.pipeline(transaction=False)
+        for key in keys:
+            pipe.hget(key, "data")
+        return pipe.execute()
+
+    def set_many(self, items):
+        if len(items) == 0:
+            return
+        pipe = self.r.pipeline(transaction=False)
+        for key, value in items:
+            pipe.hset(key, "data", value)
+        pipe.execute()
+
+
+@cache_backend_register.register("sqlite")
+class SQLiteCacheBackend(CacheBackend):
+    """Embedded, file-backed store. Needs no server process.
+
+    The database runs in WAL mode so several processes can share one cache file,
+    and is memory-mapped so that hot pages are read without syscalls.
+    """
+
+    def __init__(
+        self,
+        cache_path="./.hypogenic_cache.sqlite",
+        mmap_size=1 << 30,
+        timeout=60.0,
+        **kwargs,
+    ):
+        """
+        Parameters:
+            cache_path: Path to the database file. Created if it does not exist.
+            mmap_size: Maximum number of bytes of the database to memory-map.
+            timeout: Seconds to wait for a write lock held by another process.
+            kwargs: Redis specific arguments (e.g. `port`), ignored by this backend.
+        """
+        logger = LoggerConfig.get_logger(logger_name)
+        if len(kwargs) > 0:
+            logger.debug(f"Ignoring arguments {list(kwargs.keys())} for sqlite cache")
+
+        cache_dir = os.path.dirname(os.path.abspath(cache_path))
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            cache_path, timeout=timeout, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key BLOB PRIMARY KEY, data BLOB NOT NULL)"
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def _to_db_key(key) -> bytes:
+        # Same encoding redis-py uses for non-bytes keys
+        return key if isinstance(key, bytes) else str(key).encode("utf-8")
+
+    def get_many(self, keys):
+        db_keys = [self._to_db_key(key) for key in keys]
+        found = {}
+        with self.lock:
+            # Stay well below SQLITE_MAX_VARIABLE_NUMBER
+            for start in range(0, len(db_keys), 500):
+                chunk = db_keys[start : start + 500]
+                rows = self.conn.execute(
+                    f"SELECT key, data FROM cache WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                found.update(rows)
+        return [found.get(db_key) for db_key in db_keys]
+
+    def set_many(self, items):
+        if len(items) == 0:
+            return
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO cache (key, data) VALUES (?, ?)",
+                    [(self._to_db_key(key), value) for key, value in items],
+                )
+
+
+class LRUCacheBackend(CacheBackend):
+    """In-process LRU layer in front of another backend.
+
+    Hot keys are served from process memory; misses and writes go through to
+    the wrapped backend.
+    """
+
+    def __init__(self, backend: CacheBackend, max_size=10000):
+        self.backend = backend
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get_many(self, keys):
+        values = [None for _ in range(len(keys))]
+        missing = []
+        with self.lock:
+            for idx, key in enumerate(keys):
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    values[idx] = self.entries[key]
+                else:
+                    missing.append(idx)
+
+        if len(missing) > 0:
+            fetched = self.backend.get_many([keys[idx] for idx in missing])
+            with self.lock:
+                for idx, value in zip(missing, fetched):
+                    values[idx] = value
+                    if value is not None:
+                        self._put(keys[idx], value)
+        return values
+
+    def set_many(self, items):
+        self.backend.set_many(items)
+        with self.lock:
+            for key, value in items:
+                self._put(key, value)
+
+
+def build_cache_backend(
+    cache_backend="redis", lru_cache_size=0, **backend_kwargs
+) -> CacheBackend:
+    """
+    Build a cache backend from the registry, optionally with an in-process LRU layer.
+
+    Parameters:
+        cache_backend: Name of the registered backend, e.g. "redis" or "sqlite"
+        lru_cache_size: Number of entries kept in process memory. 0 disables the LRU layer.
+        backend_kwargs: Arguments passed to the backend constructor
+    """
+    backend = cache_backend_register.build(cache_backend)(**backend_kwargs)
+    if lru_cache_size > 0:
+        backend = LRUCacheBackend(backend, max_size=lru_cache_size)
+    return backend
@@ -1,8 +1,31 @@
+import importlib
+
 from ..register import Register
 
 llm_wrapper_register = Register(name="llm_wrapper")
 
 from .base import LLMWrapper
-from .claude import ClaudeWrapper
-from .gpt import GPTWrapper
-from .local import LocalModelWrapper, LocalHFWrapper, LocalVllmWrapper
+from .vllm_engine import ContinuousBatchingEngine, FakeAsyncEngine
+from .fake_batch_api import FakeBatchClient
+
+# Backends are imported on first use, so that e.g. an OpenAI run does not load
+# torch, vLLM and transformers.
+_lazy_wrappers = {
+    "GPTWrapper": ".gpt",
+    "ClaudeWrapper": ".claude",
+    "LocalModelWrapper": ".local",
+    "LocalHFWrapper": ".local",
+    "LocalVllmWrapper": ".local",
+}
+
+llm_wrapper_register.register_lazy("gpt", f"{__name__}.gpt:GPTWrapper")
+llm_wrapper_register.register_lazy("claude", f"{__name__}.claude:ClaudeWrapper")
+llm_wrapper_register.register_lazy("huggingface", f"{__name__}.local:LocalHFWrapper")
+llm_wrapper_register.register_lazy("vllm", f"{__name__}.local:LocalVllmWrapper")
+
+
+def __getattr__(name):
+    if name in _lazy_wrappers:
+        module = importlib.import_module(_lazy_wrappers[name], __name__)
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -2,50 +2,133 @@ from abc import ABC, abstractmethod
 import pickle
 import math
 from typing import Callable, Dict, List
-import torch
 import re
 import os
-import numpy as np
 import random
-import openai
-
-import vllm
 import asyncio
+import threading
+import time
+from collections import namedtuple
 import tqdm
-from openai import AsyncOpenAI, OpenAI
-from anthropic import AsyncAnthropic, Anthropic
-
-from sklearn.metrics import accuracy_score, f1_score
-
-from transformers import (
-    LlamaForCausalLM,
-    LlamaTokenizer,
-    LlamaConfig,
-    AutoModelForCausalLM,
-    AutoTokenizer,
-    pipeline,
-)
-from pprint import pprint
 
+from .concurrency_limiter import AdaptiveConcurrencyLimiter
 from .rate_limiter import RateLimiter
 from ..LLM_cache import ClaudeAPICache, LocalModelAPICache, OpenAIAPICache
 from ..tasks import BaseTask
 
+# Response of a streamed request, `usage` is None if the stream was stopped early
+StreamedResponse = namedtuple("StreamedResponse", ["text", "usage"])
+
+_background_loop = None
+_background_loop_lock = threading.Lock()
+
+
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    """
+    Returns a long-lived event loop running on a daemon thread.
+
+    Synchronous wrapper calls run their coroutines here, so async clients and
+    their connection pools survive across calls.
+    """
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None or _background_loop.is_closed():
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_background_loop.run_forever,
+                name="hypogenic-event-loop",
+                daemon=True,
+            ).start()
+        return _background_loop
+
+
+def run_coroutine(coro):
+    """Runs `coro` on the background event loop and blocks until it finishes."""
+    return asyncio.run_coroutine_threadsafe(coro, get_background_loop()).result()
+
+
+def logsumexp(logprobs: List[float]) -> float:
+    """Adds up probabilities given as log-probabilities. Returns `-inf` for an empty list."""
+    if len(logprobs) == 0:
+        return -math.inf
+    max_logprob = max(logprobs)
+    if max_logprob == -math.inf:
+        return -math.inf
+    return max_logprob + math.log(sum(math.exp(lp - max_logprob) for lp in logprobs))
+
 
 class LLMWrapper(ABC):
+    # errors that signal an overloaded API (rate limits, timeouts); only these lower the
+    # adaptive concurrency limit
+    overload_exceptions = ()
+
     def __init__(
         self,
         model,
         max_retry=30,
         min_backoff=1.0,
         max_backoff=60.0,
+        rpm=None,
+        tpm=None,
+        rate_limiter: RateLimiter = None,
+        adaptive_concurrency=False,
+        concurrency_limiter: AdaptiveConcurrencyLimiter = None,
     ):
+        """
+        Parameters:
+            model: Name of the model
+            max_retry: Maximum number of retries per request
+            min_backoff: Minimum seconds to back off after a rate limit error
+            max_backoff: Maximum seconds to back off after a rate limit error
+            rpm: Requests-per-minute budget enforced before sending. `None` disables it.
+            tpm: Tokens-per-minute budget enforced before sending. `None` disables it.
+            rate_limiter: Existing rate limiter to use instead of creating one, e.g. to share
+                one budget between wrappers (see `get_shared_rate_limiter`).
+            adaptive_concurrency: If true, replace the fixed `max_concurrent` semaphore with an
+                `AdaptiveConcurrencyLimiter` that tunes concurrency from latency and errors.
+            concurrency_limiter: Existing adaptive limiter to use, e.g. to share it between wrappers.
+                Implies `adaptive_concurrency`.
+        """
         self.model = model
         self.max_retry = max_retry
-        self.rate_limiter = RateLimiter(
-            min_backoff=min_backoff,
-            max_backoff=max_backoff,
+        self.rate_limiter = (
+            rate_limiter
+            if rate_limiter is not None
+            else RateLimiter(
+                min_backoff=min_backoff,
+                max_backoff=max_backoff,
+                rpm=rpm,
+                tpm=tpm,
+            )
         )
+        if concurrency_limiter is None and adaptive_concurrency:
+            concurrency_limiter = AdaptiveConcurrencyLimiter()
+        self.concurrency_limiter = concurrency_limiter
+
+    def _concurrency_slot(self, max_concurrent):
+        """
+        Returns the async context manager that bounds concurrent requests of one batch:
+        the adaptive limiter if enabled, otherwise a semaphore of size `max_concurrent`.
+        """
+        if self.concurrency_limiter is not None:
+            return self.concurrency_limiter
+        return asyncio.Semaphore(max_concurrent)
+
+    def _record_success(self, start_time):
+        if self.concurrency_limiter is not None:
+            self.concurrency_limiter.on_success(time.monotonic() - start_time)
+
+    def _record_error(self, e: Exception):
+        if self.concurrency_limiter is not None:
+            self.concurrency_limiter.on_error(
+                e, decrease=isinstance(e, self.overload_exceptions)
+            )
+
+    def concurrency_metrics(self):
+        """Metrics of the adaptive concurrency limiter, or `None` if it is disabled."""
+        if self.concurrency_limiter is None:
+            return None
+        return self.concurrency_limiter.metrics()
 
     @abstractmethod
     def _generate(
@@ -66,12 +149,158 @@ class LLMWrapper(ABC):
     ) -> List[str]:
         pass
 
+    async def _abatched_generate(
+        self,
+        messages: List[List[Dict[str, str]]],
+        model: str,
+        max_concurrent=3,
+        **kwargs,
+    ) -> List[str]:
+        """Async version of `_batched_generate`. Wrappers with async clients override this."""
+        return await asyncio.to_thread(
+            self._batched_generate,
+            messages,
+            model=model,
+            max_concurrent=max_concurrent,
+            **kwargs,
+        )
+
+    def _batch_api_generate(
+        self,
+        messages: List[List[Dict[str, str]]],
+        model: str,
+        max_concurrent=3,
+        **kwargs,
+    ) -> List[str]:
+        """Generates responses through the provider's offline batch API."""
+        raise NotImplementedError(
+            f"{type(self).__name__} does not support the batch API"
+        )
+
+    def _batched_stream_generate(
+        self,
+        messages: List[List[Dict[str, str]]],
+        model: str,
+        stop_predicate: Callable[[str], bool],
+        max_concurrent=3,
+        **kwargs,
+    ) -> List[str]:
+        """
+        Streams the responses and stops each one as soon as `stop_predicate` holds for the
+        text generated so far. Wrappers that can stop a generation early override this,
+        by default the full responses are generated.
+        """
+        return self._batched_generate(
+            messages, model=model, max_concurrent=max_concurrent, **kwargs
+        )
+
+    def _stream_api_call(self, stop_predicate: Callable[[str], bool]):
+        """
+        Returns a batched API call that stops responses at `stop_predicate`. It accepts the
+        `stop_early` flag that keeps stopped responses apart from full ones in the cache.
+        """
+
+        def batched_api_call(messages, stop_early=True, **kwargs):
+            return self._batched_stream_generate(
+                messages, stop_predicate=stop_predicate, **kwargs
+            )
+
+        return batched_api_call
+
+    def _batched_score_choices(
+        self,
+        messages: List[List[Dict[str, str]]],
+        model: str,
+        choices: List[str],
+        max_concurrent=3,
+        **kwargs,
+    ) -> List[List[float]]:
+        """
+        Scores how likely each of `choices` is as the response to every message.
+
+        Wrappers with access to log-probabilities override this. By default a few tokens are
+        generated and the first word of the response is matched against `choices`: the matched
+        choice gets log-probability 0 and every other choice `-inf`.
+
+        Returns:
+            For every message, the log-probability of each choice
+        """
+        responses = self._batched_generate(
+            messages,
+            model=model,
+            max_concurrent=max_concurrent,
+            max_tokens=5,
+            **kwargs,
+        )
+        scores = []
+        for response in responses:
+            match = re.match(r"\W*(\w+)", response if response is not None else "")
+            answer = match.group(1).lower() if match is not None else None
+            scores.append(
+                [0.0 if choice.lower() == answer else -math.inf for choice in choices]
+            )
+        return scores
+
+    def batched_score_choices(
+        self,
+        messages: List[List[Dict[str, str]]],
+        choices: List[str],
+        max_concurrent=3,
+        cache_seed=None,
+        use_batch_api=False,
+        **kwargs,
+    ) -> List[List[float]]:
+        """
+        Scores each of `choices` as the first token of the response to every message, instead
+        of generating a full response. Choices should be short and start with distinct tokens,
+        e.g. the option letters "A", "B", ...
+
+        Parameters:
+            messages: List of chat messages
+            choices: Answers to score
+            max_concurrent: Maximum number of concurrent requests
+            cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
+            use_batch_api: Ignored, scoring requests are always sent in real time
+
+        Returns:
+            For every message, the log-probability of each choice (`-inf` if it is not among
+            the likely first tokens)
+        """
+        if cache_seed is not None:
+            # `choices` is part of the cache key, so scores never collide with generated responses
+            return self.api_with_cache.batched_generate(
+                messages=messages,
+                model=self.model,
+                max_concurrent=max_concurrent,
+                cache_seed=cache_seed,
+                batched_api_call=self._batched_score_choices,
+                choices=list(choices),
+                **kwargs,
+            )
+        return self._batched_score_choices(
+            messages,
+            model=self.model,
+            choices=list(choices),
+            max_concurrent=max_concurrent,
+            **kwargs,
+        )
+
     def generate(
         self,
         messages: List[Dict[str, str]],
         cache_seed=None,
+        use_batch_api=False,
+        stop_predicate: Callable[[str], bool] = None,
         **kwargs,
     ):
+        if stop_predicate is not None:
+            return self.batched_generate(
+                [messages],
+                cache_seed=cache_seed,
+                stop_predicate=stop_predicate,
+                **kwargs,
+            )[0]
+        # A single message is always sent in real time
         if cache_seed is not None:
             return self.api_with_cache.generate(
                 messages=messages,
@@ -90,20 +319,93 @@ class LLMWrapper(ABC):
         messages: List[List[Dict[str, str]]],
         max_concurrent=3,
         cache_seed=None,
+        use_batch_api=False,
+        stop_predicate: Callable[[str], bool] = None,
         **kwargs,
     ):
-        if len(messages) == 1:
-            return [self.generate(messages[0], cache_seed=cache_seed, **kwargs)]
+        """
+        Generates responses for a batch of messages.
 
+        Parameters:
+            messages: List of chat messages
+            max_concurrent: Maximum number of concurrent requests
+            cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
+            use_batch_api: If true, send the batch as an offline job through the provider's batch API.
+                Slower to return, but cheaper and not subject to real-time rate limits.
+            stop_predicate: If given, responses are streamed and cut off as soon as it holds for the
+                text generated so far, e.g. `label_stop_predicate(task.extract_label)`. Stopped responses
+                are cached as they are, apart from full responses. Ignored with `use_batch_api`.
+        """
+        if stop_predicate is not None and not use_batch_api:
+            batched_api_call = self._stream_api_call(stop_predicate)
+            kwargs = {**kwargs, "stop_early": True}
+        elif len(messages) == 1:
+            return [self.generate(messages[0], cache_seed=cache_seed, **kwargs)]
+        else:
+            batched_api_call = (
+                self._batch_api_generate if use_batch_api else self._batched_generate
+            )
         if cache_seed is not None:
             return self.api_with_cache.batched_generate(
                 messages=messages,
                 model=self.model,
                 max_concurrent=max_concurrent,
                 cache_seed=cache_seed,
+                batched_api_call=batched_api_call,
                 **kwargs,
             )
-        return self._batched_generate(
+        return batched_api_call(
+            messages,
+            model=self.model,
+            max_concurrent=max_concurrent,
+            **kwargs,
+        )
+
+    async def agenerate(
+        self,
+        messages: List[Dict[str, str]],
+        cache_seed=None,
+        use_batch_api=False,
+        stop_predicate: Callable[[str], bool] = None,
+        **kwargs,
+    ):
+        """Async version of `generate` for callers that already run in an event loop."""
+        if cache_seed is not None or stop_predicate is not None:
+            # The cache layer is synchronous; keep it off the caller's loop
+            return await asyncio.to_thread(
+                self.generate,
+                messages,
+                cache_seed=cache_seed,
+                stop_predicate=stop_predicate,
+                **kwargs,
+            )
+        return (
+            await self._abatched_generate(
+                [messages], model=self.model, max_concurrent=1, **kwargs
+            )
+        )[0]
+
+    async def abatched_generate(
+        self,
+        messages: List[List[Dict[str, str]]],
+        max_concurrent=3,
+        cache_seed=None,
+        use_batch_api=False,
+        stop_predicate: Callable[[str], bool] = None,
+        **kwargs,
+    ):
+        """Async version of `batched_generate` for callers that already run in an event loop."""
+        if cache_seed is not None or use_batch_api or stop_predicate is not None:
+            return await asyncio.to_thread(
+                self.batched_generate,
+                messages,
+                max_concurrent=max_concurrent,
+                cache_seed=cache_seed,
+                use_batch_api=use_batch_api,
+                stop_predicate=stop_predicate,
+                **kwargs,
+            )
+        return await self._abatched_generate(
             messages,
             model=self.model,
             max_concurrent=max_concurrent,
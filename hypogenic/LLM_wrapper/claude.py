@@ -2,35 +2,20 @@ from abc import ABC, abstractmethod
 import pickle
 import math
 from typing import Callable, Dict, List
-import torch
 import re
 import os
-import numpy as np
 import random
-import openai
-
-import vllm
 import asyncio
+import time
+import weakref
 import tqdm
-from openai import AsyncOpenAI, OpenAI
 import anthropic
 from anthropic import AsyncAnthropic, Anthropic
 
-from sklearn.metrics import accuracy_score, f1_score
-
-from transformers import (
-    LlamaForCausalLM,
-    LlamaTokenizer,
-    LlamaConfig,
-    AutoModelForCausalLM,
-    AutoTokenizer,
-    pipeline,
-)
-from pprint import pprint
-
 from . import llm_wrapper_register
-from .base import LLMWrapper
-from .rate_limiter import RateLimiter
+from .base import LLMWrapper, StreamedResponse, run_coroutine
+from .concurrency_limiter import AdaptiveConcurrencyLimiter
+from .rate_limiter import RateLimiter, estimate_tokens
 from ..LLM_cache import ClaudeAPICache, LocalModelAPICache, OpenAIAPICache
 from ..tasks import BaseTask
 
@@ -39,7 +24,12 @@ from ..tasks import BaseTask
 class ClaudeWrapper(LLMWrapper):
     exceptions_to_catch = (
         anthropic.RateLimitError,
-        # TODO: add more exceptions
+        anthropic.APITimeoutError,
+        anthropic.APIConnectionError,
+    )
+    overload_exceptions = (
+        anthropic.RateLimitError,
+        anthropic.APITimeoutError,
     )
 
     def __init__(
@@ -48,6 +38,11 @@ class ClaudeWrapper(LLMWrapper):
         max_retry=30,
         min_backoff=1.0,
         max_backoff=60.0,
+        rpm=None,
+        tpm=None,
+        rate_limiter: RateLimiter = None,
+        adaptive_concurrency=False,
+        concurrency_limiter: AdaptiveConcurrencyLimiter = None,
         port=6832,
         redis_kwargs: Dict = {},
         **kwargs,
@@ -57,28 +52,51 @@ class ClaudeWrapper(LLMWrapper):
             max_retry=max_retry,
             min_backoff=min_backoff,
             max_backoff=max_backoff,
+            rpm=rpm,
+            tpm=tpm,
+            rate_limiter=rate_limiter,
+            adaptive_concurrency=adaptive_concurrency,
+            concurrency_limiter=concurrency_limiter,
         )
         self.api = Anthropic()
+        self.async_clients = weakref.WeakKeyDictionary()
         self.api_with_cache = ClaudeAPICache(port=port, **redis_kwargs)
         self.api_with_cache.api_call = self._generate
         self.api_with_cache.batched_api_call = self._batched_generate
 
-    def _batched_generate(
+    @staticmethod
+    def _usage_tokens(resp):
+        usage = getattr(resp, "usage", None)
+        if usage is None:
+            return None
+        return usage.input_tokens + usage.output_tokens
+
+    def _get_async_client(self) -> AsyncAnthropic:
+        # Async clients are bound to the loop they run on; keep one per loop so
+        # connections are reused across batches
+        loop = asyncio.get_running_loop()
+        if loop not in self.async_clients:
+            self.async_clients[loop] = AsyncAnthropic()
+        return self.async_clients[loop]
+
+    async def _abatched_generate(
         self,
         messages: List[Dict[str, str]],
         model: str,
         max_tokens=500,
         temperature=1e-5,
         max_concurrent=3,
+        stop_predicate: Callable[[str], bool] = None,
         **kwargs,
     ):
         if len(messages) == 0:
             return []
 
-        client = AsyncAnthropic()
+        client = self._get_async_client()
         status_bar = tqdm.tqdm(total=len(messages))
 
         async def _async_generate(sem, messages, **kwargs):
+            num_tokens = estimate_tokens(messages, kwargs.get("max_tokens"))
             for idx, msg in enumerate(messages):
                 if msg["role"] == "system":
                     system_prompt = messages.pop(idx)["content"]
@@ -86,17 +104,31 @@ class ClaudeWrapper(LLMWrapper):
 
             async with sem:
                 for _ in range(self.max_retry):
+                    await self.rate_limiter.aacquire(num_tokens)
+                    start_time = time.monotonic()
                     try:
-                        resp = await client.messages.create(
-                            system=system_prompt,
-                            messages=messages,
-                            **kwargs,
-                        )
+                        if stop_predicate is None:
+                            resp = await client.messages.create(
+                                system=system_prompt,
+                                messages=messages,
+                                **kwargs,
+                            )
+                        else:
+                            resp = await self._astream_text(
+                                client,
+                                stop_predicate,
+                                system=system_prompt,
+                                messages=messages,
+                                **kwargs,
+                            )
                         status_bar.update(1)
                         self.rate_limiter.add_event()
+                        self._record_success(start_time)
+                        self.rate_limiter.record_usage(num_tokens, self._usage_tokens(resp))
                         return resp
                     except self.exceptions_to_catch as e:
-                        self.rate_limiter.backoff(e)
+                        self._record_error(e)
+                        await self.rate_limiter.abackoff(e)
                         continue
                     except anthropic.BadRequestError as e:
                         resp = "Output blocked by content filtering policy"
@@ -106,7 +138,7 @@ class ClaudeWrapper(LLMWrapper):
                 )
 
         self.rate_limiter.add_event()
-        sem = asyncio.Semaphore(max_concurrent)
+        sem = self._concurrency_slot(max_concurrent)
         tasks = [
             _async_generate(
                 sem,
@@ -118,9 +150,56 @@ class ClaudeWrapper(LLMWrapper):
             )
             for i in range(len(messages))
         ]
-        loop = asyncio.get_event_loop()
-        resp = loop.run_until_complete(asyncio.gather(*tasks))
-        return [r.content[0].text for r in resp]
+        resp = await asyncio.gather(*tasks)
+        status_bar.close()
+        if stop_predicate is not None:
+            return [r.text if r is not None else None for r in resp]
+        return [r.content[0].text if r is not None else None for r in resp]
+
+    @staticmethod
+    async def _astream_text(
+        client, stop_predicate: Callable[[str], bool], **kwargs
+    ) -> StreamedResponse:
+        text = ""
+        async with client.messages.stream(**kwargs) as stream:
+            async for delta in stream.text_stream:
+                text += delta
+                if stop_predicate(text):
+                    # leaving the context closes the connection, which stops the generation
+                    return StreamedResponse(text, None)
+            final_message = await stream.get_final_message()
+        return StreamedResponse(text, final_message.usage)
+
+    def _batched_stream_generate(
+        self,
+        messages: List[Dict[str, str]],
+        model: str,
+        stop_predicate: Callable[[str], bool],
+        max_concurrent=3,
+        **kwargs,
+    ):
+        return run_coroutine(
+            self._abatched_generate(
+                messages,
+                model=model,
+                max_concurrent=max_concurrent,
+                stop_predicate=stop_predicate,
+                **kwargs,
+            )
+        )
+
+    def _batched_generate(
+        self,
+        messages: List[Dict[str, str]],
+        model: str,
+        max_concurrent=3,
+        **kwargs,
+    ):
+        return run_coroutine(
+            self._abatched_generate(
+                messages, model=model, max_concurrent=max_concurrent, **kwargs
+            )
+        )
 
     def _generate(
         self,
@@ -130,12 +209,14 @@ class ClaudeWrapper(LLMWrapper):
         temperature=1e-5,
         **kwargs,
     ):
+        num_tokens = estimate_tokens(messages, max_tokens)
         for idx, msg in enumerate(messages):
             if msg["role"] == "system":
                 system_prompt = messages.pop(idx)["content"]
                 break
 
         for _ in range(self.max_retry):
+            self.rate_limiter.acquire(num_tokens)
             try:
                 response = self.api.messages.create(
                     system=system_prompt,
@@ -145,6 +226,7 @@ class ClaudeWrapper(LLMWrapper):
                     temperature=temperature,
                     **kwargs,
                 )
+                self.rate_limiter.record_usage(num_tokens, self._usage_tokens(response))
                 return response.content[0].text
             except self.exceptions_to_catch as e:
                 self.rate_limiter.backoff(e)
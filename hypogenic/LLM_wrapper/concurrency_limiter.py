@@ -0,0 +1,159 @@
+import asyncio
+import collections
+import threading
+import time
+from ..logger_config import LoggerConfig
+
+logger_name = "HypoGenic - ConcurrencyLimiter"
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD (additive increase, multiplicative decrease) replacement for a fixed `asyncio.Semaphore`.
+
+    The limit grows by about one slot per `limit` healthy completions, and is cut by
+    `decrease_factor` on rate limit errors and timeouts. A completion is healthy if its
+    latency stays within `latency_tolerance` times the fastest latency seen so far.
+    The limiter can be shared by wrappers on different threads and event loops.
+
+    Typical usage example:
+
+      limiter = AdaptiveConcurrencyLimiter(initial_limit=3)
+      async with limiter:
+          start = time.monotonic()
+          resp = await client.chat.completions.create(...)
+          limiter.on_success(time.monotonic() - start)
+    """
+
+    def __init__(
+        self,
+        initial_limit=3,
+        min_limit=1,
+        max_limit=64,
+        decrease_factor=0.5,
+        latency_tolerance=2.0,
+        cooldown=1.0,
+        metrics_window=60.0,
+    ):
+        """
+        Parameters:
+            initial_limit: Number of concurrent requests to start with
+            min_limit: Lower bound of the limit
+            max_limit: Upper bound of the limit
+            decrease_factor: Factor applied to the limit on an error
+            latency_tolerance: Latency, relative to the fastest one seen, above which the limit stops growing
+            cooldown: Seconds after a decrease during which further errors do not decrease the limit again
+            metrics_window: Seconds of history used for throughput and error rate
+        """
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.metrics_window = metrics_window
+
+        self.lock = threading.Lock()
+        self.created_at = time.monotonic()
+        self.in_flight = 0
+        self.waiters = []
+        self.min_latency = None
+        self.avg_latency = None
+        self.last_decrease = 0.0
+        self.completions = collections.deque()
+        self.errors = collections.deque()
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self.waiters.append((loop, waiter))
+            await waiter
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+            self._wake_waiters()
+
+    def _wake_waiters(self):
+        # Waiters re-check the limit themselves, so waking all of them is safe
+        waiters, self.waiters = self.waiters, []
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(
+                lambda w=waiter: w.done() or w.set_result(None)
+            )
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    def _trim(self, events, now):
+        while len(events) > 0 and events[0] < now - self.metrics_window:
+            events.popleft()
+
+    def on_success(self, latency: float):
+        """Records a successful request and its latency in seconds."""
+        with self.lock:
+            now = time.monotonic()
+            self.completions.append(now)
+            self._trim(self.completions, now)
+            self.min_latency = (
+                latency if self.min_latency is None else min(self.min_latency, latency)
+            )
+            self.avg_latency = (
+                latency
+                if self.avg_latency is None
+                else 0.9 * self.avg_latency + 0.1 * latency
+            )
+            if self.avg_latency <= self.latency_tolerance * self.min_latency:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+                self._wake_waiters()
+
+    def on_error(self, e: Exception = None, decrease=True):
+        """
+        Records a failed request.
+
+        Parameters:
+            e: The error
+            decrease: Whether to back the limit off. Only rate limit errors and timeouts
+                should; other errors (e.g. bad requests or server errors) are only counted.
+        """
+        logger = LoggerConfig.get_logger(logger_name)
+        with self.lock:
+            now = time.monotonic()
+            self.errors.append(now)
+            self._trim(self.errors, now)
+            if not decrease or now - self.last_decrease < self.cooldown:
+                return
+            self.last_decrease = now
+            self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+            limit = self.limit
+        logger.info(f"Reducing concurrency limit to {int(limit)} after {e}")
+
+    def metrics(self):
+        """Current limit, requests in flight, throughput (requests/s), average latency (s) and error rate."""
+        with self.lock:
+            now = time.monotonic()
+            self._trim(self.completions, now)
+            self._trim(self.errors, now)
+            num_completions = len(self.completions)
+            num_errors = len(self.errors)
+            elapsed = max(1e-9, min(self.metrics_window, now - self.created_at))
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "throughput": num_completions / elapsed,
+                "avg_latency": self.avg_latency,
+                "error_rate": (
+                    num_errors / (num_completions + num_errors)
+                    if num_completions + num_errors > 0
+                    else 0.0
+                ),
+            }
@@ -0,0 +1,156 @@
+import json
+import random
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+
+class FakeBatchClient:
+    """
+    In-memory stand-in for the Files and Batches endpoints of `openai.OpenAI`, for tests
+    and dry runs of `GPTWrapper(..., batch_client=FakeBatchClient())`.
+
+    A batch is `in_progress` until its `num_polls`-th retrieval, which completes it. Like
+    the real API, the output file does not keep the order of the input file. Requests for
+    which `response_fn` raises are written to the error file with status code 400 instead.
+    Uploaded requests are recorded in `requests`, and retrievals in `num_retrieved`.
+    """
+
+    def __init__(
+        self,
+        response_fn: Callable[[Dict], str] = None,
+        num_polls=1,
+        shuffle_seed=0,
+    ):
+        """
+        Parameters:
+            response_fn: Maps the body of a chat completion request to the response text.
+                Defaults to echoing the last message.
+            num_polls: Number of retrievals until a batch completes
+            shuffle_seed: Seed of the order of the results in the output file
+        """
+        self.response_fn = (
+            response_fn
+            if response_fn is not None
+            else (lambda body: body["messages"][-1]["content"])
+        )
+        self.num_polls = num_polls
+        self.shuffle = random.Random(shuffle_seed).shuffle
+        self.files = _FakeFiles(self)
+        self.batches = _FakeBatches(self)
+        self.file_contents: Dict[str, str] = {}
+        self.requests: List[Dict] = []
+        self.num_retrieved = 0
+
+    def _add_file(self, text: str) -> SimpleNamespace:
+        file_id = f"file-{len(self.file_contents)}"
+        self.file_contents[file_id] = text
+        return SimpleNamespace(id=file_id)
+
+    def _run(self, requests: List[Dict]):
+        """Returns the output and error lines of a batch of requests."""
+        output, errors = [], []
+        for request in requests:
+            try:
+                text = self.response_fn(request["body"])
+            except Exception as e:
+                errors.append(
+                    {
+                        "id": f"batch_req_{len(errors)}",
+                        "custom_id": request["custom_id"],
+                        "response": {
+                            "status_code": 400,
+                            "body": {"error": {"message": str(e)}},
+                        },
+                        "error": None,
+                    }
+                )
+                continue
+            output.append(
+                {
+                    "id": f"batch_req_{len(output)}",
+                    "custom_id": request["custom_id"],
+                    "response": {
+                        "status_code": 200,
+                        "body": {
+                            "choices": [
+                                {
+                                    "index": 0,
+                                    "message": {"role": "assistant", "content": text},
+                                    "finish_reason": "stop",
+                                }
+                            ]
+                        },
+                    },
+                    "error": None,
+                }
+            )
+        self.shuffle(output)
+        return output, errors
+
+
+class _FakeFiles:
+    def __init__(self, client: FakeBatchClient):
+        self.client = client
+
+    def create(self, file, purpose):
+        return self.client._add_file(file.read().decode("utf-8"))
+
+    def content(self, file_id):
+        return SimpleNamespace(text=self.client.file_contents[file_id])
+
+
+class _FakeBatches:
+    def __init__(self, client: FakeBatchClient):
+        self.client = client
+        self.batches = {}
+
+    def create(self, input_file_id, endpoint, completion_window):
+        requests = [
+            json.loads(line)
+            for line in self.client.file_contents[input_file_id].splitlines()
+        ]
+        self.client.requests.extend(requests)
+        batch = SimpleNamespace(
+            id=f"batch-{len(self.batches)}",
+            status="validating",
+            requests=requests,
+            remaining_polls=self.client.num_polls,
+            output_file_id=None,
+            error_file_id=None,
+            request_counts=SimpleNamespace(
+                total=len(requests), completed=0, failed=0
+            ),
+        )
+        self.batches[batch.id] = batch
+        return self._public(batch)
+
+    def retrieve(self, batch_id):
+        self.client.num_retrieved += 1
+        batch = self.batches[batch_id]
+        if batch.status != "completed":
+            batch.status = "in_progress"
+            batch.remaining_polls -= 1
+        if batch.status == "in_progress" and batch.remaining_polls <= 0:
+            output, errors = self.client._run(batch.requests)
+            batch.status = "completed"
+            batch.request_counts.completed = len(output)
+            batch.request_counts.failed = len(errors)
+            if len(output) > 0:
+                batch.output_file_id = self.client._add_file(
+                    "".join(json.dumps(line) + "\n" for line in output)
+                ).id
+            if len(errors) > 0:
+                batch.error_file_id = self.client._add_file(
+                    "".join(json.dumps(line) + "\n" for line in errors)
+                ).id
+        return self._public(batch)
+
+    @staticmethod
+    def _public(batch):
+        return SimpleNamespace(
+            id=batch.id,
+            status=batch.status,
+            output_file_id=batch.output_file_id,
+            error_file_id=batch.error_file_id,
+            request_counts=batch.request_counts,
+        )
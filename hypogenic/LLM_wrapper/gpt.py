@@ -2,45 +2,42 @@ from abc import ABC, abstractmethod
 import pickle
 import math
 from typing import Callable, Dict, List
-import torch
 import re
 import os
-import numpy as np
 import random
 import openai
-
-import vllm
 import asyncio
+import json
+import tempfile
+import time
+import weakref
 import tqdm
 from openai import AsyncOpenAI, OpenAI
-from anthropic import AsyncAnthropic, Anthropic
-
-from sklearn.metrics import accuracy_score, f1_score
-
-from transformers import (
-    LlamaForCausalLM,
-    LlamaTokenizer,
-    LlamaConfig,
-    AutoModelForCausalLM,
-    AutoTokenizer,
-    pipeline,
-)
-from pprint import pprint
 
 from . import llm_wrapper_register
-from .base import LLMWrapper
-from .rate_limiter import RateLimiter
+from .base import LLMWrapper, StreamedResponse, logsumexp, run_coroutine
+from .concurrency_limiter import AdaptiveConcurrencyLimiter
+from .rate_limiter import RateLimiter, estimate_tokens
 from ..LLM_cache import ClaudeAPICache, LocalModelAPICache, OpenAIAPICache
 from ..tasks import BaseTask
+from ..logger_config import LoggerConfig
+
+logger_name = "HypoGenic - GPTWrapper"
 
 
 @llm_wrapper_register.register("gpt")
 class GPTWrapper(LLMWrapper):
+    # OpenAI accepts at most 50,000 requests per batch
+    max_batch_requests = 50000
     exceptions_to_catch = (
         openai.RateLimitError,
         openai.APIError,
         openai.APITimeoutError,
     )
+    overload_exceptions = (
+        openai.RateLimitError,
+        openai.APITimeoutError,
+    )
 
     def __init__(
         self,
@@ -48,24 +45,53 @@ class GPTWrapper(LLMWrapper):
         max_retry=30,
         min_backoff=1.0,
         max_backoff=60.0,
+        rpm=None,
+        tpm=None,
+        rate_limiter: RateLimiter = None,
+        adaptive_concurrency=False,
+        concurrency_limiter: AdaptiveConcurrencyLimiter = None,
         port=6832,
         timeout=20,
+        batch_poll_interval=30.0,
+        batch_client=None,
         redis_kwargs: Dict = {},
         **kwargs,
     ):
+        """
+        Parameters:
+            batch_poll_interval: Seconds between status checks of a Batch API job
+            batch_client: Client for the Files and Batches endpoints, e.g. `FakeBatchClient` for tests.
+                Defaults to the OpenAI client.
+        """
         super().__init__(
             model,
             max_retry=max_retry,
             min_backoff=min_backoff,
             max_backoff=max_backoff,
+            rpm=rpm,
+            tpm=tpm,
+            rate_limiter=rate_limiter,
+            adaptive_concurrency=adaptive_concurrency,
+            concurrency_limiter=concurrency_limiter,
         )
         self.timeout = timeout
+        self.batch_poll_interval = batch_poll_interval
         self.api = OpenAI()
+        self.batch_client = batch_client if batch_client is not None else self.api
+        self.async_clients = weakref.WeakKeyDictionary()
         self.api_with_cache = OpenAIAPICache(port=port, **redis_kwargs)
         self.api_with_cache.api_call = self._generate
         self.api_with_cache.batched_api_call = self._batched_generate
 
-    def _batched_generate(
+    def _get_async_client(self) -> AsyncOpenAI:
+        # Async clients are bound to the loop they run on; keep one per loop so
+        # connections are reused across batches
+        loop = asyncio.get_running_loop()
+        if loop not in self.async_clients:
+            self.async_clients[loop] = AsyncOpenAI()
+        return self.async_clients[loop]
+
+    async def _abatched_request(
         self,
         messages: List[List[Dict[str, str]]],
         model: str,
@@ -73,31 +99,49 @@ class GPTWrapper(LLMWrapper):
         max_tokens=500,
         temperature=1e-5,
         n=1,
+        stream_consumer=None,
         **kwargs,
     ):
+        """
+        Sends every message as a chat completion request and returns the raw responses.
+
+        Parameters:
+            stream_consumer: For streamed requests, a coroutine function reading a stream into
+                a `StreamedResponse`. It runs inside the retry loop, so a dropped stream is retried.
+        """
         if len(messages) == 0:
             return []
 
-        client = AsyncOpenAI()
+        client = self._get_async_client()
         status_bar = tqdm.tqdm(total=len(messages))
 
         async def _async_generate(sem, **kwargs):
+            num_tokens = estimate_tokens(kwargs["messages"], kwargs.get("max_tokens"))
             async with sem:
                 for _ in range(self.max_retry):
+                    await self.rate_limiter.aacquire(num_tokens)
+                    start_time = time.monotonic()
                     try:
                         resp = await client.chat.completions.create(timeout=self.timeout, **kwargs)
+                        if stream_consumer is not None:
+                            resp = await stream_consumer(resp)
                         status_bar.update(1)
                         self.rate_limiter.add_event()
+                        self._record_success(start_time)
+                        self.rate_limiter.record_usage(
+                            num_tokens, getattr(resp.usage, "total_tokens", None)
+                        )
                         return resp
                     except self.exceptions_to_catch as e:
-                        self.rate_limiter.backoff(e)
+                        self._record_error(e)
+                        await self.rate_limiter.abackoff(e)
                         continue
                 raise Exception(
                     "Max retry exceeded and failed to get response from API, possibly due to bad API requests."
                 )
 
         self.rate_limiter.add_event()
-        sem = asyncio.Semaphore(max_concurrent)
+        sem = self._concurrency_slot(max_concurrent)
         tasks = [
             _async_generate(
                 sem,
@@ -110,10 +154,251 @@ class GPTWrapper(LLMWrapper):
             )
             for i in range(len(messages))
         ]
-        loop = asyncio.get_event_loop()
-        resp = loop.run_until_complete(asyncio.gather(*tasks))
+        resp = await asyncio.gather(*tasks)
+        status_bar.close()
+        return resp
+
+    async def _abatched_generate(
+        self,
+        messages: List[List[Dict[str, str]]],
+        model: str,
+        max_concurrent=3,
+        **kwargs,
+    ):
+        resp = await self._abatched_request(
+            messages, model=model, max_concurrent=max_concurrent, **kwargs
+        )
         return [r.choices[0].message.content for r in resp]
 
+    async def _abatched_stream_generate(
+        self,
+        messages: List[List[Dict[str, str]]],
+        model: str,
+        stop_predicate: Callable[[str], bool],
+        max_concurrent=3,
+        **kwargs,
+    ):
+        async def _consume(stream) -> StreamedResponse:
+            text = ""
+            usage = None
+            async for chunk in stream:
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if len(chunk.choices) == 0 or chunk.choices[0].delta.content is None:
+                    continue
+                text += chunk.choices[0].delta.content
+                if stop_predicate(text):
+                    # closing the connection stops the generation on the server
+                    await stream.close()
+                    break
+            return StreamedResponse(text, usage)
+
+        resp = await self._abatched_request(
+            messages,
+            model=model,
+            max_concurrent=max_concurrent,
+            stream=True,
+            stream_options={"include_usage": True},
+            stream_consumer=_consume,
+            **kwargs,
+        )
+        return [r.text for r in resp]
+
+    def _batched_stream_generate(
+        self,
+        messages: List[List[Dict[str, str]]],
+        model: str,
+        stop_predicate: Callable[[str], bool],
+        max_concurrent=3,
+        **kwargs,
+    ):
+        return run_coroutine(
+            self._abatched_stream_generate(
+                messages,
+                model=model,
+                stop_predicate=stop_predicate,
+                max_concurrent=max_concurrent,
+                **kwargs,
+            )
+        )
+
+    @staticmethod
+    def _choice_logprobs(top_logprobs, choices: List[str]) -> List[float]:
+        """Adds up the probabilities of the top first tokens that spell each choice."""
+        return [
+            logsumexp(
+                [
+                    top.logprob
+                    for top in top_logprobs
+                    if top.token.strip().lower() == choice.lower()
+                ]
+            )
+            for choice in choices
+        ]
+
+    async def _abatched_score_choices(
+        self,
+        messages: List[List[Dict[str, str]]],
+        model: str,
+        choices: List[str],
+        max_concurrent=3,
+        top_logprobs=20,
+        **kwargs,
+    ):
+        # one output token is enough, the scores come from its top log-probabilities
+        resp = await self._abatched_request(
+            messages,
+            model=model,
+            max_concurrent=max_concurrent,
+            max_tokens=1,
+            logprobs=True,
+            top_logprobs=top_logprobs,
+            **kwargs,
+        )
+        return [
+            self._choice_logprobs(r.choices[0].logprobs.content[0].top_logprobs, choices)
+            for r in resp
+        ]
+
+    def _batched_score_choices(
+        self,
+        messages: List[List[Dict[str, str]]],
+        model: str,
+        choices: List[str],
+        max_concurrent=3,
+        **kwargs,
+    ):
+        return run_coroutine(
+            self._abatched_score_choices(
+                messages,
+                model=model,
+                choices=choices,
+                max_concurrent=max_concurrent,
+                **kwargs,
+            )
+        )
+
+    def _batched_generate(
+        self,
+        messages: List[List[Dict[str, str]]],
+        model: str,
+        max_concurrent=3,
+        **kwargs,
+    ):
+        return run_coroutine(
+            self._abatched_generate(
+                messages, model=model, max_concurrent=max_concurrent, **kwargs
+            )
+        )
+
+    def _submit_batch(self, messages, start_idx, **body_kwargs):
+        with tempfile.NamedTemporaryFile(
+            "w", suffix=".jsonl", delete=False
+        ) as batch_file:
+            for idx, msg in enumerate(messages):
+                request = {
+                    "custom_id": f"request-{start_idx + idx}",
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {"messages": msg, **body_kwargs},
+                }
+                batch_file.write(json.dumps(request) + "\n")
+        try:
+            with open(batch_file.name, "rb") as f:
+                input_file = self.batch_client.files.create(file=f, purpose="batch")
+        finally:
+            os.remove(batch_file.name)
+        return self.batch_client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+
+    def _batch_api_generate(
+        self,
+        messages: List[List[Dict[str, str]]],
+        model: str,
+        max_concurrent=3,
+        max_tokens=500,
+        temperature=1e-5,
+        n=1,
+        **kwargs,
+    ):
+        """
+        Sends the messages as offline jobs through the OpenAI Batch API and waits for them.
+
+        Requests that the batch does not answer (failed or expired) are retried in real time.
+        """
+        logger = LoggerConfig.get_logger(logger_name)
+        if len(messages) == 0:
+            return []
+
+        batches = []
+        for start_idx in range(0, len(messages), self.max_batch_requests):
+            batch = self._submit_batch(
+                messages[start_idx : start_idx + self.max_batch_requests],
+                start_idx,
+                model=model,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                n=n,
+                **kwargs,
+            )
+            logger.info(f"Submitted batch {batch.id}")
+            batches.append(batch)
+
+        responses = [None for _ in range(len(messages))]
+        for batch in batches:
+            while batch.status not in ["completed", "failed", "expired", "cancelled"]:
+                time.sleep(self.batch_poll_interval)
+                batch = self.batch_client.batches.retrieve(batch.id)
+                logger.info(
+                    f"Batch {batch.id} is {batch.status}: {batch.request_counts}"
+                )
+            if batch.output_file_id is None:
+                logger.error(f"Batch {batch.id} ended as {batch.status} without output")
+            results = [
+                json.loads(line)
+                for file_id in [batch.output_file_id, batch.error_file_id]
+                if file_id is not None
+                for line in self.batch_client.files.content(file_id).text.splitlines()
+            ]
+            for result in results:
+                response = result.get("response")
+                if response is None or response["status_code"] != 200:
+                    error = (
+                        result.get("error")
+                        or (response or {}).get("body", {}).get("error")
+                        or response
+                    )
+                    logger.warning(
+                        f"Batch request {result['custom_id']} failed: {error}"
+                    )
+                    continue
+                idx = int(result["custom_id"].split("-")[-1])
+                responses[idx] = response["body"]["choices"][0]["message"]["content"]
+
+        missing = [idx for idx, resp in enumerate(responses) if resp is None]
+        if len(missing) > 0:
+            logger.warning(
+                f"{len(missing)} / {len(messages)} requests were not answered by the batch API, "
+                + "requesting them in real time"
+            )
+            for idx, resp in zip(
+                missing,
+                self._batched_generate(
+                    [messages[idx] for idx in missing],
+                    model=model,
+                    max_concurrent=max_concurrent,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    n=n,
+                    **kwargs,
+                ),
+            ):
+                responses[idx] = resp
+        return responses
+
     def _generate(
         self,
         messages,
@@ -124,7 +409,9 @@ class GPTWrapper(LLMWrapper):
         **kwargs,
     ):
         self.rate_limiter.add_event()
+        num_tokens = estimate_tokens(messages, max_tokens)
         for _ in range(self.max_retry):
+            self.rate_limiter.acquire(num_tokens)
             try:
                 resp = self.api.chat.completions.create(
                     messages=messages,
@@ -135,6 +422,9 @@ class GPTWrapper(LLMWrapper):
                     timeout=self.timeout,
                     **kwargs,
                 )
+                self.rate_limiter.record_usage(
+                    num_tokens, getattr(resp.usage, "total_tokens", None)
+                )
                 return resp.choices[0].message.content
             except self.exceptions_to_catch as e:
                 self.rate_limiter.backoff(e)
@@ -9,16 +9,13 @@ import re
 import os
 import numpy as np
 import random
-import openai
 
 import vllm
 from vllm.lora.request import LoRARequest
 import asyncio
+import copy
+import threading
 import tqdm
-from openai import AsyncOpenAI, OpenAI
-from anthropic import AsyncAnthropic, Anthropic
-
-from sklearn.metrics import accuracy_score, f1_score
 
 from transformers import (
     LlamaForCausalLM,
@@ -26,14 +23,46 @@ from transformers import (
     LlamaConfig,
     AutoModelForCausalLM,
     AutoTokenizer,
+    DynamicCache,
+    StoppingCriteria,
+    StoppingCriteriaList,
     pipeline,
 )
 from pprint import pprint
 
 from . import llm_wrapper_register
-from .base import LLMWrapper
+from .base import LLMWrapper, logsumexp
+from .prefix_grouping import group_by_prefix, sort_by_prefix
+from .vllm_engine import ContinuousBatchingEngine
 from ..LLM_cache import ClaudeAPICache, LocalModelAPICache, OpenAIAPICache
 from ..tasks import BaseTask
+from ..utils import seed_torch
+
+# apply a seed set with set_seed before torch was imported
+seed_torch()
+
+
+class PredicateStoppingCriteria(StoppingCriteria):
+    """Stops each sequence of a batch once `stop_predicate` holds for its response so far."""
+
+    def __init__(self, tokenizer, stop_predicate: Callable[[str], bool], prompt_len):
+        self.tokenizer = tokenizer
+        self.stop_predicate = stop_predicate
+        self.prompt_len = prompt_len
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.tensor(
+            [
+                self.stop_predicate(
+                    self.tokenizer.decode(
+                        row[self.prompt_len :], skip_special_tokens=True
+                    )
+                )
+                for row in input_ids
+            ],
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
 
 
 class LocalModelWrapper(LLMWrapper):
@@ -63,10 +92,25 @@ class LocalModelWrapper(LLMWrapper):
 
         self.api_kwargs = {"model": path_name, **kwargs}
         self.api = None
+        self._api_lock = threading.Lock()
         self.api_with_cache = LocalModelAPICache(port=port, **redis_kwargs)
         self.api_with_cache.api_call = self._generate
         self.api_with_cache.batched_api_call = self._batched_generate
 
+    def _build_api(self):
+        raise NotImplementedError
+
+    def _load_api(self):
+        """
+        Loads the model on first use. Callers in several threads, e.g. the runs of
+        `hypogenic_schedule`, share the wrapper, so the model is loaded only once.
+        """
+        if self.api is None:
+            with self._api_lock:
+                if self.api is None:
+                    self.api = self._build_api()
+        return self.api
+
     def _batched_generate(
         self,
         messages: List[Dict[str, str]],
@@ -94,6 +138,28 @@ class LocalModelWrapper(LLMWrapper):
             **kwargs,
         )[0]
 
+    @staticmethod
+    def _choice_token_ids(tokenizer, choices: List[str]) -> List[List[int]]:
+        """
+        Returns the token ids a response can start with to give each choice: the choice
+        encoded on its own and after a space, where that is a single token, otherwise the
+        first token of the choice.
+        """
+        choice_ids = []
+        for choice in choices:
+            ids = set()
+            for text in [choice, " " + choice]:
+                encoded = tokenizer.encode(text, add_special_tokens=False)
+                if len(encoded) == 1:
+                    ids.add(encoded[0])
+            if len(ids) == 0:
+                ids.add(tokenizer.encode(choice, add_special_tokens=False)[0])
+            choice_ids.append(sorted(ids))
+        all_ids = [idx for ids in choice_ids for idx in ids]
+        if len(set(all_ids)) < len(all_ids):
+            raise ValueError(f"Choices {choices} do not start with distinct tokens")
+        return choice_ids
+
 
 @llm_wrapper_register.register("huggingface")
 class LocalHFWrapper(LocalModelWrapper):
@@ -106,8 +172,26 @@ class LocalHFWrapper(LocalModelWrapper):
         max_backoff=60.0,
         port=6832,
         redis_kwargs: Dict = {},
+        batch_size=8,
+        max_batch_tokens=None,
+        prefix_caching=False,
+        min_prefix_tokens=32,
         **kwargs,
     ):
+        """
+        Parameters:
+            batch_size: Number of prompts generated together in one micro-batch. Prompts are
+                bucketed by token length first, so each micro-batch carries little padding.
+            max_batch_tokens: Upper bound on padded prompt tokens per micro-batch. `None` disables it.
+            prefix_caching: If true, group prompts that share a prefix (e.g. the system prompt and
+                hypotheses of inference prompts) and compute the KV cache of each shared prefix once.
+            min_prefix_tokens: Shortest shared prefix, in tokens, worth caching
+            kwargs: Arguments passed to the model
+        """
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.prefix_caching = prefix_caching
+        self.min_prefix_tokens = min_prefix_tokens
         super().__init__(
             model=model,
             path_name=path_name,
@@ -122,6 +206,9 @@ class LocalHFWrapper(LocalModelWrapper):
             model_kwargs=kwargs,
         )
 
+    def _build_api(self):
+        return pipeline(**self.api_kwargs)
+
     def _batched_generate(
         self,
         messages: List[Dict[str, str]],
@@ -129,19 +216,225 @@ class LocalHFWrapper(LocalModelWrapper):
         max_concurrent=3,
         max_tokens=500,
         temperature=1e-5,
+        stop_predicate: Callable[[str], bool] = None,
         **kwargs,
     ):
         if len(messages) == 0:
             return []
-        if self.api is None:
-            self.api = pipeline(**self.api_kwargs)
-        output = self.api(
+        self._load_api()
+        if self.prefix_caching:
+            return self._prefix_cached_generate(
+                messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stop_predicate=stop_predicate,
+                **kwargs,
+            )
+        return self._bucketed_generate(
             messages,
-            max_new_tokens=max_tokens,
+            max_tokens=max_tokens,
             temperature=temperature,
+            stop_predicate=stop_predicate,
             **kwargs,
         )
-        return [o[0]["generated_text"][-1]["content"] for o in output]
+
+    def _batched_stream_generate(
+        self,
+        messages: List[List[Dict[str, str]]],
+        model: str,
+        stop_predicate: Callable[[str], bool],
+        max_concurrent=3,
+        **kwargs,
+    ):
+        # the decoded response of every sequence is checked after each generation step
+        return self._batched_generate(
+            messages,
+            model=model,
+            max_concurrent=max_concurrent,
+            stop_predicate=stop_predicate,
+            **kwargs,
+        )
+
+    def _stopping_criteria(self, stop_predicate: Callable[[str], bool], prompt_len):
+        if stop_predicate is None:
+            return {}
+        return {
+            "stopping_criteria": StoppingCriteriaList(
+                [
+                    PredicateStoppingCriteria(
+                        self.api.tokenizer, stop_predicate, prompt_len
+                    )
+                ]
+            )
+        }
+
+    def _tokenize(self, messages: List[List[Dict[str, str]]]):
+        tokenizer = self.api.tokenizer
+        input_ids = [
+            tokenizer.apply_chat_template(m, tokenize=True, add_generation_prompt=True)
+            for m in messages
+        ]
+        pad_token_id = (
+            tokenizer.pad_token_id
+            if tokenizer.pad_token_id is not None
+            else tokenizer.eos_token_id
+        )
+        return input_ids, pad_token_id
+
+    def _pad_batch(self, input_ids: List[List[int]], batch: List[int], pad_token_id):
+        """Left pads the prompts of `batch`, returns the token ids and the attention mask."""
+        device = self.api.model.device
+        # the first prompt of a batch is its longest one
+        max_len = len(input_ids[batch[0]])
+        # decoder-only models need left padding
+        ids = torch.tensor(
+            [
+                [pad_token_id] * (max_len - len(input_ids[idx])) + input_ids[idx]
+                for idx in batch
+            ],
+            device=device,
+        )
+        attention_mask = torch.tensor(
+            [
+                [0] * (max_len - len(input_ids[idx])) + [1] * len(input_ids[idx])
+                for idx in batch
+            ],
+            device=device,
+        )
+        return ids, attention_mask
+
+    def _micro_batches(self, input_ids: List[List[int]]) -> List[List[int]]:
+        """Splits prompt indices, longest first, into micro-batches of similar length."""
+        order = sorted(
+            range(len(input_ids)), key=lambda idx: len(input_ids[idx]), reverse=True
+        )
+        batches = []
+        for idx in order:
+            if len(batches) > 0:
+                batch = batches[-1]
+                # the first prompt of a batch is its longest one
+                padded_tokens = (len(batch) + 1) * len(input_ids[batch[0]])
+                if len(batch) < self.batch_size and (
+                    self.max_batch_tokens is None
+                    or padded_tokens <= self.max_batch_tokens
+                ):
+                    batch.append(idx)
+                    continue
+            batches.append([idx])
+        return batches
+
+    @torch.no_grad()
+    def _bucketed_generate(
+        self,
+        messages: List[List[Dict[str, str]]],
+        max_tokens=500,
+        temperature=1e-5,
+        stop_predicate: Callable[[str], bool] = None,
+        **kwargs,
+    ):
+        model, tokenizer = self.api.model, self.api.tokenizer
+        input_ids, pad_token_id = self._tokenize(messages)
+
+        responses = [None for _ in range(len(messages))]
+        for batch in self._micro_batches(input_ids):
+            ids, attention_mask = self._pad_batch(input_ids, batch, pad_token_id)
+            max_len = ids.shape[1]
+            output = model.generate(
+                ids,
+                attention_mask=attention_mask,
+                max_new_tokens=max_tokens,
+                temperature=temperature,
+                pad_token_id=pad_token_id,
+                **self._stopping_criteria(stop_predicate, max_len),
+                **kwargs,
+            )
+            for row, idx in enumerate(batch):
+                responses[idx] = tokenizer.decode(
+                    output[row, max_len:], skip_special_tokens=True
+                )
+        return responses
+
+    @torch.no_grad()
+    def _batched_score_choices(
+        self,
+        messages: List[List[Dict[str, str]]],
+        model: str,
+        choices: List[str],
+        max_concurrent=3,
+        **kwargs,
+    ):
+        """
+        Scores the choices from the next-token distribution after each prompt, with one
+        forward pass per micro-batch and no generation.
+        """
+        if len(messages) == 0:
+            return []
+        self._load_api()
+        model, tokenizer = self.api.model, self.api.tokenizer
+        input_ids, pad_token_id = self._tokenize(messages)
+        choice_ids = self._choice_token_ids(tokenizer, choices)
+
+        scores = [None for _ in range(len(messages))]
+        for batch in self._micro_batches(input_ids):
+            ids, attention_mask = self._pad_batch(input_ids, batch, pad_token_id)
+            # positions start after the padding, like in generate()
+            position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+            logits = model(
+                ids, attention_mask=attention_mask, position_ids=position_ids
+            ).logits[:, -1, :]
+            logprobs = torch.log_softmax(logits.float(), dim=-1)
+            for row, idx in enumerate(batch):
+                scores[idx] = [
+                    logsumexp(logprobs[row, token_ids].tolist())
+                    for token_ids in choice_ids
+                ]
+        return scores
+
+    @torch.no_grad()
+    def _prefix_cached_generate(
+        self,
+        messages: List[List[Dict[str, str]]],
+        max_tokens=500,
+        temperature=1e-5,
+        stop_predicate: Callable[[str], bool] = None,
+        **kwargs,
+    ):
+        model, tokenizer = self.api.model, self.api.tokenizer
+        input_ids, pad_token_id = self._tokenize(messages)
+
+        responses = [None for _ in range(len(messages))]
+        for prefix_len, indices in group_by_prefix(input_ids, self.min_prefix_tokens):
+            # generate() needs at least one uncached token per prompt
+            prefix_len = min([prefix_len] + [len(input_ids[i]) - 1 for i in indices])
+            prefix_cache = None
+            if len(indices) > 1 and prefix_len > 0:
+                prefix = torch.tensor(
+                    [input_ids[indices[0]][:prefix_len]], device=model.device
+                )
+                prefix_cache = model(
+                    prefix, past_key_values=DynamicCache(), use_cache=True
+                ).past_key_values
+
+            for idx in indices:
+                ids = torch.tensor([input_ids[idx]], device=model.device)
+                output = model.generate(
+                    ids,
+                    attention_mask=torch.ones_like(ids),
+                    past_key_values=(
+                        copy.deepcopy(prefix_cache)
+                        if prefix_cache is not None
+                        else None
+                    ),
+                    max_new_tokens=max_tokens,
+                    temperature=temperature,
+                    pad_token_id=pad_token_id,
+                    **self._stopping_criteria(stop_predicate, ids.shape[1]),
+                    **kwargs,
+                )
+                responses[idx] = tokenizer.decode(
+                    output[0, ids.shape[1] :], skip_special_tokens=True
+                )
+        return responses
 
 
 @llm_wrapper_register.register("vllm")
@@ -155,8 +448,26 @@ class LocalVllmWrapper(LocalModelWrapper):
         max_backoff=60.0,
         port=6832,
         redis_kwargs: Dict = {},
+        use_async_engine=False,
+        engine: ContinuousBatchingEngine = None,
+        prefix_caching=False,
         **kwargs,
     ):
+        """
+        Parameters:
+            use_async_engine: If true, run the model on vLLM's async engine kept warm across calls.
+                Requests from all callers go through one queue and are batched continuously.
+            engine: Existing `ContinuousBatchingEngine` to use, e.g. one built around
+                `FakeAsyncEngine` for tests. Implies `use_async_engine`.
+            prefix_caching: If true, enable vLLM's automatic prefix caching and submit prompts
+                sharing a prefix next to each other, so each shared prefix is computed once.
+            kwargs: Arguments passed to the vLLM engine
+        """
+        self.use_async_engine = use_async_engine or engine is not None
+        self.engine = engine
+        self.prefix_caching = prefix_caching
+        if prefix_caching:
+            kwargs = {"enable_prefix_caching": True, **kwargs}
         super(__class__, self).__init__(
             model=model,
             path_name=path_name,
@@ -169,6 +480,22 @@ class LocalVllmWrapper(LocalModelWrapper):
             tensor_parallel_size=torch.cuda.device_count(),
             **kwargs,
         )
+        lora_path = self.api_kwargs.pop("lora_path", None)
+        if lora_path is not None:
+            self.lora = LoRARequest("lora", 1, lora_path)
+        else:
+            self.lora = None
+        if self.use_async_engine and self.engine is None:
+            # The engine itself is only built on first use
+            engine_args = vllm.AsyncEngineArgs(
+                **{"enable_lora": self.lora is not None, **self.api_kwargs}
+            )
+            self.engine = ContinuousBatchingEngine(
+                lambda: vllm.AsyncLLMEngine.from_engine_args(engine_args)
+            )
+
+    def _build_api(self):
+        return vllm.LLM(**self.api_kwargs)
 
     def _batched_generate(
         self,
@@ -186,20 +513,169 @@ class LocalVllmWrapper(LocalModelWrapper):
             temperature=temperature,
             **kwargs,
         )
-        if self.api is None:
-            lora_path = self.api_kwargs.pop("lora_path", None)
-            if lora_path is not None:
-                self.lora = LoRARequest("lora", 1, lora_path)
-            else:
-                self.lora = None
-            self.api = vllm.LLM(**self.api_kwargs)
-        tokenizer = self.api.get_tokenizer()
-        formatted_prompts = [
+        if self.use_async_engine:
+            prompts, order = self._format_prompts(
+                self.engine.get_tokenizer(), messages
+            )
+            responses = self.engine.generate(
+                prompts, sampling_params, lora_request=self.lora
+            )
+            return self._restore_order(responses, order)
+        self._load_api()
+        prompts, order = self._format_prompts(self.api.get_tokenizer(), messages)
+
+        output = self.api.generate(
+            prompts,
+            sampling_params,
+            lora_request=self.lora,
+        )
+        return self._restore_order([o.outputs[0].text for o in output], order)
+
+    async def _abatched_generate(
+        self,
+        messages: List[List[Dict[str, str]]],
+        model: str,
+        max_concurrent=3,
+        max_tokens=500,
+        temperature=1e-5,
+        **kwargs,
+    ):
+        if not self.use_async_engine:
+            return await super()._abatched_generate(
+                messages,
+                model=model,
+                max_concurrent=max_concurrent,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                **kwargs,
+            )
+        if len(messages) == 0:
+            return []
+        sampling_params = vllm.SamplingParams(
+            max_tokens=max_tokens,
+            temperature=temperature,
+            **kwargs,
+        )
+        prompts, order = self._format_prompts(
+            await self.engine.aget_tokenizer(), messages
+        )
+        responses = await self.engine.agenerate(
+            prompts, sampling_params, lora_request=self.lora
+        )
+        return self._restore_order(responses, order)
+
+    def _batched_score_choices(
+        self,
+        messages: List[List[Dict[str, str]]],
+        model: str,
+        choices: List[str],
+        max_concurrent=3,
+        **kwargs,
+    ):
+        """
+        Scores the choices from the log-probabilities of a single generated token that is
+        restricted to the choice tokens, so every choice is among the returned log-probabilities.
+        """
+        if len(messages) == 0:
+            return []
+        if self.use_async_engine:
+            tokenizer = self.engine.get_tokenizer()
+        else:
+            self._load_api()
+            tokenizer = self.api.get_tokenizer()
+        choice_ids = self._choice_token_ids(tokenizer, choices)
+        allowed_token_ids = sorted(idx for ids in choice_ids for idx in ids)
+        # temperature 1 reports the log-probabilities of the model itself
+        sampling_params = vllm.SamplingParams(
+            max_tokens=1,
+            temperature=1.0,
+            logprobs=len(allowed_token_ids),
+            allowed_token_ids=allowed_token_ids,
+            **kwargs,
+        )
+        prompts, order = self._format_prompts(tokenizer, messages)
+        if self.use_async_engine:
+            first_token_logprobs = self.engine.generate(
+                prompts,
+                sampling_params,
+                lora_request=self.lora,
+                output_fn=lambda output: output.outputs[0].logprobs[0],
+            )
+        else:
+            first_token_logprobs = [
+                o.outputs[0].logprobs[0]
+                for o in self.api.generate(
+                    prompts, sampling_params, lora_request=self.lora
+                )
+            ]
+        scores = [
+            [
+                logsumexp(
+                    [
+                        logprobs[token_id].logprob
+                        for token_id in token_ids
+                        if token_id in logprobs
+                    ]
+                )
+                for token_ids in choice_ids
+            ]
+            for logprobs in first_token_logprobs
+        ]
+        return self._restore_order(scores, order)
+
+    def _batched_stream_generate(
+        self,
+        messages: List[List[Dict[str, str]]],
+        model: str,
+        stop_predicate: Callable[[str], bool],
+        max_concurrent=3,
+        max_tokens=500,
+        temperature=1e-5,
+        **kwargs,
+    ):
+        """
+        With the async engine, a request is aborted as soon as `stop_predicate` holds for
+        its output. The offline engine generates full responses.
+        """
+        if not self.use_async_engine:
+            return self._batched_generate(
+                messages,
+                model=model,
+                max_concurrent=max_concurrent,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                **kwargs,
+            )
+        if len(messages) == 0:
+            return []
+        sampling_params = vllm.SamplingParams(
+            max_tokens=max_tokens,
+            temperature=temperature,
+            **kwargs,
+        )
+        prompts, order = self._format_prompts(self.engine.get_tokenizer(), messages)
+        responses = self.engine.generate(
+            prompts,
+            sampling_params,
+            lora_request=self.lora,
+            stop_predicate=stop_predicate,
+        )
+        return self._restore_order(responses, order)
+
+    def _format_prompts(self, tokenizer, messages: List[List[Dict[str, str]]]):
+        """Applies the chat template, returns the prompts in submission order and their original indices."""
+        prompts = [
             tokenizer.apply_chat_template(m, tokenize=False, add_generation_prompt=True)
             for m in messages
         ]
+        if not self.prefix_caching:
+            return prompts, list(range(len(prompts)))
+        order = sort_by_prefix(prompts)
+        return [prompts[idx] for idx in order], order
 
-        output = self.api.generate(
-            formatted_prompts, sampling_params, lora_request=self.lora
-        )
-        return [o.outputs[0].text for o in output]
+    @staticmethod
+    def _restore_order(responses: List[str], order: List[int]) -> List[str]:
+        restored = [None for _ in range(len(responses))]
+        for idx, response in zip(order, responses):
+            restored[idx] = response
+        return restored
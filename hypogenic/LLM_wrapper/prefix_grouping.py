@@ -0,0 +1,76 @@
+from typing import List, Sequence, Tuple
+
+
+def common_prefix_length(a: Sequence, b: Sequence) -> int:
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+def sort_by_prefix(prompts: List[Sequence]) -> List[int]:
+    """
+    Returns the indices of `prompts` in an order where prompts sharing a prefix are adjacent.
+
+    Requests submitted in this order let an engine with prefix caching (e.g. vLLM's
+    automatic prefix caching) compute each shared prefix once and reuse it while it is
+    still cached, instead of interleaving prompts that evict each other's blocks.
+    """
+    return sorted(range(len(prompts)), key=lambda idx: prompts[idx])
+
+
+def group_by_prefix(
+    prompts: List[Sequence], min_prefix_len=1, max_group_size=64
+) -> List[Tuple[int, List[int]]]:
+    """
+    Groups prompts (strings or token id lists) that share a prefix.
+
+    Prompts are sorted so that shared prefixes are contiguous, then split into runs that
+    save the most prefix computation in total, i.e. that maximize the sum of
+    `(group size - 1) * prefix length` over all groups. Groups have at most `max_group_size`
+    prompts, which keeps the search linear in the number of prompts when most of them share a
+    prefix (e.g. the system prompt); a longer run is split into several groups, each of which
+    computes the shared prefix once.
+
+    Parameters:
+        prompts: Prompts to group
+        min_prefix_len: Shortest prefix worth sharing. Shorter prefixes are not grouped.
+        max_group_size: Largest number of prompts in one group
+
+    Returns:
+        List of `(prefix_len, indices)`. Every index appears in exactly one group,
+        groups of a single prompt have `prefix_len` 0.
+    """
+    order = sort_by_prefix(prompts)
+    n = len(order)
+    # in sorted order, the common prefix of a run is the minimum over its adjacent pairs
+    adjacent = [
+        common_prefix_length(prompts[order[k - 1]], prompts[order[k]])
+        for k in range(1, n)
+    ]
+
+    # best[j]: largest saving for the first j prompts, start[j]: where its last group starts
+    best = [0 for _ in range(n + 1)]
+    start = [0 for _ in range(n + 1)]
+    for j in range(1, n + 1):
+        best[j], start[j] = best[j - 1], j - 1
+        prefix_len = None
+        for i in range(j - 2, max(j - max_group_size, 0) - 1, -1):
+            pair = adjacent[i]
+            prefix_len = pair if prefix_len is None else min(prefix_len, pair)
+            if prefix_len < min_prefix_len:
+                break
+            saving = best[i] + (j - 1 - i) * prefix_len
+            if saving > best[j]:
+                best[j], start[j] = saving, i
+
+    groups = []
+    j = n
+    while j > 0:
+        i = start[j]
+        prefix_len = min(adjacent[i : j - 1]) if j - i > 1 else 0
+        groups.append((prefix_len, order[i:j]))
+        j = i
+    return groups[::-1]
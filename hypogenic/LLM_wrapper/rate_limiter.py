@@ -1,30 +1,143 @@
+import asyncio
 import threading
 import time
 import logging
+from typing import Dict, List, Optional
 from ..logger_config import LoggerConfig
 
 logger_name = "HypoGenic - RateLimiter"
 
+_shared_rate_limiters: Dict[str, "RateLimiter"] = {}
+_shared_rate_limiters_lock = threading.Lock()
+
+
+def estimate_tokens(messages: List[Dict[str, str]], max_tokens=None) -> int:
+    """
+    Rough token count of a request before it is sent (~4 characters per token).
+
+    Providers count `max_tokens` against the tokens-per-minute budget, so it is included.
+    """
+    num_chars = sum(len(str(msg.get("content", ""))) for msg in messages)
+    return num_chars // 4 + 4 * len(messages) + (max_tokens or 0)
+
+
+def get_shared_rate_limiter(name: str, **kwargs) -> "RateLimiter":
+    """
+    Returns the process-wide rate limiter registered under `name`, creating it with `kwargs` if needed.
+
+    Pass the result as `rate_limiter` to several wrappers to make them share one budget.
+    """
+    with _shared_rate_limiters_lock:
+        if name not in _shared_rate_limiters:
+            _shared_rate_limiters[name] = RateLimiter(**kwargs)
+        return _shared_rate_limiters[name]
+
 
 class RateLimiter:
-    def __init__(self, min_backoff=1.0, max_backoff=60.0):
+    def __init__(self, min_backoff=1.0, max_backoff=60.0, rpm=None, tpm=None):
+        """
+        Parameters:
+            min_backoff: Minimum seconds to back off after a rate limit error
+            max_backoff: Maximum seconds to back off after a rate limit error
+            rpm: Requests-per-minute budget. `None` disables it.
+            tpm: Tokens-per-minute budget. `None` disables it.
+        """
         self.min_backoff = self.backoff_time = min_backoff
         self.max_backoff = max_backoff
+        self.rpm = rpm
+        self.tpm = tpm
         self.lock = threading.Lock()
 
+        # token buckets, allowed to go negative to queue reservations
+        self.request_allowance = float(rpm) if rpm else 0.0
+        self.token_allowance = float(tpm) if tpm else 0.0
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+
     def reset(self):
         with self.lock:
             self.backoff_time = self.min_backoff
 
-    def backoff(self, e: Exception):
+    def _refill(self, now):
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        if self.rpm:
+            self.request_allowance = min(
+                self.rpm, self.request_allowance + elapsed * self.rpm / 60.0
+            )
+        if self.tpm:
+            self.token_allowance = min(
+                self.tpm, self.token_allowance + elapsed * self.tpm / 60.0
+            )
+
+    def _reserve(self, num_tokens=0) -> float:
+        """Takes one request and `num_tokens` from the budgets, returns the seconds to wait before sending."""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(0.0, self.paused_until - now)
+            if self.rpm:
+                self.request_allowance -= 1
+                wait = max(wait, -self.request_allowance * 60.0 / self.rpm)
+            if self.tpm:
+                # a single request larger than the whole budget must still go through
+                self.token_allowance -= min(num_tokens, self.tpm)
+                wait = max(wait, -self.token_allowance * 60.0 / self.tpm)
+        return wait
+
+    def acquire(self, num_tokens=0):
+        """Blocks until a request of `num_tokens` fits into the budgets."""
+        wait = self._reserve(num_tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, num_tokens=0):
+        """Waits, without blocking the event loop, until a request of `num_tokens` fits into the budgets."""
+        wait = self._reserve(num_tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        """Returns over-estimated tokens to the budget once the real usage is known."""
+        if not self.tpm or actual_tokens is None:
+            return
+        with self.lock:
+            self.token_allowance = min(
+                self.tpm, self.token_allowance + estimated_tokens - actual_tokens
+            )
+
+    @staticmethod
+    def _retry_after(e: Exception) -> Optional[float]:
+        response = getattr(e, "response", None)
+        headers = getattr(response, "headers", None)
+        if headers is None:
+            return None
+        try:
+            if headers.get("retry-after-ms") is not None:
+                return float(headers.get("retry-after-ms")) / 1000.0
+            if headers.get("retry-after") is not None:
+                return float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+        return None
+
+    def _start_backoff(self, e: Exception) -> float:
         logger = LoggerConfig.get_logger(logger_name)
-        logger.error(
-            f"Caught exception {e}. Backing off for {self.backoff_time:.1f} seconds"
-        )
-        time.sleep(self.backoff_time)
+        retry_after = self._retry_after(e)
         with self.lock:
+            delay = retry_after if retry_after is not None else self.backoff_time
+            # pause every request sharing this limiter, not only the failed one
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
             self.backoff_time = min(self.backoff_time * 2, self.max_backoff)
+        logger.error(f"Caught exception {e}. Backing off for {delay:.1f} seconds")
         logger.debug(f"Setting backoff time to {self.backoff_time:.1f} seconds")
+        return delay
+
+    def backoff(self, e: Exception):
+        time.sleep(self._start_backoff(e))
+
+    async def abackoff(self, e: Exception):
+        await asyncio.sleep(self._start_backoff(e))
 
     def add_event(self):
         with self.lock:
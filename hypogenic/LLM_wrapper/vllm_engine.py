@@ -0,0 +1,274 @@
+import asyncio
+import itertools
+import math
+from collections import namedtuple
+from typing import Callable, Dict, List
+
+from .base import get_background_loop, run_coroutine
+from ..logger_config import LoggerConfig
+
+logger_name = "HypoGenic - VllmEngine"
+
+
+def _output_text(output):
+    return output.outputs[0].text
+
+
+class ContinuousBatchingEngine:
+    """
+    Keeps one vLLM async engine warm and feeds it from a request queue.
+
+    Callers on any thread (or event loop) submit prompts to the queue. A dispatcher
+    task on the background event loop moves them into the engine, which schedules
+    every request in flight at each decoding step, so small batches from different
+    producers are decoded together instead of one `LLM.generate` call at a time.
+
+    Typical usage example:
+
+      engine = ContinuousBatchingEngine(
+          lambda: vllm.AsyncLLMEngine.from_engine_args(vllm.AsyncEngineArgs(model=path))
+      )
+      responses = engine.generate(prompts, vllm.SamplingParams(max_tokens=500))
+    """
+
+    def __init__(self, engine_factory: Callable, max_in_flight=256):
+        """
+        Parameters:
+            engine_factory: Builds the async engine. Called once, on the background event loop.
+            max_in_flight: Maximum number of requests handed to the engine at the same time
+        """
+        self.engine_factory = engine_factory
+        self.max_in_flight = max_in_flight
+        self.engine = None
+        self.tokenizer = None
+        self.started = None
+        self.request_ids = itertools.count()
+
+    async def _start(self):
+        logger = LoggerConfig.get_logger(logger_name)
+        logger.info("Starting continuous batching engine")
+        self.engine = self.engine_factory()
+        self.tokenizer = await self.engine.get_tokenizer()
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(self.max_in_flight)
+        self.dispatcher = asyncio.ensure_future(self._dispatch())
+
+    async def _ensure_started(self):
+        # Only ever runs on the background loop, so no lock is needed
+        if self.started is None:
+            self.started = asyncio.ensure_future(self._start())
+        await self.started
+
+    async def _dispatch(self):
+        while True:
+            request = await self.queue.get()
+            await self.slots.acquire()
+            asyncio.ensure_future(self._run(*request))
+
+    async def _run(
+        self, prompt, sampling_params, lora_request, output_fn, stop_predicate, future
+    ):
+        request_id = f"hypogenic-{next(self.request_ids)}"
+        try:
+            if future.done():
+                return
+            final_output = None
+            async for output in self.engine.generate(
+                prompt, sampling_params, request_id, lora_request=lora_request
+            ):
+                final_output = output
+                # outputs hold the text generated so far
+                if (
+                    stop_predicate is not None
+                    and not output.finished
+                    and stop_predicate(output.outputs[0].text)
+                ):
+                    await self.engine.abort(request_id)
+                    break
+            if not future.done():
+                future.set_result(output_fn(final_output))
+        except asyncio.CancelledError:
+            await self.engine.abort(request_id)
+            raise
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            self.slots.release()
+
+    async def _generate(
+        self,
+        prompts: List[str],
+        sampling_params,
+        lora_request=None,
+        output_fn=None,
+        stop_predicate=None,
+    ):
+        await self._ensure_started()
+        if output_fn is None:
+            output_fn = _output_text
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in prompts]
+        for prompt, future in zip(prompts, futures):
+            self.queue.put_nowait(
+                (prompt, sampling_params, lora_request, output_fn, stop_predicate, future)
+            )
+        try:
+            return await asyncio.gather(*futures)
+        finally:
+            for future in futures:
+                future.cancel()
+
+    async def _on_background_loop(self, coro):
+        if asyncio.get_running_loop() is get_background_loop():
+            return await coro
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(coro, get_background_loop())
+        )
+
+    def generate(
+        self,
+        prompts: List[str],
+        sampling_params,
+        lora_request=None,
+        output_fn=None,
+        stop_predicate: Callable[[str], bool] = None,
+    ) -> List[str]:
+        """
+        Submits `prompts` and blocks until all of them are generated.
+
+        Parameters:
+            output_fn: Maps the final `RequestOutput` of a prompt to its result. Defaults to the generated text.
+            stop_predicate: If given, a request is aborted as soon as it holds for the text generated so far
+        """
+        if len(prompts) == 0:
+            return []
+        return run_coroutine(
+            self._generate(
+                prompts, sampling_params, lora_request, output_fn, stop_predicate
+            )
+        )
+
+    async def agenerate(
+        self,
+        prompts: List[str],
+        sampling_params,
+        lora_request=None,
+        output_fn=None,
+        stop_predicate: Callable[[str], bool] = None,
+    ) -> List[str]:
+        """Async version of `generate`. Can be awaited from any event loop."""
+        if len(prompts) == 0:
+            return []
+        return await self._on_background_loop(
+            self._generate(
+                prompts, sampling_params, lora_request, output_fn, stop_predicate
+            )
+        )
+
+    def get_tokenizer(self):
+        run_coroutine(self._ensure_started())
+        return self.tokenizer
+
+    async def aget_tokenizer(self):
+        await self._on_background_loop(self._ensure_started())
+        return self.tokenizer
+
+
+_FakeCompletionOutput = namedtuple("_FakeCompletionOutput", ["text"])
+_FakeRequestOutput = namedtuple(
+    "_FakeRequestOutput", ["request_id", "prompt", "outputs", "finished"]
+)
+
+
+class FakeChatTokenizer:
+    """Stands in for a Hugging Face tokenizer with a trivial chat template."""
+
+    def apply_chat_template(
+        self,
+        messages: List[Dict[str, str]],
+        tokenize=False,
+        add_generation_prompt=True,
+        **kwargs,
+    ):
+        prompt = "".join(f"<{m['role']}>{m['content']}\n" for m in messages)
+        if add_generation_prompt:
+            prompt += "<assistant>"
+        return prompt
+
+
+class FakeAsyncEngine:
+    """
+    CPU-only stand-in for `vllm.AsyncLLMEngine`, for tests and dry runs.
+
+    Mimics continuous batching: a step loop advances every running request by one
+    step each `step_time` seconds, and a request finishes after `num_steps` steps.
+    Like vLLM, every step yields the text generated so far, here an equal share of the
+    response per step. The number of requests decoded in each step is recorded in `batch_sizes`.
+    """
+
+    def __init__(
+        self,
+        response_fn: Callable[[str], str] = None,
+        step_time=0.01,
+        num_steps=4,
+        max_num_seqs=256,
+    ):
+        """
+        Parameters:
+            response_fn: Maps a formatted prompt to its response. Defaults to echoing the prompt.
+            step_time: Seconds per decoding step
+            num_steps: Decoding steps per request
+            max_num_seqs: Maximum number of requests decoded in one step
+        """
+        self.response_fn = (
+            response_fn
+            if response_fn is not None
+            else (lambda prompt: prompt)
+        )
+        self.step_time = step_time
+        self.num_steps = num_steps
+        self.max_num_seqs = max_num_seqs
+        self.running = {}
+        self.batch_sizes = []
+        self.step_task = None
+
+    async def get_tokenizer(self, lora_request=None):
+        return FakeChatTokenizer()
+
+    async def _step_loop(self):
+        while len(self.running) > 0:
+            await asyncio.sleep(self.step_time)
+            batch = list(self.running.values())[: self.max_num_seqs]
+            self.batch_sizes.append(len(batch))
+            for request in batch:
+                request["remaining_steps"] -= 1
+                request["steps"].put_nowait(request["remaining_steps"])
+                if request["remaining_steps"] == 0:
+                    self.running.pop(request["request_id"])
+
+    async def generate(self, prompt, sampling_params, request_id, lora_request=None):
+        steps = asyncio.Queue()
+        self.running[request_id] = {
+            "request_id": request_id,
+            "remaining_steps": self.num_steps,
+            "steps": steps,
+        }
+        if self.step_task is None or self.step_task.done():
+            self.step_task = asyncio.ensure_future(self._step_loop())
+        response = self.response_fn(prompt)
+        remaining_steps = self.num_steps
+        while remaining_steps > 0:
+            remaining_steps = await steps.get()
+            num_chars = math.ceil(
+                len(response) * (self.num_steps - remaining_steps) / self.num_steps
+            )
+            yield _FakeRequestOutput(
+                request_id=request_id,
+                prompt=prompt,
+                outputs=[_FakeCompletionOutput(text=response[:num_chars])],
+                finished=remaining_steps == 0,
+            )
+
+    async def abort(self, request_id):
+        self.running.pop(request_id, None)
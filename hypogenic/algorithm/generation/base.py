@@ -1,7 +1,7 @@
 from abc import ABC, abstractmethod
 import math
 import os
-from typing import List
+from typing import Dict, List
 
 from .utils import extract_hypotheses
 from ..summary_information import SummaryInformation
@@ -81,6 +81,52 @@ class Generation(ABC):
             hypotheses_list: A list containing all newly generated hypotheses.
         """
 
+        prompt_input = self._generation_prompt(example_indices, num_hypotheses_generate)
+
+        # Batch generate responses based on the prompts that we just generated
+        response = self.api.generate(
+            prompt_input, cache_seed=cache_seed, **generate_kwargs
+        )
+
+        return extract_hypotheses(response, num_hypotheses_generate)
+
+    def batched_hyp_lists_generation(
+        self,
+        example_indices: List[int],
+        num_hypotheses_generate: int,
+        num_rounds: int,
+        cache_seed=None,
+        max_concurrent=3,
+        **generate_kwargs
+    ) -> List[List[str]]:
+        """Runs `num_rounds` rounds of `batched_hyp_list_generation` on the same examples as one batch of requests.
+
+        Parameters:
+            example_indices: the indices of examples being used to generate hypotheses
+            num_hypotheses_generate: the number of hypotheses that we expect each response to generate
+            num_rounds: the number of generation rounds
+            cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
+            max_concurrent: the maximum number of concurrent requests to make to the API
+
+        Returns:
+            hypotheses_lists: A list of newly generated hypotheses for every round.
+        """
+        prompt_input = self._generation_prompt(example_indices, num_hypotheses_generate)
+
+        # With a cache, the identical prompts are requested once, as in sequential rounds
+        responses = self.api.batched_generate(
+            [prompt_input for _ in range(num_rounds)],
+            cache_seed=cache_seed,
+            max_concurrent=max_concurrent,
+            **generate_kwargs
+        )
+
+        return [
+            extract_hypotheses(response, num_hypotheses_generate)
+            for response in responses
+        ]
+
+    def _generation_prompt(self, example_indices, num_hypotheses_generate):
         # ----------------------------------------------------------------------
         # Gather the examples to use for generation
         # ----------------------------------------------------------------------
@@ -94,16 +140,42 @@ class Generation(ABC):
         # Prompt LLM to generate hypotheses
         # ----------------------------------------------------------------------
         # Batch generate a bunch of prompts based on yaml file
-        prompt_input = self.prompt_class.batched_generation(
+        return self.prompt_class.batched_generation(
             example_bank, num_hypotheses_generate
         )
 
-        # Batch generate responses based on the prompts that we just generated
-        response = self.api.generate(
-            prompt_input, cache_seed=cache_seed, **generate_kwargs
-        )
+    def batched_hypothesis_generation_rounds(
+        self,
+        example_ids,
+        current_sample,
+        num_hypotheses_generate: int,
+        alpha: float,
+        num_rounds: int,
+        cache_seed=None,
+        max_concurrent=3,
+        **generate_kwargs
+    ) -> List[Dict[str, SummaryInformation]]:
+        """
+        Runs `batched_hypothesis_generation` `num_rounds` times on the same examples.
 
-        return extract_hypotheses(response, num_hypotheses_generate)
+        The rounds run one after another here. Subclasses can override this to batch
+        the requests of all rounds together.
+
+        Returns:
+            hypotheses_banks: The hypotheses bank generated in every round
+        """
+        return [
+            self.batched_hypothesis_generation(
+                example_ids,
+                current_sample,
+                num_hypotheses_generate,
+                alpha,
+                cache_seed=cache_seed,
+                max_concurrent=max_concurrent,
+                **generate_kwargs
+            )
+            for _ in range(num_rounds)
+        ]
 
     # ------------------------------------------------------------------------ #
     #                                                                          #
@@ -188,3 +260,44 @@ class Generation(ABC):
             new_generated_hypotheses[hyp].set_example(ex)
 
         return new_generated_hypotheses
+
+    def make_hypotheses_banks(
+        self,
+        example_indices,
+        current_sample,
+        alpha,
+        hypotheses_lists: List[List[str]],
+        cache_seed=None,
+        max_concurrent=3,
+        **generate_kwargs
+    ) -> List[Dict[str, SummaryInformation]]:
+        """
+        `make_hypotheses_bank` for several lists of hypotheses evaluated on the same examples.
+
+        Every distinct hypothesis is evaluated once, and all of them in a single batch.
+
+        Returns:
+            new_generated_hypotheses: One hypotheses bank per list in `hypotheses_lists`
+        """
+        merged_bank = self.make_hypotheses_bank(
+            example_indices,
+            current_sample,
+            alpha,
+            list(dict.fromkeys(hyp for hyps in hypotheses_lists for hyp in hyps)),
+            cache_seed=cache_seed,
+            max_concurrent=max_concurrent,
+            **generate_kwargs
+        )
+        return [
+            {
+                hyp: SummaryInformation(
+                    hypothesis=hyp,
+                    acc=merged_bank[hyp].acc,
+                    reward=merged_bank[hyp].reward,
+                    num_visits=merged_bank[hyp].num_visits,
+                    correct_examples=list(merged_bank[hyp].correct_examples),
+                )
+                for hyp in hyps
+            }
+            for hyps in hypotheses_lists
+        ]
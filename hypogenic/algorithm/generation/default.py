@@ -1,7 +1,7 @@
 from abc import ABC, abstractmethod
 import math
 import os
-from typing import List
+from typing import Dict, List
 
 from . import generation_register
 from .utils import extract_hypotheses
@@ -155,3 +155,49 @@ class DefaultGeneration(Generation):
             max_concurrent=max_concurrent,
             **generate_kwargs,
         )
+
+    def batched_hypothesis_generation_rounds(
+        self,
+        example_ids,
+        current_sample,
+        num_hypotheses_generate: int,
+        alpha: float,
+        num_rounds: int,
+        cache_seed=None,
+        max_concurrent=3,
+        **generate_kwargs,
+    ) -> List[Dict[str, SummaryInformation]]:
+        """
+        Generates new hypotheses for the given examples in `num_rounds` rounds, with one batch
+        of generation requests for all rounds followed by one batch of predictions
+
+        Parameters:
+            example_ids: The ids of the examples for which hypotheses need to be generated
+            current_sample: the current sample in data which the algorithm is on
+            num_hypotheses_generate: the number of hypotheses that we expect each response to generate
+            alpha: eploration constant in hypogenic reward funciton
+            num_rounds: the number of generation rounds
+            cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
+            max_concurrent: The maximum number of concurrent requests
+
+        Returns:
+            hypotheses_banks: A dictionary with keys as hypotheses and the values as the Summary Information class for every round
+        """
+        hypotheses_lists = self.batched_hyp_lists_generation(
+            example_ids,
+            num_hypotheses_generate,
+            num_rounds,
+            cache_seed=cache_seed,
+            max_concurrent=max_concurrent,
+            **generate_kwargs,
+        )
+
+        return self.make_hypotheses_banks(
+            example_ids,
+            current_sample,
+            alpha,
+            hypotheses_lists,
+            cache_seed=cache_seed,
+            max_concurrent=max_concurrent,
+            **generate_kwargs,
+        )
@@ -1,7 +1,7 @@
 from abc import ABC, abstractmethod
 import os
 from collections import OrderedDict
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, Iterable, List, Tuple
 import numpy as np
 import pandas as pd
 import pulp
@@ -11,11 +11,19 @@ import re
 from ..summary_information import SummaryInformation
 from ...prompt import BasePrompt
 from ...tasks import BaseTask
+from ...logger_config import LoggerConfig
+from .streaming import PredictionSink
+
+logger_name = "HypoGenic - Inference"
 
 
 class Inference(ABC):
     """Inference abstract class. For each style of inference implement the inference function."""
 
+    # Whether `batched_predict` reads the SummaryInformation of the hypotheses (e.g. their
+    # correct examples), which changes during the update, besides the hypothesis itself
+    uses_hypothesis_info = True
+
     def __init__(
         self,
         api,
@@ -36,6 +44,9 @@ class Inference(ABC):
         self.prompt_class = prompt_class
         self.train_data = train_data
         self.task = task
+        # confidence of every prediction of the last `batched_predict` call, for the
+        # inference styles that report one
+        self.confidences = None
 
     @abstractmethod
     def batched_predict(
@@ -43,6 +54,7 @@ class Inference(ABC):
         data,
         idx_hyp_pair=List[Tuple[int, Dict[str, SummaryInformation]]],
         cache_seed=None,
+        stop_predicate: Callable[[str], bool] = None,
         **generate_kwargs,
     ):
         """
@@ -51,6 +63,9 @@ class Inference(ABC):
         Parameters:
             data: the data to predict on
             idx_hyp_pair: a list of tuples of indices and hypothesis banks
+            stop_predicate: If given, the responses the labels are extracted from are streamed and
+                cut off as soon as it holds, e.g. `label_stop_predicate(task.extract_label)`. Other
+                requests, e.g. for selecting hypotheses, always run to completion.
         """
         pass
 
@@ -61,6 +76,7 @@ class Inference(ABC):
         hyp_bank,
         cache_seed=None,
         max_concurrent=3,
+        stop_predicate: Callable[[str], bool] = None,
         generate_kwargs={},
         **kwargs,
     ):
@@ -71,8 +87,57 @@ class Inference(ABC):
             hyp_bank: a dictionary of hypotheses
             cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
             max_concurrent: the maximum number of concurrent requests
+            stop_predicate: If given, the label predictions are streamed and cut off as soon as it holds,
+                see `batched_predict`
 
         Returns:
             accuracy: the accuracy over the dataset
         """
         pass
+
+    def run_inference_streaming(
+        self,
+        data_chunks: Iterable[Tuple[int, pd.DataFrame]],
+        hyp_bank,
+        sink: PredictionSink,
+        cache_seed=None,
+        max_concurrent=3,
+        stop_predicate: Callable[[str], bool] = None,
+        generate_kwargs={},
+        **kwargs,
+    ):
+        """
+        Runs `run_inference_final` on one chunk of data at a time, so only one chunk of
+        prompts and responses is held in memory, and appends each chunk's predictions to
+        `sink` as soon as it completes.
+
+        Parameters:
+            data_chunks: `(chunk_idx, data)` pairs with `data` indexed from 0, e.g. from `BaseTask.get_data_chunks`
+            hyp_bank: a dictionary of hypotheses
+            sink: where predictions are written. Chunks it has already completed are skipped.
+            cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
+            max_concurrent: the maximum number of concurrent requests
+            stop_predicate: If given, the label predictions are streamed and cut off as soon as it holds
+
+        Returns:
+            The running metrics over all completed chunks
+        """
+        logger = LoggerConfig.get_logger(logger_name)
+        for chunk_idx, data in data_chunks:
+            if chunk_idx < sink.next_chunk:
+                continue
+            pred_list, label_list = self.run_inference_final(
+                data,
+                hyp_bank,
+                cache_seed=cache_seed,
+                max_concurrent=max_concurrent,
+                stop_predicate=stop_predicate,
+                generate_kwargs=generate_kwargs,
+                **kwargs,
+            )
+            sink.write_chunk(chunk_idx, pred_list, label_list, self.confidences)
+            logger.info(
+                f"Chunk {chunk_idx}: {sink.metrics.num_examples} examples, "
+                f"running accuracy {sink.metrics.accuracy}, running F1 {sink.metrics.f1}"
+            )
+        return sink.metrics
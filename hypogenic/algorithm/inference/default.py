@@ -1,7 +1,7 @@
 from abc import ABC, abstractmethod
 import os
 from collections import OrderedDict
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, List, Tuple
 import numpy as np
 import pandas as pd
 import pulp
@@ -17,6 +17,8 @@ from ...tasks import BaseTask
 
 @inference_register.register("default")
 class DefaultInference(Inference):
+    uses_hypothesis_info = False
+
     def __init__(
         self,
         api,
@@ -32,6 +34,7 @@ class DefaultInference(Inference):
         idx_hyp_pair=List[Tuple[int, Dict[str, SummaryInformation]]],
         cache_seed=None,
         max_concurrent=3,
+        stop_predicate: Callable[[str], bool] = None,
         **generate_kwargs,
     ):
         """
@@ -42,6 +45,8 @@ class DefaultInference(Inference):
             idx_hyp_pair: a list of tuples of indices and hypothesis banks
             cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
             max_concurrent: the maximum number of concurrent requests
+            stop_predicate: If given, the responses the labels are extracted from are streamed and
+                cut off as soon as it holds
         """
         assert all(
             [len(hyp_bank.keys()) == 1 for _, hyp_bank in idx_hyp_pair]
@@ -56,6 +61,7 @@ class DefaultInference(Inference):
             prompt_inputs,
             cache_seed=cache_seed,
             max_concurrent=max_concurrent,
+            stop_predicate=stop_predicate,
             **generate_kwargs,
         )
         predictions = [self.task.extract_label(response) for response in responses]
@@ -72,6 +78,7 @@ class DefaultInference(Inference):
         hyp_bank,
         cache_seed=None,
         max_concurrent=3,
+        stop_predicate: Callable[[str], bool] = None,
         generate_kwargs={},
         **kwargs,
     ):
@@ -83,6 +90,7 @@ class DefaultInference(Inference):
             hyp_bank: the hypotheses that we want to predict from
             cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
             max_concurrent: the maximum number of concurrent requests
+            stop_predicate: If given, the label predictions are streamed and cut off as soon as it holds
         """
 
         # getting the top hypothesis
@@ -100,5 +108,6 @@ class DefaultInference(Inference):
             ],
             cache_seed=cache_seed,
             max_concurrent=max_concurrent,
+            stop_predicate=stop_predicate,
             **generate_kwargs,
         )
@@ -1,7 +1,7 @@
 from abc import ABC, abstractmethod
 import os
 from collections import OrderedDict
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, List, Tuple
 import numpy as np
 import pandas as pd
 import pulp
@@ -35,6 +35,7 @@ class FilterAndWeightInference(Inference):
         idx_hyp_pair=List[Tuple[int, Dict[str, SummaryInformation]]],
         cache_seed=None,
         max_concurrent=3,
+        stop_predicate: Callable[[str], bool] = None,
         **generate_kwargs,
     ):
         """
@@ -49,6 +50,8 @@ class FilterAndWeightInference(Inference):
             idx_hyp_pair: a list of tuples of indices and hypothesis banks
             cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
             max_concurrent: the maximum number of concurrent requests
+            stop_predicate: If given, the responses the labels are extracted from are streamed and
+                cut off as soon as it holds
         """
         logger = LoggerConfig.get_logger(logger_name)
         assert all(
@@ -65,6 +68,7 @@ class FilterAndWeightInference(Inference):
             prompt_inputs,
             cache_seed=cache_seed,
             max_concurrent=max_concurrent,
+            stop_predicate=stop_predicate,
             **generate_kwargs,
         )
         logger.info(f"Responses: {responses}")
@@ -139,6 +143,7 @@ class FilterAndWeightInference(Inference):
         k=1,
         cache_seed=None,
         max_concurrent=3,
+        stop_predicate: Callable[[str], bool] = None,
         generate_kwargs={},
         **kwargs,
     ):
@@ -153,6 +158,7 @@ class FilterAndWeightInference(Inference):
             k: the number of hypotheses to keep
             cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
             max_concurrent: the maximum number of concurrent requests
+            stop_predicate: If given, the label predictions are streamed and cut off as soon as it holds
         """
         # get the top k hypotheses by reward (save as dictionary)
         if k > len(hyp_bank):
@@ -200,6 +206,7 @@ class FilterAndWeightInference(Inference):
             ],
             cache_seed=cache_seed,
             max_concurrent=max_concurrent,
+            stop_predicate=stop_predicate,
             **generate_kwargs,
         )
 
@@ -209,6 +216,7 @@ class FilterAndWeightInference(Inference):
         hyp_bank,
         cache_seed=None,
         max_concurrent=3,
+        stop_predicate: Callable[[str], bool] = None,
         generate_kwargs={},
         **kwargs,
     ):
@@ -223,12 +231,14 @@ class FilterAndWeightInference(Inference):
             k: the number of hypotheses to keep
             cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
             max_concurrent: the maximum number of concurrent requests
+            stop_predicate: If given, the label predictions are streamed and cut off as soon as it holds
         """
         return self._run_inference_final(
             data,
             hyp_bank,
             cache_seed=cache_seed,
             max_concurrent=max_concurrent,
+            stop_predicate=stop_predicate,
             generate_kwargs=generate_kwargs,
             **kwargs,
         )
@@ -1,17 +1,17 @@
 from abc import ABC, abstractmethod
 import os
-from collections import OrderedDict
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, List, Tuple
 import numpy as np
 import pandas as pd
 import pulp
 import random
 import re
+import time
 
 from . import inference_register
 from .base import Inference
 from .default import DefaultInference
-from ..summary_information import SummaryInformation
+from ..summary_information import SummaryInformation, correct_example_matrix
 from ...prompt import BasePrompt
 from ...tasks import BaseTask
 from ...logger_config import LoggerConfig
@@ -36,6 +36,7 @@ class OneStepAdaptiveInference(Inference):
         idx_hyp_pair=List[Tuple[int, Dict[str, SummaryInformation]]],
         cache_seed=None,
         max_concurrent=3,
+        stop_predicate: Callable[[str], bool] = None,
         **generate_kwargs,
     ):
         """
@@ -46,6 +47,8 @@ class OneStepAdaptiveInference(Inference):
             idx_hyp_pair: a list of tuples of indices and hypothesis banks
             cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
             max_concurrent: the maximum number of concurrent requests
+            stop_predicate: If given, the responses the labels are extracted from are streamed and
+                cut off as soon as it holds
         """
         prompt_inputs = [
             self.prompt_class.one_step_adaptive_inference(
@@ -57,6 +60,7 @@ class OneStepAdaptiveInference(Inference):
             prompt_inputs,
             cache_seed=cache_seed,
             max_concurrent=max_concurrent,
+            stop_predicate=stop_predicate,
             **generate_kwargs,
         )
         predictions = [self.task.extract_label(response) for response in responses]
@@ -70,8 +74,11 @@ class OneStepAdaptiveInference(Inference):
         adaptive_threshold=0.7,
         adaptive_num_hypotheses=3,
         adaptive_num_examples=5,
+        adaptive_selection_method="auto",
+        adaptive_selection_time_budget=None,
         cache_seed=None,
         max_concurrent=3,
+        stop_predicate: Callable[[str], bool] = None,
         generate_kwargs={},
         **kwargs,
     ):
@@ -84,42 +91,39 @@ class OneStepAdaptiveInference(Inference):
             adaptive_threshold: the threshold for similarity between hypotheses
             adaptive_num_hypotheses: the number of hypotheses to select
             adaptive_num_examples: the number of examples to select
+            adaptive_selection_method: how to select dissimilar hypotheses, see `select_hypotheses`
+            adaptive_selection_time_budget: seconds the selection may take, `None` for no limit
             cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
             max_concurrent: the maximum number of concurrent requests
+            stop_predicate: If given, the label predictions are streamed and cut off as soon as it holds
         """
         logger = LoggerConfig.get_logger(logger_name)
 
         num_train_data_samples = len(self.train_data)
-        similarity_matrix, one_hot_encoded_dict = self.compute_similarity_matrix(
+        similarity_matrix, example_matrix = self.compute_similarity_matrix(
             hyp_bank, num_train_data_samples
         )
-        assert list(one_hot_encoded_dict.keys()) == list(
-            hyp_bank.keys()
-        ), "The keys of the one hot encoded dict and the hyp_bank should be the same"
-        similarity_per_hypothesis = [
-            np.sum(similarity_matrix[i])
-            for i, _ in enumerate(one_hot_encoded_dict.keys())
-        ]
-        accuracy_per_hypothesis = [hyp_bank[hyp].acc for hyp in one_hot_encoded_dict]
+        key_list = list(hyp_bank.keys())
+        similarity_per_hypothesis = similarity_matrix.sum(axis=1)
+        accuracy_per_hypothesis = [hyp_bank[hyp].acc for hyp in key_list]
         logger.info("Initial examples per hyp:")
         for hyp in hyp_bank:
             logger.info(f"Hypothesis {hyp}, Examples: {hyp_bank[hyp].correct_examples}")
 
-        logger.info("One hot encoded dict:")
-        for hyp in one_hot_encoded_dict:
-            logger.info(
-                f"Hypothesis {hyp}, Encoded Examples: {one_hot_encoded_dict[hyp]}"
-            )
+        logger.info("Number of distinct correct examples per hyp:")
+        for hyp, num_examples in zip(key_list, example_matrix.getnnz(axis=1)):
+            logger.info(f"Hypothesis {hyp}, Encoded Examples: {num_examples}")
         logger.info(f"Similarity matrix:\n{similarity_matrix}\n")
 
         # choose hypotheses with the least similarities
-        selected_indices = self.select_hypotheses_ilp(
+        selected_indices = self.select_hypotheses(
             similarity_matrix,
             accuracy_per_hypothesis,
             similarity_per_hypothesis,
             adaptive_threshold,
+            method=adaptive_selection_method,
+            time_budget=adaptive_selection_time_budget,
         )
-        key_list = list(one_hot_encoded_dict.keys())
         selected_hypotheses = [key_list[idx] for idx in selected_indices]
         logger.info(
             f"Selected hypotheses based upon non-similarity: {selected_hypotheses}",
@@ -147,6 +151,7 @@ class OneStepAdaptiveInference(Inference):
             [(i, selected_hyp_bank) for i in range(num_samples)],
             cache_seed=cache_seed,
             max_concurrent=max_concurrent,
+            stop_predicate=stop_predicate,
             **generate_kwargs,
         )
 
@@ -156,6 +161,7 @@ class OneStepAdaptiveInference(Inference):
         hyp_bank,
         cache_seed=None,
         max_concurrent=3,
+        stop_predicate: Callable[[str], bool] = None,
         generate_kwargs={},
         **kwargs,
     ):
@@ -170,42 +176,171 @@ class OneStepAdaptiveInference(Inference):
             adaptive_num_examples: the number of examples to select
             cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
             max_concurrent: the maximum number of concurrent requests
+            stop_predicate: If given, the label predictions are streamed and cut off as soon as it holds
         """
         return self._run_inference_final(
             data,
             hyp_bank,
             cache_seed=cache_seed,
             max_concurrent=max_concurrent,
+            stop_predicate=stop_predicate,
             generate_kwargs=generate_kwargs,
             **kwargs,
         )
 
     def compute_similarity_matrix(self, hyp_bank, num_train_data_samples):
-        one_hot_encoded_dict = OrderedDict()
-
-        for hypothesis in hyp_bank:
-            indices = [ex[0] for ex in hyp_bank[hypothesis].correct_examples]
-            result = [0] * num_train_data_samples  # Initialize array with zeros
-            for idx in indices:
-                result[idx] = 1  # Set elements at specified indices to 1
-            one_hot_encoded_dict[hypothesis] = result
-
-        similarity_matrix = np.zeros((len(hyp_bank), len(hyp_bank)))
-        for i, hypothesis_one in enumerate(one_hot_encoded_dict.keys()):
-            for j, hypothesis_two in enumerate(one_hot_encoded_dict.keys()):
-                if hypothesis_one != hypothesis_two:
-                    similarity_matrix[i][j] = np.dot(
-                        one_hot_encoded_dict[hypothesis_one],
-                        one_hot_encoded_dict[hypothesis_two],
-                    ) / (
-                        np.linalg.norm(one_hot_encoded_dict[hypothesis_one])
-                        * np.linalg.norm(one_hot_encoded_dict[hypothesis_two])
-                    )
+        """
+        Cosine similarity between the sets of correct examples of every pair of hypotheses.
+
+        Parameters:
+            hyp_bank: the hypotheses to compare
+            num_train_data_samples: the number of training examples
+
+        Returns:
+            similarity_matrix: dense matrix with one row and column per hypothesis, in the order of
+                `hyp_bank`, and zeros on the diagonal
+            example_matrix: sparse matrix of the correct examples of each hypothesis
+        """
+        example_matrix = correct_example_matrix(hyp_bank, num_train_data_samples)
+
+        # number of shared correct examples for every pair, in one sparse product
+        overlaps = (example_matrix @ example_matrix.T).toarray()
+        norms = np.sqrt(np.diag(overlaps))
+        # hypotheses without correct examples get NaN similarities, as before
+        with np.errstate(divide="ignore", invalid="ignore"):
+            similarity_matrix = overlaps / np.outer(norms, norms)
+        np.fill_diagonal(similarity_matrix, 0.0)
+
+        return similarity_matrix, example_matrix
+
+    # Largest bank solved exactly when the selection method is "auto"
+    max_ilp_hypotheses = 200
 
-        return similarity_matrix, one_hot_encoded_dict
+    def select_hypotheses(
+        self,
+        similarity_matrix,
+        accuracies,
+        similarities,
+        threshold,
+        method="auto",
+        time_budget=None,
+    ):
+        """
+        Select the most accurate set of hypotheses in which no pair is similar, i.e. a maximum
+        weight independent set of the graph linking pairs with similarity above the threshold.
+
+        Parameters:
+            similarity_matrix: the similarity matrix between hypotheses
+            accuracies: the training accuracies of the hypotheses
+            similarities: the similarities of the hypotheses
+            threshold: the threshold for similarity between hypotheses
+            method: "ilp" for the exact solution, "greedy" for the heuristic, or "auto" to solve
+                banks of up to `max_ilp_hypotheses` hypotheses exactly and larger ones greedily
+            time_budget: seconds the selection may take, `None` for no limit
+        """
+        logger = LoggerConfig.get_logger(logger_name)
+        if method == "auto":
+            method = (
+                "ilp"
+                if similarity_matrix.shape[0] <= self.max_ilp_hypotheses
+                else "greedy"
+            )
+        if method == "ilp":
+            start_time = time.monotonic()
+            selected_indices = self.select_hypotheses_ilp(
+                similarity_matrix,
+                accuracies,
+                similarities,
+                threshold,
+                time_budget=time_budget,
+            )
+            if selected_indices is not None:
+                return selected_indices
+            logger.warning("ILP found no solution in time, selecting greedily")
+            # the greedy selection only improves its result for what is left of the budget
+            return self.select_hypotheses_greedy(
+                similarity_matrix,
+                accuracies,
+                similarities,
+                threshold,
+                time_budget=(
+                    None
+                    if time_budget is None
+                    else max(0.0, time_budget - (time.monotonic() - start_time))
+                ),
+            )
+        if method == "greedy":
+            return self.select_hypotheses_greedy(
+                similarity_matrix,
+                accuracies,
+                similarities,
+                threshold,
+                time_budget=time_budget,
+            )
+        raise ValueError(f"Unknown hypothesis selection method {method}")
+
+    def select_hypotheses_greedy(
+        self, similarity_matrix, accuracies, similarities, threshold, time_budget=None
+    ):
+        """
+        Select hypotheses with a greedy maximum weight independent set heuristic.
+
+        Repeatedly picks the hypothesis with the best accuracy / (number of similar remaining
+        hypotheses + 1) and drops the hypotheses similar to it. The result is then improved by
+        swapping in any hypothesis more accurate than its selected similar hypotheses combined,
+        until no swap helps or the time budget runs out.
+
+        Parameters:
+            similarity_matrix: the similarity matrix between hypotheses
+            accuracies: the training accuracies of the hypotheses
+            similarities: the similarities of the hypotheses
+            threshold: the threshold for similarity between hypotheses
+            time_budget: seconds the improvement phase may take, `None` for no limit
+        """
+        deadline = None if time_budget is None else time.monotonic() + time_budget
+        accuracies = np.asarray(accuracies, dtype=np.float64)
+        # NaN similarities compare as False, like in the ILP constraints
+        conflicts = similarity_matrix >= threshold
+        np.fill_diagonal(conflicts, False)
+        conflicts = conflicts | conflicts.T
+        conflict_weights = conflicts.astype(np.float32)
+
+        def fill(selected):
+            # add hypotheses not similar to any selected one, best ratio first
+            available = ~selected & ~conflicts[:, selected].any(axis=1)
+            # number of similar hypotheses that are still available
+            degrees = conflicts[:, available].sum(axis=1)
+            while available.any():
+                ratios = np.where(available, accuracies / (degrees + 1), -np.inf)
+                best = int(np.argmax(ratios))
+                selected[best] = True
+                removed = available & (conflicts[best] | (np.arange(len(available)) == best))
+                available &= ~removed
+                degrees -= conflicts[:, removed].sum(axis=1)
+            return selected
+
+        selected = fill(np.zeros(len(accuracies), dtype=bool))
+
+        improved = True
+        while improved and (deadline is None or time.monotonic() < deadline):
+            improved = False
+            # accuracy of the selected hypotheses each one would replace, in float32 to
+            # rank the candidates quickly, then checked exactly for the best one
+            replaced = conflict_weights @ np.where(selected, accuracies, 0.0).astype(
+                np.float32
+            )
+            best = int(np.argmax(np.where(selected, -np.inf, accuracies - replaced)))
+            gain = accuracies[best] - accuracies[selected & conflicts[best]].sum()
+            if not selected[best] and gain > 1e-12:
+                selected &= ~conflicts[best]
+                selected[best] = True
+                selected = fill(selected)
+                improved = True
+
+        return [int(i) for i in np.flatnonzero(selected)]
 
     def select_hypotheses_ilp(
-        self, similarity_matrix, accuracies, similarities, threshold
+        self, similarity_matrix, accuracies, similarities, threshold, time_budget=None
     ):
         """
         Select hypotheses using integer linear programming.
@@ -215,6 +350,11 @@ class OneStepAdaptiveInference(Inference):
             accuracies: the training accuracies of the hypotheses
             similarities: the similarities of the hypotheses
             threshold: the threshold for similarity between hypotheses
+            time_budget: seconds the solver may take, `None` for no limit
+
+        Returns:
+            selected_indices: the indices of the selected hypotheses, or `None` if the solver
+                found no solution within the time budget
         """
         num_hypotheses = similarity_matrix.shape[0]
         problem = pulp.LpProblem("Hypothesis_Selection", pulp.LpMaximize)
@@ -231,13 +371,18 @@ class OneStepAdaptiveInference(Inference):
 
         # Constraints: For each pair of hypotheses, if the similarity is above the threshold,
         # at least one hypothesis must not be selected.
-        for i in range(num_hypotheses):
-            for j in range(i + 1, num_hypotheses):
-                if similarity_matrix[i, j] >= threshold:
-                    problem += selection_vars[i] + selection_vars[j] <= 1
+        for i, j in np.argwhere(np.triu(similarity_matrix >= threshold, k=1)):
+            problem += selection_vars[i] + selection_vars[j] <= 1
 
         # Solve the problem
-        problem.solve()
+        if time_budget is None:
+            problem.solve()
+        else:
+            problem.solve(pulp.PULP_CBC_CMD(msg=False, timeLimit=time_budget))
+            if pulp.LpStatus[problem.status] != "Optimal" and any(
+                var.value() is None for var in selection_vars
+            ):
+                return None
 
         # Get the indices of the selected hypotheses
         selected_indices = [
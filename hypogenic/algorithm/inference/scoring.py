@@ -0,0 +1,236 @@
+import math
+from typing import Callable, Dict, List, Tuple
+import pandas as pd
+
+from . import inference_register
+from .default import DefaultInference
+from ..summary_information import SummaryInformation
+from ...prompt import BasePrompt
+from ...tasks import BaseTask
+from ...logger_config import LoggerConfig
+from ...LLM_wrapper.base import logsumexp
+
+logger_name = "HypoGenic - Scoring Inference"
+
+
+@inference_register.register("scoring")
+class ScoringInference(DefaultInference):
+    """
+    Default inference with the best hypothesis, where the model scores the labels instead of
+    reasoning its way to a "Final answer". The labels are listed as lettered options, and the
+    log-probabilities of the option letters as the first output token give the prediction and
+    its confidence, so every prediction costs a single output token.
+    """
+
+    def __init__(
+        self,
+        api,
+        prompt_class: BasePrompt,
+        train_data: pd.DataFrame,
+        task: BaseTask,
+        labels: List[str] = None,
+        calibration_temperature=1.0,
+    ):
+        """
+        Parameters:
+            labels: the label set to choose from. Defaults to the labels of the training data.
+            calibration_temperature: temperature of the softmax over the label log-probabilities that gives
+                the confidences. Values above 1 soften over-confident scores, it does not change the predictions.
+                See `fit_calibration_temperature`.
+        """
+        super().__init__(api, prompt_class, train_data, task)
+        self.calibration_temperature = calibration_temperature
+        self.labels = (
+            labels if labels is not None else sorted(set(train_data["label"]))
+        )
+        if len(self.labels) > 26:
+            raise ValueError(
+                f"Scoring inference supports at most 26 labels, got {len(self.labels)}"
+            )
+        self.choices = [chr(ord("A") + idx) for idx in range(len(self.labels))]
+        self.label_options = "\n".join(
+            f"{choice}. {label}" for choice, label in zip(self.choices, self.labels)
+        )
+
+    def batched_score(
+        self,
+        data: pd.DataFrame,
+        idx_hyp_pair=List[Tuple[int, Dict[str, SummaryInformation]]],
+        cache_seed=None,
+        max_concurrent=3,
+        **generate_kwargs,
+    ):
+        """
+        Scores the labels for a batch of examples.
+
+        Parameters:
+            data: the data to predict on
+            idx_hyp_pair: a list of tuples of indices and hypothesis banks
+            cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
+            max_concurrent: the maximum number of concurrent requests
+
+        Returns:
+            scores: the log-probability of every label in `self.labels`, per example
+            actual_labels: the true labels
+        """
+        assert all(
+            [len(hyp_bank.keys()) == 1 for _, hyp_bank in idx_hyp_pair]
+        ), "scoring inference only supports one hypothesis at a time"
+
+        # only one token is generated, and the scores do not depend on the sampling temperature
+        generate_kwargs.pop("max_tokens", None)
+        generate_kwargs.pop("temperature", None)
+
+        prompt_inputs = [
+            self.prompt_class.scoring_inference(
+                hyp_bank, data, index, self.label_options
+            )
+            for index, hyp_bank in idx_hyp_pair
+        ]
+        scores = self.api.batched_score_choices(
+            prompt_inputs,
+            self.choices,
+            cache_seed=cache_seed,
+            max_concurrent=max_concurrent,
+            **generate_kwargs,
+        )
+
+        actual_labels = [data["label"][index] for index, _ in idx_hyp_pair]
+
+        return scores, actual_labels
+
+    def label_probabilities(self, choice_scores: List[float]) -> List[float]:
+        """
+        Softmax of the scores of one example at `self.calibration_temperature`, or all zeros
+        if no label was scored.
+        """
+        max_score = max(choice_scores)
+        if max_score == -math.inf:
+            return [0.0 for _ in choice_scores]
+        weights = [
+            math.exp((score - max_score) / self.calibration_temperature)
+            for score in choice_scores
+        ]
+        return [weight / sum(weights) for weight in weights]
+
+    def batched_predict(
+        self,
+        data: pd.DataFrame,
+        idx_hyp_pair=List[Tuple[int, Dict[str, SummaryInformation]]],
+        cache_seed=None,
+        max_concurrent=3,
+        stop_predicate: Callable[[str], bool] = None,
+        **generate_kwargs,
+    ):
+        """
+        Makes a batch of predictions on a hypothesis by scoring the labels. The calibrated
+        probability of every prediction is stored in `self.confidences`.
+
+        Parameters:
+            data: the data to predict on
+            idx_hyp_pair: a list of tuples of indices and hypothesis banks
+            cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
+            max_concurrent: the maximum number of concurrent requests
+            stop_predicate: Ignored, scoring generates a single token
+
+        Returns:
+            predictions: the highest scoring label, "other" if no label was scored
+            actual_labels: the true labels
+        """
+        logger = LoggerConfig.get_logger(logger_name)
+        scores, actual_labels = self.batched_score(
+            data,
+            idx_hyp_pair,
+            cache_seed=cache_seed,
+            max_concurrent=max_concurrent,
+            **generate_kwargs,
+        )
+
+        predictions, confidences = [], []
+        for choice_scores in scores:
+            probabilities = self.label_probabilities(choice_scores)
+            if max(probabilities) == 0.0:
+                predictions.append("other")
+                confidences.append(0.0)
+                continue
+            best = probabilities.index(max(probabilities))
+            predictions.append(self.labels[best])
+            confidences.append(probabilities[best])
+        self.confidences = confidences
+
+        if len(confidences) > 0:
+            logger.info(
+                f"Mean confidence: {sum(confidences) / len(confidences)}"
+            )
+        return predictions, actual_labels
+
+    def fit_calibration_temperature(
+        self,
+        data: pd.DataFrame,
+        hyp_bank: Dict[str, SummaryInformation],
+        cache_seed=None,
+        max_concurrent=3,
+        generate_kwargs={},
+    ):
+        """
+        Sets `self.calibration_temperature` to the temperature that minimizes the negative
+        log-likelihood of the true labels of `data`, e.g. the validation split, with the
+        hypothesis `run_inference_final` uses. Predictions do not change, only confidences.
+
+        Parameters:
+            data: the data to fit on
+            hyp_bank: the hypotheses that we want to predict from
+            cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
+            max_concurrent: the maximum number of concurrent requests
+
+        Returns:
+            The fitted temperature
+        """
+        logger = LoggerConfig.get_logger(logger_name)
+        top_hypothesis = sorted(hyp_bank, key=lambda x: hyp_bank[x].acc, reverse=True)[
+            0
+        ]
+        scores, actual_labels = self.batched_score(
+            data,
+            [
+                (i, {top_hypothesis: hyp_bank[top_hypothesis]})
+                for i in range(len(data))
+            ],
+            cache_seed=cache_seed,
+            max_concurrent=max_concurrent,
+            **generate_kwargs,
+        )
+        # examples whose true label got no probability are left out, their likelihood is 0 at any temperature
+        examples = [
+            (choice_scores, self.labels.index(label))
+            for choice_scores, label in zip(scores, actual_labels)
+            if label in self.labels
+            and choice_scores[self.labels.index(label)] > -math.inf
+        ]
+        if len(examples) == 0:
+            logger.warning("No example to fit the calibration temperature on")
+            return self.calibration_temperature
+
+        def negative_log_likelihood(temperature):
+            return -sum(
+                choice_scores[label_idx] / temperature
+                - logsumexp([score / temperature for score in choice_scores])
+                for choice_scores, label_idx in examples
+            )
+
+        # the likelihood is log-concave in 1 / temperature, so a ternary search over
+        # log(temperature) finds its maximum
+        low, high = math.log(1e-2), math.log(1e2)
+        for _ in range(100):
+            left, right = low + (high - low) / 3, high - (high - low) / 3
+            if negative_log_likelihood(math.exp(left)) < negative_log_likelihood(
+                math.exp(right)
+            ):
+                high = right
+            else:
+                low = left
+        self.calibration_temperature = math.exp((low + high) / 2)
+        logger.info(
+            f"Fitted calibration temperature {self.calibration_temperature} on {len(examples)} examples"
+        )
+        return self.calibration_temperature
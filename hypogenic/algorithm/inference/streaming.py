@@ -0,0 +1,231 @@
+import json
+import os
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from ...logger_config import LoggerConfig
+
+logger_name = "HypoGenic - Streaming Inference"
+
+
+class RunningMetrics:
+    """
+    Accuracy and macro F1 kept up to date one prediction at a time, from per-label counts
+    instead of the lists of predictions and labels.
+
+    Matches `get_results` (scikit-learn's `accuracy_score` and `f1_score(average="macro")`)
+    on all predictions seen so far.
+    """
+
+    def __init__(self):
+        self.num_examples = 0
+        self.num_correct = 0
+        self.true_positives = Counter()
+        self.false_positives = Counter()
+        self.false_negatives = Counter()
+
+    def update(self, pred_list: List, label_list: List):
+        for pred, label in zip(pred_list, label_list):
+            self.num_examples += 1
+            if pred == label:
+                self.num_correct += 1
+                self.true_positives[label] += 1
+            else:
+                self.false_positives[pred] += 1
+                self.false_negatives[label] += 1
+
+    @property
+    def accuracy(self) -> float:
+        if self.num_examples == 0:
+            return 0.0
+        return self.num_correct / self.num_examples
+
+    @property
+    def f1(self) -> float:
+        # like scikit-learn, average over every label seen as a prediction or as a true label
+        labels = (
+            set(self.true_positives)
+            | set(self.false_positives)
+            | set(self.false_negatives)
+        )
+        if len(labels) == 0:
+            return 0.0
+        # per-label F1 is 2TP / (2TP + FP + FN), i.e. 0 when precision and recall are both 0
+        return sum(
+            2
+            * self.true_positives[label]
+            / (
+                2 * self.true_positives[label]
+                + self.false_positives[label]
+                + self.false_negatives[label]
+            )
+            for label in labels
+        ) / len(labels)
+
+    def results(self):
+        return {"accuracy": self.accuracy, "f1": self.f1}
+
+
+def _to_json(value):
+    # labels read from a DataFrame can be NumPy scalars
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class PredictionSink:
+    """
+    Appends predictions to a JSONL file chunk by chunk, so an interrupted run can resume
+    from the last completed chunk.
+
+    The first line records the chunk size and `run_info`, e.g. the hypotheses, model and
+    data the predictions are made with. Every chunk is written as one line per example,
+    `{"chunk", "index", "prediction", "label"}` with `index` the position in the sampled
+    split (and a `"confidence"` for inference styles that report one), followed by a
+    `{"chunk", "completed": true}` line, and synced to disk. When an existing file is
+    opened, a partially written chunk after the last completed one is cut off, and the
+    running metrics are rebuilt from the completed chunks.
+
+    Typical usage example:
+
+      sink = PredictionSink(
+          "./outputs/predictions_seed_49.jsonl",
+          chunk_size=1000,
+          run_info={"hypothesis_sha256": hypothesis_sha256, "seed": 49},
+      )
+      for chunk_idx, data in task.get_data_chunks("test", None, 49, 1000, sink.next_chunk):
+          pred_list, label_list = inference_class.run_inference_final(data, hyp_bank)
+          sink.write_chunk(chunk_idx, pred_list, label_list)
+      sink.close()
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        chunk_size: int,
+        resume=True,
+        run_info: Dict[str, Any] = None,
+    ):
+        """
+        Parameters:
+            file_path: Path to the JSONL file
+            chunk_size: Number of examples per chunk, must match the chunk size of a file that is resumed
+            resume: Whether to continue an existing file. If `False`, the file is overwritten.
+            run_info: JSON serializable description of the run, must match the one of a file that is resumed
+        """
+        logger = LoggerConfig.get_logger(logger_name)
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        # compared with the header after a JSON round trip, e.g. tuples become lists
+        self.run_info = json.loads(json.dumps(run_info if run_info is not None else {}))
+        self.metrics = RunningMetrics()
+        self.next_chunk = 0
+
+        if resume and os.path.exists(file_path):
+            completed_size = self._read_completed_chunks()
+            self.file = open(file_path, "r+b")
+            self.file.truncate(completed_size)
+            self.file.seek(completed_size)
+            if completed_size == 0:
+                self._write_header()
+            elif self.next_chunk > 0:
+                logger.info(
+                    f"Resuming {file_path} from chunk {self.next_chunk} "
+                    f"({self.metrics.num_examples} examples done)"
+                )
+        else:
+            directory = os.path.dirname(os.path.abspath(file_path))
+            os.makedirs(directory, exist_ok=True)
+            self.file = open(file_path, "wb")
+            self._write_header()
+
+    def _write_header(self):
+        self._write_lines([{"chunk_size": self.chunk_size, "run_info": self.run_info}])
+
+    def _write_lines(self, records: List[dict]):
+        self.file.write(
+            "".join(json.dumps(record) + "\n" for record in records).encode("utf-8")
+        )
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def _read_completed_chunks(self) -> int:
+        """
+        Reads the completed chunks of an existing file into the running metrics.
+
+        Returns:
+            The size in bytes of the file up to the end of the last completed chunk
+        """
+        completed_size = 0
+        chunk_pred_list, chunk_label_list = [], []
+        with open(self.file_path, "rb") as f:
+            offset = 0
+            for line in f:
+                offset += len(line)
+                if not line.endswith(b"\n"):
+                    # cut off in the middle of writing this line
+                    break
+                record = json.loads(line)
+                if "chunk_size" in record:
+                    if record["chunk_size"] != self.chunk_size:
+                        raise ValueError(
+                            f"{self.file_path} was written with chunk size {record['chunk_size']}, "
+                            f"not {self.chunk_size}"
+                        )
+                    saved_run_info = record.get("run_info", {})
+                    mismatches = [
+                        f"{key}={saved_run_info.get(key)!r} (now {self.run_info.get(key)!r})"
+                        for key in sorted(set(saved_run_info) | set(self.run_info))
+                        if saved_run_info.get(key) != self.run_info.get(key)
+                    ]
+                    if len(mismatches) > 0:
+                        raise ValueError(
+                            f"{self.file_path} was written by a different run: "
+                            + ", ".join(mismatches)
+                        )
+                    completed_size = offset
+                elif record.get("completed", False):
+                    self.metrics.update(chunk_pred_list, chunk_label_list)
+                    chunk_pred_list, chunk_label_list = [], []
+                    self.next_chunk = record["chunk"] + 1
+                    completed_size = offset
+                else:
+                    chunk_pred_list.append(record["prediction"])
+                    chunk_label_list.append(record["label"])
+        return completed_size
+
+    def write_chunk(
+        self,
+        chunk_idx: int,
+        pred_list: List,
+        label_list: List,
+        confidence_list: Optional[List[float]] = None,
+    ):
+        """
+        Appends the predictions of chunk `chunk_idx` and marks it completed. If given, the
+        confidence of every prediction is stored with it.
+        """
+        records = [
+            {
+                "chunk": chunk_idx,
+                "index": chunk_idx * self.chunk_size + idx,
+                "prediction": _to_json(pred),
+                "label": _to_json(label),
+            }
+            for idx, (pred, label) in enumerate(zip(pred_list, label_list))
+        ]
+        if confidence_list is not None:
+            for record, confidence in zip(records, confidence_list):
+                record["confidence"] = confidence
+        records.append({"chunk": chunk_idx, "completed": True})
+        self._write_lines(records)
+        self.metrics.update(
+            [record["prediction"] for record in records[:-1]],
+            [record["label"] for record in records[:-1]],
+        )
+        self.next_chunk = chunk_idx + 1
+
+    def close(self):
+        self.file.close()
@@ -1,7 +1,7 @@
 from abc import ABC, abstractmethod
 import os
 from collections import OrderedDict
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, List, Tuple
 import numpy as np
 import pandas as pd
 import pulp
@@ -79,6 +79,7 @@ class TwoStepAdaptiveInference(OneStepAdaptiveInference):
         idx_hyp_pair=List[Tuple[int, Dict[str, SummaryInformation]]],
         cache_seed=None,
         max_concurrent=3,
+        stop_predicate: Callable[[str], bool] = None,
         **generate_kwargs,
     ):
         """
@@ -89,6 +90,8 @@ class TwoStepAdaptiveInference(OneStepAdaptiveInference):
             idx_hyp_pair: a list of tuples of indices and hypothesis banks
             cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
             max_concurrent: the maximum number of concurrent requests
+            stop_predicate: If given, the responses the labels are extracted from are streamed and
+                cut off as soon as it holds
         """
         prompt_inputs = [
             self.prompt_class.adaptive_selection(hyp_bank, self.train_data, data, index)
@@ -112,6 +115,7 @@ class TwoStepAdaptiveInference(OneStepAdaptiveInference):
             prompt_inputs,
             cache_seed=cache_seed,
             max_concurrent=max_concurrent,
+            stop_predicate=stop_predicate,
             **generate_kwargs,
         )
         predictions = [self.task.extract_label(response) for response in responses]
@@ -1,7 +1,7 @@
 from abc import ABC, abstractmethod
 import os
 from collections import OrderedDict
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, List, Tuple
 import numpy as np
 import pandas as pd
 import pulp
@@ -35,6 +35,7 @@ class UpperboundInference(Inference):
         idx_hyp_pair=List[Tuple[int, Dict[str, SummaryInformation]]],
         cache_seed=None,
         max_concurrent=3,
+        stop_predicate: Callable[[str], bool] = None,
         **generate_kwargs,
     ):
         """
@@ -45,6 +46,8 @@ class UpperboundInference(Inference):
             idx_hyp_pair: a list of tuples of indices and hypothesis banks
             cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
             max_concurrent: the maximum number of concurrent requests
+            stop_predicate: If given, the responses the labels are extracted from are streamed and
+                cut off as soon as it holds
         """
         assert all(
             [len(hyp_bank.keys()) == 1 for _, hyp_bank in idx_hyp_pair]
@@ -59,6 +62,7 @@ class UpperboundInference(Inference):
             prompt_inputs,
             cache_seed=cache_seed,
             max_concurrent=max_concurrent,
+            stop_predicate=stop_predicate,
             **generate_kwargs,
         )
         predictions = [self.task.extract_label(response) for response in responses]
@@ -72,6 +76,7 @@ class UpperboundInference(Inference):
         k=1,
         cache_seed=None,
         max_concurrent=3,
+        stop_predicate: Callable[[str], bool] = None,
         generate_kwargs={},
         **kwargs,
     ):
@@ -85,6 +90,7 @@ class UpperboundInference(Inference):
             k: the number of hypotheses to keep
             cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
             max_concurrent: the maximum number of concurrent requests
+            stop_predicate: If given, the label predictions are streamed and cut off as soon as it holds
         """
         logger = LoggerConfig.get_logger(logger_name)
 
@@ -109,6 +115,7 @@ class UpperboundInference(Inference):
             [(i, {hyp: hyp_bank[hyp]}) for hyp in hyp_bank for i in range(num_samples)],
             cache_seed=cache_seed,
             max_concurrent=max_concurrent,
+            stop_predicate=stop_predicate,
             **generate_kwargs,
         )
         preds = preds[::-1]
@@ -157,6 +164,7 @@ class UpperboundInference(Inference):
         hyp_bank,
         cache_seed=None,
         max_concurrent=3,
+        stop_predicate: Callable[[str], bool] = None,
         generate_kwargs={},
         **kwargs,
     ):
@@ -170,12 +178,14 @@ class UpperboundInference(Inference):
             k: the number of hypotheses to keep
             cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
             max_concurrent: the maximum number of concurrent requests
+            stop_predicate: If given, the label predictions are streamed and cut off as soon as it holds
         """
         return self._run_inference_final(
             data,
             hyp_bank,
             cache_seed=cache_seed,
             max_concurrent=max_concurrent,
+            stop_predicate=stop_predicate,
             generate_kwargs=generate_kwargs,
             **kwargs,
         )
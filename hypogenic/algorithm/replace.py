@@ -1,6 +1,7 @@
 import os
 from abc import ABC, abstractmethod
 from ..register import Register
+from .summary_information import HypothesisBank
 
 replace_register = Register(name="replace")
 
@@ -39,13 +40,20 @@ class DefaultReplace(Replace):
         exceeds the maximum number of hypotheses.
 
         Parameters:
-            hypotheses_bank: the original dictionary of hypotheses
+            hypotheses_bank: the original dictionary of hypotheses, or a `HypothesisBank`
             new_generated_hypotheses: the newly generated dictionary of hypotheses
 
         Returns:
-            updated_hyp_bank: the updated hypothesis bank
+            updated_hyp_bank: the updated hypothesis bank, of the same type as `hypotheses_bank`
 
         """
+        if isinstance(hypotheses_bank, HypothesisBank):
+            merged_hyp_bank = HypothesisBank(new_generated_hypotheses)
+            merged_hyp_bank.update(hypotheses_bank)
+            return merged_hyp_bank.subset(
+                merged_hyp_bank.top_k(self.max_num_hypotheses)
+            )
+
         merged_hyp_bank = new_generated_hypotheses.copy()
         merged_hyp_bank.update(hypotheses_bank)
 
@@ -1,5 +1,9 @@
 import math
+import weakref
+from collections.abc import MutableMapping
+from typing import Any, Dict, List, Mapping, Sequence, Tuple
 
+import numpy as np
 import pandas as pd
 
 
@@ -76,6 +80,288 @@ class SummaryInformation:
     def get_examples(self, train_data: pd.DataFrame):
         return train_data.iloc[[index for index, *_ in self.correct_examples]]
 
+    def to_dict(self) -> dict:
+        return {
+            "hypothesis": self.hypothesis,
+            "acc": self.acc,
+            "num_visits": self.num_visits,
+            "reward": self.reward,
+            "correct_examples": list(self.correct_examples),
+        }
+
     @staticmethod
     def from_dict(data: dict) -> "SummaryInformation":
         return SummaryInformation(**data)
+
+
+def _bank_column(name, cast):
+    """Attribute of a `_BankEntry` stored in column `name` of its bank."""
+
+    def fget(self):
+        if self._bank is None:
+            return self._detached[name]
+        return cast(getattr(self._bank, "_" + name)[self._bank.ids[self._key]])
+
+    def fset(self, value):
+        if self._bank is None:
+            self._detached[name] = value
+        else:
+            getattr(self._bank, "_" + name)[self._bank.ids[self._key]] = value
+
+    return property(fget, fset)
+
+
+class _BankEntry(SummaryInformation):
+    """
+    `SummaryInformation` view of one row of a `HypothesisBank`. Reads and writes go to the
+    bank, so `bank[hypothesis].set_example(...)` changes the bank, as it would change a
+    dict of `SummaryInformation`. Once the hypothesis is deleted from the bank, the view
+    keeps the last values.
+    """
+
+    acc = _bank_column("acc", float)
+    num_visits = _bank_column("num_visits", int)
+    reward = _bank_column("reward", float)
+
+    def __init__(self, bank: "HypothesisBank", hypothesis: str):
+        self._bank = bank
+        self._key = hypothesis
+        self._detached = None
+        self.hypothesis = hypothesis
+
+    @property
+    def correct_examples(self) -> List[Tuple[int, Any]]:
+        if self._bank is None:
+            return self._detached["correct_examples"]
+        return self._bank.correct_examples[self._bank.ids[self._key]]
+
+    @correct_examples.setter
+    def correct_examples(self, value):
+        if self._bank is None:
+            self._detached["correct_examples"] = list(value)
+        else:
+            self._bank.correct_examples[self._bank.ids[self._key]] = list(value)
+
+    def _detach(self):
+        self._detached = {
+            "acc": self.acc,
+            "num_visits": self.num_visits,
+            "reward": self.reward,
+            "correct_examples": self.correct_examples,
+        }
+        self._bank = None
+
+    def __reduce__(self):
+        return (SummaryInformation, (-1, self.acc, self.reward, self.num_visits))
+
+
+def correct_example_matrix(
+    hyp_bank: Mapping[str, SummaryInformation], num_examples: int
+):
+    """
+    Sparse 0/1 matrix (`scipy.sparse.csr_matrix`) with one row per hypothesis, in the order of
+    `hyp_bank`, and a 1 in the column of each example the hypothesis got right.
+
+    Only the indices of correct examples are stored, so the matrix stays small for large
+    training sets, and overlaps between all hypotheses are one sparse matrix product.
+    """
+    # imported here so that importing hypogenic does not load scipy
+    from scipy import sparse
+
+    rows, columns = [], []
+    for row, hypothesis in enumerate(hyp_bank):
+        indices = [index for index, *_ in hyp_bank[hypothesis].correct_examples]
+        rows.extend([row] * len(indices))
+        columns.extend(indices)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float64), (rows, columns)),
+        shape=(len(hyp_bank), num_examples),
+    )
+    # an example recorded twice (e.g. in two epochs) still counts once
+    matrix.sum_duplicates()
+    matrix.data[:] = 1.0
+    return matrix
+
+
+class HypothesisBank(MutableMapping):
+    """
+    Array-backed hypothesis bank, a drop-in replacement for `Dict[str, SummaryInformation]`.
+
+    Accuracy, number of visits and reward are kept in NumPy columns indexed by a row id
+    per hypothesis, so rewards can be recomputed and the bank ranked without touching
+    Python objects. Rows keep insertion order, like a dict.
+
+    Indexing returns a live `SummaryInformation` view of the row: changing it, e.g. with
+    `bank[hypothesis].set_reward(...)`, changes the bank. `record_results` updates many
+    hypotheses at once.
+    """
+
+    def __init__(self, hypotheses_bank: Dict[str, SummaryInformation] = None):
+        """
+        Parameters:
+            hypotheses_bank: Hypotheses to start with
+        """
+        self.hypotheses: List[str] = []
+        self.ids: Dict[str, int] = {}
+        self.correct_examples: List[List[Tuple[int, Any]]] = []
+        self._acc = np.zeros(16, dtype=np.float64)
+        self._num_visits = np.zeros(16, dtype=np.int64)
+        self._reward = np.zeros(16, dtype=np.float64)
+        self._views = weakref.WeakValueDictionary()
+        if hypotheses_bank is not None:
+            self.update(hypotheses_bank)
+
+    # Columns of the live rows
+    @property
+    def acc(self) -> np.ndarray:
+        return self._acc[: len(self.hypotheses)]
+
+    @property
+    def num_visits(self) -> np.ndarray:
+        return self._num_visits[: len(self.hypotheses)]
+
+    @property
+    def reward(self) -> np.ndarray:
+        return self._reward[: len(self.hypotheses)]
+
+    def _grow(self):
+        capacity = 2 * len(self._acc)
+        self._acc = np.resize(self._acc, capacity)
+        self._num_visits = np.resize(self._num_visits, capacity)
+        self._reward = np.resize(self._reward, capacity)
+
+    def __len__(self):
+        return len(self.hypotheses)
+
+    def __iter__(self):
+        return iter(list(self.hypotheses))
+
+    def __contains__(self, hypothesis):
+        return hypothesis in self.ids
+
+    def __getitem__(self, hypothesis: str) -> SummaryInformation:
+        if hypothesis not in self.ids:
+            raise KeyError(hypothesis)
+        view = self._views.get(hypothesis)
+        if view is None:
+            view = _BankEntry(self, hypothesis)
+            self._views[hypothesis] = view
+        return view
+
+    def __setitem__(self, hypothesis: str, info: SummaryInformation):
+        if hypothesis not in self.ids:
+            if len(self.hypotheses) == len(self._acc):
+                self._grow()
+            self.ids[hypothesis] = len(self.hypotheses)
+            self.hypotheses.append(hypothesis)
+            self.correct_examples.append(None)
+        idx = self.ids[hypothesis]
+        self._acc[idx] = info.acc
+        self._num_visits[idx] = info.num_visits
+        self._reward[idx] = info.reward
+        self.correct_examples[idx] = list(info.correct_examples)
+
+    def __delitem__(self, hypothesis: str):
+        if hypothesis not in self.ids:
+            raise KeyError(hypothesis)
+        # views handed out before, e.g. by `pop`, keep the values of the deleted row
+        view = self._views.pop(hypothesis, None)
+        if view is not None:
+            view._detach()
+        idx = self.ids.pop(hypothesis)
+        num_rows = len(self.hypotheses)
+        for column in (self._acc, self._num_visits, self._reward):
+            column[idx : num_rows - 1] = column[idx + 1 : num_rows]
+        del self.hypotheses[idx]
+        del self.correct_examples[idx]
+        for row, hyp in enumerate(self.hypotheses[idx:], start=idx):
+            self.ids[hyp] = row
+
+    def to_dict(self) -> Dict[str, SummaryInformation]:
+        return {hypothesis: self[hypothesis] for hypothesis in self.hypotheses}
+
+    def subset(self, hypotheses: List[str]) -> "HypothesisBank":
+        """Returns a new bank with only `hypotheses`, in the given order."""
+        rows = np.array([self.ids[hyp] for hyp in hypotheses], dtype=np.int64)
+        bank = HypothesisBank()
+        bank.hypotheses = list(hypotheses)
+        bank.ids = {hyp: row for row, hyp in enumerate(hypotheses)}
+        bank.correct_examples = [list(self.correct_examples[row]) for row in rows]
+        capacity = max(16, len(rows))
+        for name in ("_acc", "_num_visits", "_reward"):
+            column = np.zeros(capacity, dtype=getattr(self, name).dtype)
+            column[: len(rows)] = getattr(self, name)[rows]
+            setattr(bank, name, column)
+        return bank
+
+    def top_k(self, k: int) -> List[str]:
+        """
+        Hypotheses ranked by reward, sliced with `[:k]`.
+
+        Same result as `sorted(bank, key=lambda h: bank[h].reward, reverse=True)[:k]`,
+        including insertion order among equal rewards, but only the top `k` rows are sorted.
+        """
+        reward = self.reward
+        num_rows = len(reward)
+        num_selected = len(range(num_rows)[:k])
+        if num_selected == 0:
+            return []
+        if num_selected < num_rows:
+            # everything above the k-th largest reward, then ties in insertion order
+            threshold = -np.partition(-reward, num_selected - 1)[num_selected - 1]
+            above = np.flatnonzero(reward > threshold)
+            ties = np.flatnonzero(reward == threshold)[: num_selected - len(above)]
+            rows = np.concatenate([above, ties])
+        else:
+            rows = np.arange(num_rows)
+        rows = rows[np.argsort(-reward[rows], kind="stable")]
+        return [self.hypotheses[row] for row in rows]
+
+    def update_rewards(self, alpha, num_examples, hypotheses: List[str] = None):
+        """Recomputes the UCB reward of `hypotheses` (default: all) after `num_examples` examples."""
+        rows = (
+            slice(0, len(self.hypotheses))
+            if hypotheses is None
+            else np.array([self.ids[hyp] for hyp in hypotheses], dtype=np.int64)
+        )
+        with np.errstate(divide="ignore"):
+            self._reward[rows] = self._acc[rows] + alpha * np.sqrt(
+                math.log(num_examples) / self._num_visits[rows]
+            )
+
+    def record_results(
+        self,
+        hypotheses: List[str],
+        correct: Sequence[bool],
+        current_sample,
+        alpha,
+        example_idx=None,
+        labels: Sequence = None,
+    ):
+        """
+        Records whether each hypothesis predicted one example correctly, updating accuracy,
+        number of visits and reward of all of them at once.
+
+        Parameters:
+            hypotheses: Hypotheses that were tested
+            correct: Whether the prediction of each hypothesis was correct
+            current_sample: Number of examples seen so far, used for the reward
+            alpha: Exploration parameter
+            example_idx: Index of the example. If given with `labels`, it is added to the
+                correct examples of the hypotheses that got it right.
+            labels: Label of the example, one per hypothesis
+        """
+        if len(hypotheses) == 0:
+            return
+        rows = np.array([self.ids[hyp] for hyp in hypotheses], dtype=np.int64)
+        correct = np.asarray(correct, dtype=np.float64)
+        num_visits = self._num_visits[rows]
+        self._acc[rows] = (self._acc[rows] * num_visits + correct) / (num_visits + 1)
+        self._num_visits[rows] = num_visits + 1
+        self._reward[rows] = self._acc[rows] + alpha * np.sqrt(
+            math.log(current_sample) / self._num_visits[rows]
+        )
+        if example_idx is not None and labels is not None:
+            for row, is_correct, label in zip(rows, correct, labels):
+                if is_correct:
+                    self.correct_examples[row].append((example_idx, label))
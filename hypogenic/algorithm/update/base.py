@@ -1,21 +1,51 @@
 from abc import ABC, abstractmethod
 import os
+import re
 import json
 import math
-from typing import Dict
+import random
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
 from string import Template
 
+import numpy as np
 import pandas as pd
 
 from ..generation import Generation
 from ..inference import Inference
 from ..replace import Replace
 from ..summary_information import SummaryInformation
+from ...logger_config import LoggerConfig
+
+logger_name = "HypoGenic - Update"
+
+
+def atomic_write(file_path: str, content: str):
+    """
+    Writes `content` to a temporary file next to `file_path` and renames it into place,
+    so readers (and a run resuming after a crash) never see a partially written file.
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
 
 
 class Update(ABC):
     """Update class. To use it implement the update function"""
 
+    checkpoint_file_name_template = (
+        "update_checkpoint_seed_${seed}_epoch_${epoch}_sample_${sample}.json"
+    )
+
     def __init__(
         self,
         generation_class: Generation,
@@ -34,6 +64,8 @@ class Update(ABC):
         update_hypotheses_per_batch=5,
         only_best_hypothesis=False,
         save_every_n_examples=100,
+        lookahead_window=1,
+        keep_checkpoints=2,
     ):
         """
         Initialize the update class
@@ -55,6 +87,10 @@ class Update(ABC):
             update_hypotheses_per_batch: Number of hypotheses to generate per prompt. Default is 5
             only_best_hypothesis: If only the best hypothesis should be added in the newly generated hypotheses of the batch. Default is False
             save_every_n_examples: Save hypotheses every n examples. Default is 100
+            lookahead_window: Number of upcoming examples the current top hypotheses are evaluated on in one batch.
+                Predictions are replayed one example at a time, so the result matches the sequential loop.
+                Needs an inference class with `uses_hypothesis_info` set to False, e.g. `DefaultInference`. Default is 1
+            keep_checkpoints: Number of most recent update checkpoints to keep per seed. 0 disables checkpointing. Default is 2
         """
         self.generation_class = generation_class
         self.inference_class = inference_class
@@ -73,6 +109,14 @@ class Update(ABC):
         self.update_hypotheses_per_batch = update_hypotheses_per_batch
         self.only_best_hypothesis = only_best_hypothesis
         self.save_every_n_examples = save_every_n_examples
+        self.lookahead_window = lookahead_window
+        self.keep_checkpoints = keep_checkpoints
+
+        if lookahead_window > 1 and self.inference_class.uses_hypothesis_info:
+            raise ValueError(
+                f"lookahead_window > 1 needs predictions that only depend on the hypothesis and the example, "
+                f"but {type(self.inference_class).__name__} uses the hypotheses' information, which changes during the update"
+            )
 
     @abstractmethod
     def update(
@@ -82,6 +126,7 @@ class Update(ABC):
         current_seed,
         cache_seed=None,
         max_concurrent=3,
+        checkpoint: Optional[Dict[str, Any]] = None,
         **generate_kwargs,
     ):
         """Implements how the algorithm runs through the samples. To run through the updated samples, start from args.num_init
@@ -92,12 +137,65 @@ class Update(ABC):
             hypotheses_bank: a dictionary of hypotheses that is generated with the initial training data
             current_epoch: the current epoch number
             current_seed: the current seed number
+            checkpoint: a checkpoint returned by `load_checkpoint` to resume from. Its hypotheses bank should be passed as `hypotheses_bank`
 
         Returns
             final_hypotheses_bank: a dictionary of the final hypotheses as keys and the values being corresponding SummaryInformation of the hypotheses
         """
         pass
 
+    def lookahead_predict(
+        self,
+        hypotheses_bank,
+        hypotheses: List[str],
+        example_idx: int,
+        predictions: Dict[int, Dict[str, Tuple]],
+        cache_seed=None,
+        max_concurrent=3,
+        **generate_kwargs,
+    ):
+        """
+        Returns the predictions and labels of `hypotheses` on one training example.
+
+        Pairs missing from `predictions` are evaluated in one batch, together with the same
+        hypotheses on the next `lookahead_window - 1` examples, and stored in `predictions`
+        for the following calls. The inference class does not use the hypotheses' information
+        (see `Inference.uses_hypothesis_info`), so its predictions only depend on the hypothesis
+        and the example, and stored ones stay valid while the bank changes; a hypothesis that
+        enters the top later is simply evaluated then.
+
+        Parameters:
+            hypotheses_bank: The hypothesis bank
+            hypotheses: The hypotheses to evaluate
+            example_idx: The index of the training example
+            predictions: Maps example index to {hypothesis: (prediction, label)}, updated in place
+            cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
+            max_concurrent: The maximum number of concurrent requests
+        """
+        current = predictions.setdefault(example_idx, {})
+        missing = [hyp for hyp in hypotheses if hyp not in current]
+        if len(missing) > 0:
+            window_end = min(example_idx + self.lookahead_window, len(self.train_data))
+            pairs = [
+                (idx, hyp)
+                for idx in range(example_idx, window_end)
+                for hyp in missing
+                if hyp not in predictions.get(idx, {})
+            ]
+            preds, labels = self.inference_class.batched_predict(
+                self.train_data,
+                [(idx, {hyp: hypotheses_bank[hyp]}) for idx, hyp in pairs],
+                cache_seed=cache_seed,
+                max_concurrent=max_concurrent,
+                **generate_kwargs,
+            )
+            for (idx, hyp), pred, label in zip(pairs, preds, labels):
+                predictions.setdefault(idx, {})[hyp] = (pred, label)
+
+        preds = [current[hyp][0] for hyp in hypotheses]
+        labels = [current[hyp][1] for hyp in hypotheses]
+        return preds, labels
+
     def save_to_json(
         self,
         hypotheses_bank: Dict[str, SummaryInformation],
@@ -120,21 +218,185 @@ class Update(ABC):
         # Write what we want to store
         temp_dict = {}
         for hypothesis in hypotheses_bank.keys():
-            serialized_dict = hypotheses_bank[hypothesis].__dict__
+            serialized_dict = hypotheses_bank[hypothesis].to_dict()
             temp_dict[hypothesis] = serialized_dict
 
         json_string = json.dumps(temp_dict)
 
         # we expect 'sample', 'seed', 'epoch'
         kwargs = {k: str(v) for k, v in kwargs.items()}
-        with open(
+        atomic_write(
             os.path.join(
                 self.save_path,
                 Template(file_name_template).substitute(kwargs),
             ),
-            "w",
-        ) as f:
-            f.write(json_string)
+            json_string,
+        )
+
+    def _checkpoint_paths(self, current_seed) -> List[Tuple[int, int, str]]:
+        """Returns `(epoch, sample, path)` of the checkpoints of `current_seed`, oldest first."""
+        pattern = re.escape(self.checkpoint_file_name_template)
+        for key in ["seed", "epoch", "sample"]:
+            pattern = pattern.replace(
+                re.escape("${" + key + "}"),
+                re.escape(str(current_seed)) if key == "seed" else f"(?P<{key}>\\d+)",
+            )
+        if not os.path.isdir(self.save_path):
+            return []
+        checkpoints = []
+        for file_name in os.listdir(self.save_path):
+            match = re.fullmatch(pattern, file_name)
+            if match is not None:
+                checkpoints.append(
+                    (
+                        int(match.group("epoch")),
+                        int(match.group("sample")),
+                        os.path.join(self.save_path, file_name),
+                    )
+                )
+        return sorted(checkpoints)
+
+    def run_config(self) -> Dict[str, Any]:
+        """
+        Settings a checkpoint is only valid for. They are saved with every checkpoint, and
+        `load_checkpoint` refuses to resume a run with different ones.
+        """
+        return {
+            "task": self.inference_class.task.task_name,
+            "model": self.inference_class.api.model,
+            "update_class": type(self).__name__,
+            "generation_class": type(self.generation_class).__name__,
+            "inference_class": type(self.inference_class).__name__,
+            "replace_class": type(self.replace_class).__name__,
+            "max_num_hypotheses": self.replace_class.max_num_hypotheses,
+            "num_train": len(self.train_data),
+            "num_init": self.num_init,
+            "num_wrong_scale": self.num_wrong_scale,
+            "k": self.k,
+            "alpha": self.alpha,
+            "update_batch_size": self.update_batch_size,
+            "num_hypotheses_to_update": self.num_hypotheses_to_update,
+            "update_hypotheses_per_batch": self.update_hypotheses_per_batch,
+            "only_best_hypothesis": self.only_best_hypothesis,
+        }
+
+    def save_checkpoint(
+        self,
+        hypotheses_bank: Dict[str, SummaryInformation],
+        next_sample,
+        wrong_example_ids,
+        current_epoch,
+        current_seed,
+    ):
+        """
+        Atomically saves everything needed to continue the update loop: the hypotheses bank,
+        the wrong examples collected for the next generation round, the loop position, the
+        random number generator states and the `run_config`. Only the `keep_checkpoints` most recent checkpoints are kept.
+
+        Parameters:
+            hypotheses_bank: The hypothesis bank
+            next_sample: Index of the next training example to visit
+            wrong_example_ids: Wrong examples collected since the last generation round
+            current_epoch: The current epoch
+            current_seed: The current seed
+        """
+        if self.keep_checkpoints <= 0:
+            return
+        logger = LoggerConfig.get_logger(logger_name)
+
+        numpy_state = np.random.get_state()
+        state = {
+            "config": self.run_config(),
+            "seed": current_seed,
+            "epoch": current_epoch,
+            "next_sample": next_sample,
+            "wrong_example_ids": sorted(wrong_example_ids),
+            "hypotheses_bank": {
+                hypothesis: hypotheses_bank[hypothesis].to_dict()
+                for hypothesis in hypotheses_bank
+            },
+            "random_state": random.getstate(),
+            "numpy_random_state": [
+                numpy_state[0],
+                numpy_state[1].tolist(),
+                *numpy_state[2:],
+            ],
+        }
+        file_path = os.path.join(
+            self.save_path,
+            Template(self.checkpoint_file_name_template).substitute(
+                seed=current_seed, epoch=current_epoch, sample=next_sample
+            ),
+        )
+        atomic_write(file_path, json.dumps(state))
+        logger.debug(f"Saved update checkpoint {file_path}")
+
+        for _, _, old_path in self._checkpoint_paths(current_seed)[
+            : -self.keep_checkpoints
+        ]:
+            os.remove(old_path)
+
+    def load_checkpoint(self, current_seed) -> Optional[Dict[str, Any]]:
+        """
+        Loads the most recent checkpoint of `current_seed` written by `save_checkpoint`.
+
+        Returns:
+            checkpoint: The saved state, with the hypotheses bank as a dictionary of `SummaryInformation`, or `None` if there is no checkpoint
+
+        Raises:
+            ValueError: If the checkpoint was saved by a run with a different `run_config`
+        """
+        logger = LoggerConfig.get_logger(logger_name)
+        checkpoints = self._checkpoint_paths(current_seed)
+        if len(checkpoints) == 0:
+            return None
+        file_path = checkpoints[-1][2]
+        with open(file_path, "r") as f:
+            checkpoint = json.load(f)
+
+        saved_config = checkpoint.get("config", {})
+        config = self.run_config()
+        mismatches = [
+            f"{key}={saved_config.get(key)!r} (now {value!r})"
+            for key, value in config.items()
+            if saved_config.get(key) != value
+        ]
+        if len(mismatches) > 0:
+            raise ValueError(
+                f"Update checkpoint {file_path} belongs to a run with different settings: "
+                + ", ".join(mismatches)
+                + ". Use the same settings to resume it, or start over in another folder."
+            )
+        if checkpoint["next_sample"] >= config["num_train"]:
+            logger.info(
+                f"Update checkpoint {file_path} already visited all {config['num_train']} training examples"
+            )
+
+        hypotheses_bank = {}
+        for hypothesis, data in checkpoint["hypotheses_bank"].items():
+            info = SummaryInformation.from_dict(data)
+            info.set_example([tuple(example) for example in info.correct_examples])
+            hypotheses_bank[hypothesis] = info
+        checkpoint["hypotheses_bank"] = hypotheses_bank
+        return checkpoint
+
+    def restore_from_checkpoint(self, checkpoint: Dict[str, Any]):
+        """
+        Restores the random number generator states of `checkpoint`.
+
+        Returns:
+            next_sample: Index of the next training example to visit
+            wrong_example_ids: Wrong examples collected since the last generation round
+        """
+        logger = LoggerConfig.get_logger(logger_name)
+        logger.info(
+            f"Resuming epoch {checkpoint['epoch']} from example {checkpoint['next_sample']}"
+        )
+        version, internal_state, gauss_next = checkpoint["random_state"]
+        random.setstate((version, tuple(internal_state), gauss_next))
+        name, keys, *rest = checkpoint["numpy_random_state"]
+        np.random.set_state((name, np.array(keys, dtype=np.uint32), *rest))
+        return checkpoint["next_sample"], set(checkpoint["wrong_example_ids"])
 
     def batched_initialize_hypotheses(
         self,
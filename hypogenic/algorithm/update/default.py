@@ -2,7 +2,7 @@ from abc import ABC, abstractmethod
 import os
 import json
 import math
-from typing import Dict
+from typing import Any, Dict, Optional, Union
 from string import Template
 
 from . import update_register
@@ -10,7 +10,7 @@ from .base import Update
 from ..generation import Generation
 from ..inference import Inference
 from ..replace import Replace
-from ..summary_information import SummaryInformation
+from ..summary_information import HypothesisBank, SummaryInformation
 from ...logger_config import LoggerConfig
 
 logger_name = "HypoGenic - Default Update"
@@ -40,6 +40,8 @@ class DefaultUpdate(Update):
         update_hypotheses_per_batch=5,
         only_best_hypothesis=False,
         save_every_n_examples=100,
+        lookahead_window=1,
+        keep_checkpoints=2,
     ):
         super().__init__(
             generation_class,
@@ -58,15 +60,18 @@ class DefaultUpdate(Update):
             update_hypotheses_per_batch,
             only_best_hypothesis,
             save_every_n_examples,
+            lookahead_window,
+            keep_checkpoints,
         )
 
     def update(
         self,
-        hypotheses_bank: Dict[str, SummaryInformation],
+        hypotheses_bank: Union[HypothesisBank, Dict[str, SummaryInformation]],
         current_epoch,
         current_seed,
         cache_seed=None,
         max_concurrent=3,
+        checkpoint: Optional[Dict[str, Any]] = None,
         **generate_kwargs,
     ):
         """
@@ -78,12 +83,18 @@ class DefaultUpdate(Update):
             current_seed: The current seed
             cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
             max_concurrent: The maximum number of concurrent requests
+            checkpoint: A checkpoint returned by `load_checkpoint` to resume from
         """
         logger = LoggerConfig.get_logger(logger_name)
 
+        if not isinstance(hypotheses_bank, HypothesisBank):
+            hypotheses_bank = HypothesisBank(hypotheses_bank)
+
         # initialize variables
         num_train_examples = len(self.train_data)
         wrong_example_ids = set()
+        # predictions made ahead of time, see `lookahead_predict`
+        predictions = {}
 
         # ----------------------------------------------------------------------
         # Figuring out starting samples
@@ -102,6 +113,9 @@ class DefaultUpdate(Update):
         if current_epoch > self.epoch_to_start_from:
             start_sample = 0
 
+        if checkpoint is not None and checkpoint["epoch"] == current_epoch:
+            start_sample, wrong_example_ids = self.restore_from_checkpoint(checkpoint)
+
         # ----------------------------------------------------------------------
         # Creating the new hypotheses
         # ----------------------------------------------------------------------
@@ -113,9 +127,7 @@ class DefaultUpdate(Update):
             logger.info(f"Training on example {i}")
 
             # We need to get the best k for testing the strength of our hypothesis bank
-            top_k_hypotheses = sorted(
-                hypotheses_bank, key=lambda x: hypotheses_bank[x].reward, reverse=True
-            )[: self.k]
+            top_k_hypotheses = hypotheses_bank.top_k(self.k)
 
             # We are at the regret that we need in order to generate a new hypothesis
             if self.num_wrong_scale > 0:
@@ -126,32 +138,31 @@ class DefaultUpdate(Update):
             # ------------------------------------------------------------------
             # We need to see how good our hypothesis is, which we do by way of the inference class
             # ------------------------------------------------------------------
-            num_wrong_hypotheses = 0
-            preds, labels = self.inference_class.batched_predict(
-                self.train_data,
-                [
-                    (i, {hypothesis: hypotheses_bank[hypothesis]})
-                    for hypothesis in top_k_hypotheses
-                ],
+            preds, labels = self.lookahead_predict(
+                hypotheses_bank,
+                top_k_hypotheses,
+                i,
+                predictions,
                 cache_seed=cache_seed,
                 max_concurrent=max_concurrent,
                 **generate_kwargs,
             )
+            predictions.pop(i)
 
             # Comparison of the label and prediction
-            for pred, label, hypothesis in zip(preds, labels, top_k_hypotheses):
-                if pred != label:
-                    num_wrong_hypotheses += 1
-                    hypotheses_bank[hypothesis].update_info_if_not_useful(
-                        current_sample, self.alpha
-                    )  # let the bank know it got one wrong
-                else:
-                    hypotheses_bank[hypothesis].update_info_if_useful(
-                        current_sample, self.alpha
-                    )  # let the bank know it got one right
-
-                    # keeping track of good examples as we do in generation
-                    hypotheses_bank[hypothesis].update_useful_examples(i, label)
+            correct = [pred == label for pred, label in zip(preds, labels)]
+            num_wrong_hypotheses = len(correct) - sum(correct)
+
+            # let the bank know which ones got it right, and keep track of good examples
+            # as we do in generation
+            hypotheses_bank.record_results(
+                top_k_hypotheses,
+                correct,
+                current_sample,
+                self.alpha,
+                example_idx=i,
+                labels=labels,
+            )
 
             # ------------------------------------------------------------------
             # Generating a new hypothesis
@@ -173,21 +184,21 @@ class DefaultUpdate(Update):
                     new_hyp_bank = {}
 
                     # generate new hypotheses
-                    for j in range(self.num_hypotheses_to_update):
-                        # Go through poorly performing exmaples and generate hypotheses for them
-                        # TODO: batched?
-                        new_hypotheses = (
-                            self.generation_class.batched_hypothesis_generation(
-                                wrong_example_ids,
-                                current_sample,
-                                self.update_hypotheses_per_batch,
-                                self.alpha,
-                                cache_seed=cache_seed,
-                                max_concurrent=max_concurrent,
-                                **generate_kwargs,
-                            )
+                    # Go through poorly performing exmaples and generate hypotheses for them,
+                    # with the requests of all rounds sent together
+                    new_hypotheses_rounds = (
+                        self.generation_class.batched_hypothesis_generation_rounds(
+                            wrong_example_ids,
+                            current_sample,
+                            self.update_hypotheses_per_batch,
+                            self.alpha,
+                            self.num_hypotheses_to_update,
+                            cache_seed=cache_seed,
+                            max_concurrent=max_concurrent,
+                            **generate_kwargs,
                         )
-
+                    )
+                    for new_hypotheses in new_hypotheses_rounds:
                         # If we onlt take the best performing hypothesis from the batch
                         if self.only_best_hypothesis:
                             best_hypothesis = max(
@@ -214,6 +225,21 @@ class DefaultUpdate(Update):
                     seed=current_seed,
                     epoch=current_epoch,
                 )
+                self.save_checkpoint(
+                    hypotheses_bank,
+                    i + 1,
+                    wrong_example_ids,
+                    current_epoch,
+                    current_seed,
+                )
+
+        self.save_checkpoint(
+            hypotheses_bank,
+            num_train_examples,
+            wrong_example_ids,
+            current_epoch,
+            current_seed,
+        )
 
         # Our new bank
         return hypotheses_bank
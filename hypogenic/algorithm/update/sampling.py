@@ -2,7 +2,7 @@ from abc import ABC, abstractmethod
 import os
 import json
 import math
-from typing import Dict
+from typing import Any, Dict, Optional, Union
 from string import Template
 
 from . import update_register
@@ -10,7 +10,7 @@ from .base import Update
 from ..generation import Generation
 from ..inference import Inference
 from ..replace import Replace
-from ..summary_information import SummaryInformation
+from ..summary_information import HypothesisBank, SummaryInformation
 from ...logger_config import LoggerConfig
 
 logger_name = "HypoGenic - Sampling Update"
@@ -36,6 +36,7 @@ class SamplingUpdate(Update):
         update_hypotheses_per_batch=5,
         only_best_hypothesis=False,
         save_every_n_examples=100,
+        keep_checkpoints=2,
     ):
         super().__init__(
             generation_class,
@@ -54,15 +55,17 @@ class SamplingUpdate(Update):
             update_hypotheses_per_batch,
             only_best_hypothesis,
             save_every_n_examples,
+            keep_checkpoints=keep_checkpoints,
         )
 
     def update(
         self,
-        hypotheses_bank: Dict[str, SummaryInformation],
+        hypotheses_bank: Union[HypothesisBank, Dict[str, SummaryInformation]],
         current_epoch,
         current_seed,
         cache_seed=None,
         max_concurrent=3,
+        checkpoint: Optional[Dict[str, Any]] = None,
         **generate_kwargs,
     ):
         """
@@ -74,9 +77,13 @@ class SamplingUpdate(Update):
             current_seed: The current seed
             cache_seed: If `None`, will not use cache, otherwise will use cache with corresponding seed number
             max_concurrent: The maximum number of concurrent requests
+            checkpoint: A checkpoint returned by `load_checkpoint` to resume from
         """
         logger = LoggerConfig.get_logger(logger_name)
 
+        if not isinstance(hypotheses_bank, HypothesisBank):
+            hypotheses_bank = HypothesisBank(hypotheses_bank)
+
         num_train_examples = len(self.train_data)
         wrong_example_ids = set()
 
@@ -92,13 +99,15 @@ class SamplingUpdate(Update):
         # This is to check if we are running more epochs than the starting epoch, if so, start at sample 0
         if current_epoch > self.epoch_to_start_from:
             start_sample = 0
+
+        if checkpoint is not None and checkpoint["epoch"] == current_epoch:
+            start_sample, wrong_example_ids = self.restore_from_checkpoint(checkpoint)
+
         for i in range(start_sample, num_train_examples):
             current_sample = i + 1
             logger.info(f"Training on example {i}")
 
-            top_k_hypotheses = sorted(
-                hypotheses_bank, key=lambda x: hypotheses_bank[x].reward, reverse=True
-            )[: self.k]
+            top_k_hypotheses = hypotheses_bank.top_k(self.k)
 
             if self.num_wrong_scale > 0:
                 num_wrong_to_add_bank = (
@@ -106,7 +115,6 @@ class SamplingUpdate(Update):
                 ) * self.num_wrong_scale
 
             # check if the hypothesis works for the generated hypotheses
-            num_wrong_hypotheses = 0
             preds, labels = self.inference_class.batched_predict(
                 self.train_data,
                 [
@@ -117,17 +125,16 @@ class SamplingUpdate(Update):
                 max_concurrent=max_concurrent,
                 **generate_kwargs,
             )
-            for pred, label, hypothesis in zip(preds, labels, top_k_hypotheses):
-                if pred != label:
-                    num_wrong_hypotheses += 1
-                    hypotheses_bank[hypothesis].update_info_if_not_useful(
-                        current_sample, self.alpha
-                    )
-                else:
-                    hypotheses_bank[hypothesis].update_info_if_useful(
-                        current_sample, self.alpha
-                    )
-                    hypotheses_bank[hypothesis].update_useful_examples(i, label)
+            correct = [pred == label for pred, label in zip(preds, labels)]
+            num_wrong_hypotheses = len(correct) - sum(correct)
+            hypotheses_bank.record_results(
+                top_k_hypotheses,
+                correct,
+                current_sample,
+                self.alpha,
+                example_idx=i,
+                labels=labels,
+            )
 
             # if we get enough wrong examples
             if (
@@ -141,32 +148,37 @@ class SamplingUpdate(Update):
                 ):
                     new_hyp_bank = {}
 
-                    # generate new hypotheses
-                    for _ in range(self.num_hypotheses_to_update):
-                        # TODO: batched?
-                        new_hypotheses = (
-                            self.generation_class.batched_hypothesis_generation(
-                                wrong_example_ids,
-                                current_sample,
-                                self.update_hypotheses_per_batch,
-                                self.alpha,
-                                cache_seed=cache_seed,
-                                max_concurrent=max_concurrent,
-                            )
-                        )
-
-                        max_visited = max(
-                            hypotheses_bank, key=lambda x: hypotheses_bank[x].num_visits
-                        )
-                        new_hypotheses = self.balance_by_sample(
-                            new_hypotheses,
+                    # generate new hypotheses, with the requests of all rounds sent together
+                    new_hypotheses_rounds = (
+                        self.generation_class.batched_hypothesis_generation_rounds(
+                            wrong_example_ids,
                             current_sample,
-                            hypotheses_bank[max_visited].num_visits,
-                            self.num_init,
+                            self.update_hypotheses_per_batch,
                             self.alpha,
+                            self.num_hypotheses_to_update,
                             cache_seed=cache_seed,
-                            **generate_kwargs,
+                            max_concurrent=max_concurrent,
                         )
+                    )
+
+                    # balance the hypotheses of all rounds in one batch of predictions
+                    balanced_hypotheses = {}
+                    for new_hypotheses in new_hypotheses_rounds:
+                        balanced_hypotheses.update(new_hypotheses)
+                    balanced_hypotheses = self.balance_by_sample(
+                        balanced_hypotheses,
+                        current_sample,
+                        int(hypotheses_bank.num_visits.max()),
+                        self.num_init,
+                        self.alpha,
+                        cache_seed=cache_seed,
+                        **generate_kwargs,
+                    )
+
+                    for new_hypotheses in new_hypotheses_rounds:
+                        new_hypotheses = {
+                            hyp: balanced_hypotheses[hyp] for hyp in new_hypotheses
+                        }
                         if self.only_best_hypothesis:
                             best_hypothesis = max(
                                 new_hypotheses, key=lambda x: new_hypotheses[x].reward
@@ -195,7 +207,21 @@ class SamplingUpdate(Update):
                     seed=current_seed,
                     epoch=current_epoch,
                 )
+                self.save_checkpoint(
+                    hypotheses_bank,
+                    i + 1,
+                    wrong_example_ids,
+                    current_epoch,
+                    current_seed,
+                )
 
+        self.save_checkpoint(
+            hypotheses_bank,
+            num_train_examples,
+            wrong_example_ids,
+            current_epoch,
+            current_seed,
+        )
         return hypotheses_bank
 
     def balance_by_sample(
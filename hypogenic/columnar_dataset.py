@@ -0,0 +1,205 @@
+""" Columnar, memory-mapped storage of the JSON data splits """
+
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from .logger_config import LoggerConfig
+
+logger_name = "HypoGenic - ColumnarDataset"
+
+# bump when the on-disk layout changes, so old caches are not read
+FORMAT_VERSION = 1
+
+_loaded_datasets: Dict[tuple, "ColumnarDataset"] = {}
+_loaded_datasets_lock = threading.Lock()
+
+
+def file_sha256(file_path: str, chunk_size=1 << 24) -> str:
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _column_kind(values: List) -> str:
+    """
+    How a column is stored: "int", "float" and "bool" as NumPy arrays, "str" as UTF-8 bytes
+    with offsets, and anything else ("json") as JSON-encoded strings. Mixed columns, e.g.
+    ints and floats, keep each value's type, since pandas infers the dtype from the sampled rows.
+    """
+    types = set(type(value) for value in values)
+    if types == {bool}:
+        return "bool"
+    if types == {int}:
+        if all(-(2**63) <= value < 2**63 for value in values):
+            return "int"
+        return "json"
+    if types == {float}:
+        return "float"
+    if types == {str}:
+        return "str"
+    return "json"
+
+
+class ColumnarDataset:
+    """
+    A JSON data split (`{column: [values]}`) converted once into NumPy files and memory-mapped.
+
+    Numeric and boolean columns are stored as arrays. Strings are stored as one UTF-8 byte
+    array plus row offsets, so reading a row only touches its own bytes. The conversion is
+    cached under the SHA-256 of the JSON file, so a changed file is converted again.
+
+    Typical usage example:
+
+      dataset = ColumnarDataset.from_json("./data/hotel_reviews/train.json", "./.hypogenic_data")
+      random.seed(49)
+      df = dataset.sample(200)
+    """
+
+    def __init__(self, path: str):
+        """
+        Parameters:
+            path: Directory written by `convert`
+        """
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        self.columns = meta["columns"]
+        self.arrays = []
+        for idx, column in enumerate(self.columns):
+            if column["kind"] in ["str", "json"]:
+                self.arrays.append(
+                    (
+                        np.load(os.path.join(path, f"{idx}.npy"), mmap_mode="r"),
+                        np.load(os.path.join(path, f"{idx}.offsets.npy"), mmap_mode="r"),
+                    )
+                )
+            else:
+                self.arrays.append(
+                    np.load(os.path.join(path, f"{idx}.npy"), mmap_mode="r")
+                )
+
+    @staticmethod
+    def convert(json_path: str, path: str):
+        """Converts the JSON split at `json_path` into the directory `path`."""
+        with open(json_path, "r") as f:
+            data = json.load(f)
+
+        columns = []
+        for idx, (name, values) in enumerate(data.items()):
+            kind = _column_kind(values)
+            columns.append({"name": name, "kind": kind, "length": len(values)})
+            if kind in ["str", "json"]:
+                encoded = [
+                    (value if kind == "str" else json.dumps(value)).encode("utf-8")
+                    for value in values
+                ]
+                offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+                np.cumsum([len(value) for value in encoded], out=offsets[1:])
+                np.save(
+                    os.path.join(path, f"{idx}.npy"),
+                    np.frombuffer(b"".join(encoded), dtype=np.uint8),
+                )
+                np.save(os.path.join(path, f"{idx}.offsets.npy"), offsets)
+            else:
+                dtype = {"int": np.int64, "float": np.float64, "bool": np.bool_}[kind]
+                np.save(os.path.join(path, f"{idx}.npy"), np.array(values, dtype=dtype))
+
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"version": FORMAT_VERSION, "columns": columns}, f)
+
+    @classmethod
+    def from_json(cls, json_path: str, cache_dir: str) -> "ColumnarDataset":
+        """
+        Returns the columnar version of the JSON split at `json_path`, converting it into
+        `cache_dir` the first time. Datasets already opened in this process are reused as
+        long as the file's size and modification time do not change.
+        """
+        logger = LoggerConfig.get_logger(logger_name)
+        stat = os.stat(json_path)
+        memo_key = (os.path.abspath(json_path), stat.st_size, stat.st_mtime_ns)
+        with _loaded_datasets_lock:
+            if memo_key in _loaded_datasets:
+                return _loaded_datasets[memo_key]
+
+        path = os.path.join(cache_dir, f"v{FORMAT_VERSION}-{file_sha256(json_path)}")
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            logger.info(f"Converting {json_path} to columnar format in {path}")
+            os.makedirs(cache_dir, exist_ok=True)
+            # convert into a temporary directory and rename it, so a crash never leaves a partial cache
+            temp_path = tempfile.mkdtemp(dir=cache_dir, suffix=".tmp")
+            try:
+                cls.convert(json_path, temp_path)
+                os.rename(temp_path, path)
+            except OSError:
+                # another process finished the same conversion first
+                if not os.path.exists(os.path.join(path, "meta.json")):
+                    raise
+            finally:
+                shutil.rmtree(temp_path, ignore_errors=True)
+
+        dataset = cls(path)
+        with _loaded_datasets_lock:
+            _loaded_datasets[memo_key] = dataset
+        return dataset
+
+    def __len__(self):
+        # like zip(*columns), rows only go up to the shortest column
+        return min(column["length"] for column in self.columns)
+
+    def _read_column(self, idx: int, indices: np.ndarray):
+        kind = self.columns[idx]["kind"]
+        if kind not in ["str", "json"]:
+            return np.asarray(self.arrays[idx][indices])
+
+        data, offsets = self.arrays[idx]
+        starts = np.asarray(offsets[indices])
+        ends = np.asarray(offsets[indices + 1])
+        values = [
+            data[start:end].tobytes().decode("utf-8")
+            for start, end in zip(starts.tolist(), ends.tolist())
+        ]
+        if kind == "json":
+            values = [json.loads(value) for value in values]
+        return values
+
+    def take(self, indices: List[int]) -> pd.DataFrame:
+        """Reads the rows at `indices`, in that order, into a DataFrame."""
+        if len(indices) == 0:
+            # matches building the DataFrame from zero zipped rows
+            return pd.DataFrame.from_dict({})
+        indices = np.asarray(indices, dtype=np.int64)
+        return pd.DataFrame.from_dict(
+            {
+                column["name"]: self._read_column(idx, indices)
+                for idx, column in enumerate(self.columns)
+            }
+        )
+
+    def sample_indices(self, num: Optional[int] = None, label_column="label") -> List[int]:
+        """
+        Samples the indices of `num` rows (all rows if `None`) in random order with the
+        `random` module.
+
+        Draws the same rows, in the same order, as sampling the list of row tuples of the
+        JSON split with the same random state, without building the tuples.
+        """
+        lengths = {column["name"]: column["length"] for column in self.columns}
+        num_labels = lengths[label_column]
+        num_samples = num_labels if num is None else min(num, num_labels)
+        # random.sample only uses the population through its length and indexing
+        return random.sample(range(len(self)), num_samples)
+
+    def sample(self, num: Optional[int] = None, label_column="label") -> pd.DataFrame:
+        """Reads the rows chosen by `sample_indices` into a DataFrame."""
+        return self.take(self.sample_indices(num, label_column))
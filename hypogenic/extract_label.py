@@ -1,9 +1,51 @@
+import logging
 import re
+import threading
+from typing import Callable, Iterable
 from .register import Register
 from .logger_config import LoggerConfig
 
 extract_label_register = Register("extract_label")
 
+_extraction_state = threading.local()
+
+
+class _QuietExtractionFilter(logging.Filter):
+    """Drops extraction warnings while a stop predicate looks at a partial response."""
+
+    def filter(self, record):
+        return not getattr(_extraction_state, "quiet", False)
+
+
+logging.getLogger("extract_label").addFilter(_QuietExtractionFilter())
+
+
+def label_stop_predicate(
+    extract_label: Callable[[str], str],
+    unknown_labels: Iterable[str] = ("other", "conflict"),
+) -> Callable[[str], bool]:
+    """
+    Builds a stop predicate for streamed responses from a label extractor: a response can be
+    cut off as soon as the text generated so far contains a label.
+
+    Extractors return the last label in a response, so a response stopped at its first label
+    only gives a different label if the model would have changed its answer later on.
+
+    Parameters:
+        extract_label: Extracts the label from a response, e.g. `BaseTask.extract_label`
+        unknown_labels: What the extractor returns when there is no label (yet)
+    """
+    unknown_labels = set(unknown_labels)
+
+    def stop_predicate(text: str) -> bool:
+        _extraction_state.quiet = True
+        try:
+            return extract_label(text) not in unknown_labels
+        finally:
+            _extraction_state.quiet = False
+
+    return stop_predicate
+
 
 @extract_label_register.register("default")
 def default_extract_label(text):
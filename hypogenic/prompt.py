@@ -1,8 +1,9 @@
 from abc import ABC, abstractmethod
 import os
 import textwrap
+import weakref
 from string import Template
-from typing import List, Tuple, Union, Dict
+from typing import Any, List, Tuple, Union, Dict
 from copy import deepcopy
 import pandas as pd
 
@@ -12,6 +13,72 @@ from hypogenic.logger_config import LoggerConfig
 
 logger = LoggerConfig.get_logger("Prompt")
 
+
+class CompiledTemplate:
+    """
+    A prompt template (a string, or a list or dictionary of them) parsed once.
+
+    Strings are split into literal text and placeholder names up front, so rendering is a
+    join instead of a regular expression pass, and `keys` lists the placeholders without
+    rescanning the template. Rendering gives the same result, and raises the same errors,
+    as `string.Template.substitute`.
+    """
+
+    def __init__(self, template: Union[str, List, Dict]):
+        self.template = template
+        self.keys = []
+        self.compiled = self._compile(template)
+
+    def _compile(self, template):
+        if isinstance(template, str):
+            # parts alternate literal text and placeholder names: literal, name, literal, ...
+            parts = [""]
+            position = 0
+            for match in Template.pattern.finditer(template):
+                if match.group("invalid") is not None:
+                    # keep the string, so that string.Template raises its error when rendering
+                    return template
+                parts[-1] += template[position : match.start()]
+                position = match.end()
+                if match.group("escaped") is not None:
+                    parts[-1] += match.group("escaped")
+                    continue
+                name = match.group("named") or match.group("braced")
+                if name not in self.keys:
+                    self.keys.append(name)
+                parts.extend([name, ""])
+            parts[-1] += template[position:]
+            return tuple(parts)
+        elif isinstance(template, list):
+            return [self._compile(item) for item in template]
+        elif isinstance(template, dict):
+            return {key: self._compile(value) for key, value in template.items()}
+        else:
+            raise ValueError(f"Invalid template type {type(template)}")
+
+    def _substitute(self, compiled, mapping):
+        if isinstance(compiled, tuple):
+            if len(compiled) == 1:
+                return compiled[0]
+            return "".join(
+                part if idx % 2 == 0 else str(mapping[part])
+                for idx, part in enumerate(compiled)
+            )
+        elif isinstance(compiled, str):
+            return Template(compiled).substitute(mapping)
+        elif isinstance(compiled, list):
+            return [self._substitute(item, mapping) for item in compiled]
+        else:
+            return {key: self._substitute(value, mapping) for key, value in compiled.items()}
+
+    def substitute(self, mapping: Dict[str, Any]):
+        return self._substitute(self.compiled, mapping)
+
+    def substitute_item(self, key, mapping: Dict[str, Any]):
+        """Renders only `template[key]` of a dictionary template."""
+        return self._substitute(self.compiled[key], mapping)
+
+
 class BasePrompt(ABC):
     """
     This class gives us a way to conviniently generate prompts.
@@ -93,11 +160,83 @@ class BasePrompt(ABC):
             raise ValueError(f"Invalid template type {type(template_str)}")
         return list(keys)
 
+    def _compiled_template(self, key: str, as_messages=False) -> CompiledTemplate:
+        """
+        Returns `self.task.prompt_template[key]` (as messages if `as_messages`) compiled.
+
+        Templates are compiled on first use and recompiled if the task's template is replaced.
+        """
+        # set up here rather than in __init__, since subclasses may not call it
+        cache = self.__dict__.setdefault("_compiled_templates", {})
+        template = self.task.prompt_template[key]
+        source, compiled = cache.get((key, as_messages), (None, None))
+        if source is not template:
+            compiled = CompiledTemplate(
+                self._convert_to_messages(key) if as_messages else template
+            )
+            cache[(key, as_messages)] = (template, compiled)
+        return compiled
+
+    @staticmethod
+    def _data_signature(data: pd.DataFrame):
+        """
+        Cheap check that `data` was not changed since rows were extracted from it. Replacing its
+        index or a column (e.g. `data["text"] = ...`) changes it, writing single cells in place
+        (e.g. `data.loc[idx, "text"] = ...`) does not; call `clear_data_cache` after those.
+        """
+        return (
+            data.shape,
+            tuple(data.columns),
+            id(data.index),
+            tuple(id(block.values) for block in data._mgr.blocks),
+        )
+
+    def clear_data_cache(self):
+        """Forgets the rows extracted from DataFrames, e.g. after changing their cells in place."""
+        self.__dict__.pop("_row_cache", None)
+        self.__dict__.pop("_adaptive_info_cache", None)
+
+    def _data_rows(self, data: pd.DataFrame):
+        """
+        Returns a dictionary from index label to row dictionary of `data`, extracted in bulk
+        once per DataFrame, or `None` if rows have to be read one by one. Rows are extracted
+        again when `data` changes, see `_data_signature`.
+        """
+        cache = self.__dict__.setdefault("_row_cache", {})
+        signature = self._data_signature(data)
+        entry = cache.get(id(data))
+        if entry is not None and entry[0]() is data and entry[1] == signature:
+            return entry[2]
+
+        if not data.index.is_unique:
+            rows = None
+        elif len(data) == 0:
+            rows = {}
+        else:
+            # `data.loc[idx]` casts a row to the common dtype of the columns, e.g. ints to
+            # floats next to a float column, so records are cast the same way
+            row_dtype = data.iloc[0].dtype
+            if row_dtype != object and any(dtype != row_dtype for dtype in data.dtypes):
+                data_as_rows = data.astype(row_dtype)
+            else:
+                data_as_rows = data
+            rows = dict(zip(data.index, data_as_rows.to_dict("records")))
+
+        key = id(data)
+        cache[key] = (
+            weakref.ref(data, lambda _: cache.pop(key, None)),
+            signature,
+            rows,
+        )
+        return rows
+
     def _get_substitute_dict(
         self, data_dict: pd.DataFrame, example_idx
     ) -> Dict[str, str]:
-        substitute_dict = data_dict.loc[example_idx].to_dict()
-        return substitute_dict
+        rows = self._data_rows(data_dict)
+        if rows is None:
+            return data_dict.loc[example_idx].to_dict()
+        return dict(rows[example_idx])
 
     def _substitute_obj(
         self, substitute_dict: Dict[str, str], obj: Union[str, List, Dict]
@@ -112,8 +251,9 @@ class BasePrompt(ABC):
     def _information_prompt(
         self, substitute_dict: Dict[str, str], info_key: str
     ) -> Dict[str, str]:
-        prompt = self._convert_to_messages(info_key)
-        return self._substitute_obj(substitute_dict, prompt)
+        return self._compiled_template(info_key, as_messages=True).substitute(
+            substitute_dict
+        )
 
     def _get_prompt_template(self, key: str) -> Union[str, List[Dict[str, str]], Dict]:
         return deepcopy(self.task.prompt_template[key])
@@ -132,20 +272,91 @@ class BasePrompt(ABC):
         prompt_key: str,
     ):
         substitute_dict = init_dict
-        keys = self._get_substitute_key(self._get_prompt_template(prompt_key))
+        keys = self._compiled_template(prompt_key).keys
         keys = [key for key in keys if key not in substitute_dict]
 
         for key in keys:
-            if self._is_multi_content(self._get_prompt_template(key)):
-                substitute_dict[key] = self._fill_multi_content(
-                    ({}, multi_sub_dicts[key]),
-                    self._get_prompt_template(key),
+            template = self.task.prompt_template[key]
+            if self._is_multi_content(template):
+                substitute_dict[key] = self._render_multi_content(
+                    key, multi_sub_dicts[key]
                 )
             else:
-                substitute_dict[key] = self._get_prompt_template(key)
+                substitute_dict[key] = deepcopy(template)
 
         return substitute_dict
 
+    def _render_multi_content(self, key: str, substitute_dicts: List[Dict]) -> str:
+        """
+        Compiled equivalent of `self._fill_multi_content(({}, substitute_dicts), template)`
+        for the multi content template `key`.
+        """
+        template = self.task.prompt_template[key]
+        if not isinstance(template["multi_content"], str):
+            return self._fill_multi_content(({}, substitute_dicts), template)
+        if len(substitute_dicts) == 0:
+            return ""
+
+        compiled = self._compiled_template(key)
+        res = ""
+        if "prefix" in template:
+            res += compiled.substitute_item("prefix", {})
+        res += "".join(
+            compiled.substitute_item(
+                "multi_content", {"idx": idx + 1, **substitute_dict}
+            )
+            for idx, substitute_dict in enumerate(substitute_dicts)
+        )
+        if "suffix" in template:
+            res += compiled.substitute_item("suffix", {})
+        return res
+
+    def _adaptive_info_dicts(self, hypotheses_dict, train_data: pd.DataFrame):
+        """
+        Substitute dictionaries of `adaptive_info_prompt` for every hypothesis.
+
+        They only depend on the hypotheses and their correct examples, so the result for the
+        last hypotheses bank is kept and reused for every test example.
+        """
+        signature = (
+            self._data_signature(train_data),
+            tuple(
+                (
+                    hypothesis_class.hypothesis,
+                    tuple(example_info[0] for example_info in hypothesis_class.correct_examples),
+                )
+                for hypothesis_class in hypotheses_dict.values()
+            ),
+        )
+        cached = self.__dict__.get("_adaptive_info_cache")
+        if cached is not None and cached[0]() is train_data and cached[1] == signature:
+            return cached[2]
+
+        hyp_substitute_dicts = []
+        for hyp_idx, (hypothesis_text, example_indices) in enumerate(signature[1]):
+            hyp_substitute_dict = {
+                "hypothesis_text": hypothesis_text,
+                "idx": hyp_idx + 1,
+            }
+            observations_dict = {
+                "observations": [
+                    self._get_substitute_dict(train_data, example_idx)
+                    for example_idx in example_indices
+                ]
+            }
+            hyp_substitute_dicts.append(
+                self._fill_multi_in_sub_dict(
+                    hyp_substitute_dict, observations_dict, "adaptive_info_prompt"
+                )
+            )
+
+        self._adaptive_info_cache = (
+            weakref.ref(train_data),
+            signature,
+            hyp_substitute_dicts,
+        )
+        return hyp_substitute_dicts
+
     def few_shot_baseline(
         self, train_data: pd.DataFrame, num_few_shot, test_data, test_idx
     ):
@@ -201,6 +412,50 @@ class BasePrompt(ABC):
 
         return prompt
 
+    def scoring_inference(
+        self, hypotheses_dict, test_data, test_idx, label_options: str
+    ):
+        """
+        Inference prompt that asks for only the letter of the predicted label.
+
+        Uses the `scoring_inference` template if the task has one, where `${label_options}`
+        is replaced by the lettered labels. The `inference` template asks the model to reason
+        before its final answer, so it is not reused. Without the template, the prompt lists
+        the fields of the example other than its label.
+        """
+        hypothesis = list(hypotheses_dict.keys())[0]
+
+        substitute_dict = self._get_substitute_dict(test_data, test_idx)
+        if "scoring_inference" not in self.task.prompt_template:
+            example = "\n".join(
+                f"{key}: {value}"
+                for key, value in substitute_dict.items()
+                if key != "label"
+            )
+            return [
+                {
+                    "role": "system",
+                    "content": f"You are an expert in the {self.task.task_name} task. "
+                    + "Given a hypothesis about the task and an example, choose the label of the example "
+                    + "from a list of options, based on the hypothesis. "
+                    + "Answer with only the letter of the option, without any explanation.",
+                },
+                {
+                    "role": "user",
+                    "content": f"Hypothesis: {hypothesis}\n\n"
+                    + f"{example}\n\n"
+                    + f"Options:\n{label_options}\n\n"
+                    + "Answer with only the letter of the correct option.",
+                },
+            ]
+
+        substitute_dict["hypothesis"] = hypothesis
+        substitute_dict["label_options"] = label_options
+
+        prompt = self._information_prompt(substitute_dict, "scoring_inference")
+
+        return prompt
+
     def one_step_adaptive_inference(
         self, hypotheses_dict, train_data, test_data, test_idx
     ):
@@ -210,28 +465,11 @@ class BasePrompt(ABC):
 
         substitute_dict = self._get_substitute_dict(test_data, test_idx)
 
-        multi_sub_dicts = {"adaptive_info_prompt": []}
-        hyp_idx = 0
-        for _, hypothesis_class in hypotheses_dict.items():
-            hypothesis_related_examples = hypothesis_class.correct_examples
-            hyp_substitute_dict = {
-                "hypothesis_text": hypothesis_class.hypothesis,
-                "idx": hyp_idx + 1,
-            }
-            observations_dict = {"observations": []}
-            for example_info in hypothesis_related_examples:
-                observations_dict["observations"].append(
-                    self._get_substitute_dict(train_data, example_info[0])
-                )
-            
-            hyp_substitute_dict = self._fill_multi_in_sub_dict(
-                hyp_substitute_dict, observations_dict, "adaptive_info_prompt"
-            )
-            multi_sub_dicts["adaptive_info_prompt"].append(
-                hyp_substitute_dict
+        multi_sub_dicts = {
+            "adaptive_info_prompt": self._adaptive_info_dicts(
+                hypotheses_dict, train_data
             )
-            hyp_idx += 1
-
+        }
         substitute_dict = self._fill_multi_in_sub_dict(
             substitute_dict, multi_sub_dicts, "adaptive_inference"
         )
@@ -249,28 +487,11 @@ class BasePrompt(ABC):
 
         substitute_dict = self._get_substitute_dict(test_data, test_idx)
 
-        multi_sub_dicts = {"adaptive_info_prompt": []}
-        hyp_idx = 0
-        for _, hypothesis_class in hypotheses_dict.items():
-            hypothesis_related_examples = hypothesis_class.correct_examples
-            hyp_substitute_dict = {
-                "hypothesis_text": hypothesis_class.hypothesis,
-                "idx": hyp_idx + 1,
-            }
-            observations_dict = {"observations": []}
-            for example_info in hypothesis_related_examples:
-                observations_dict["observations"].append(
-                    self._get_substitute_dict(train_data, example_info[0])
-                )
-            
-            hyp_substitute_dict = self._fill_multi_in_sub_dict(
-                hyp_substitute_dict, observations_dict, "adaptive_info_prompt"
+        multi_sub_dicts = {
+            "adaptive_info_prompt": self._adaptive_info_dicts(
+                hypotheses_dict, train_data
             )
-            multi_sub_dicts["adaptive_info_prompt"].append(
-                hyp_substitute_dict
-            )
-            hyp_idx += 1
-
+        }
         substitute_dict = self._fill_multi_in_sub_dict(
             substitute_dict, multi_sub_dicts, "adaptive_selection"
         )
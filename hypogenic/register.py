@@ -1,3 +1,5 @@
+import importlib
+
 from .logger_config import LoggerConfig
 
 logger_name = "HypoGenic - Register"
@@ -15,6 +17,15 @@ class Register:
 
         return decorator
 
+    def register_lazy(self, key: str, target: str):
+        """
+        Registers an entry by its import path ("package.module:attribute").
+
+        The module is only imported when the entry is built, so entries with heavy
+        dependencies cost nothing until they are used.
+        """
+        self.entries[key] = target
+
     def build(self, type: str):
         logger = LoggerConfig.get_logger(logger_name)
         if type not in self.entries and "default" not in self.entries:
@@ -25,4 +36,10 @@ class Register:
             logger.warning(
                 f"Entry {type} not found in registry {self.name}. Using default entry."
             )
-        return self.entries[type] if type in self.entries else self.entries["default"]
+            type = "default"
+        if isinstance(self.entries[type], str):
+            module_name, attribute = self.entries[type].split(":")
+            self.entries[type] = getattr(
+                importlib.import_module(module_name), attribute
+            )
+        return self.entries[type]
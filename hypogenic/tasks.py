@@ -1,12 +1,14 @@
 from abc import ABC, abstractmethod
 import yaml
 import json
+import math
 import os
 import random
 import re
-from typing import Callable, Tuple, Union
+from typing import Callable, Iterator, List, Tuple, Union
 import pandas as pd
 from .register import Register
+from .columnar_dataset import ColumnarDataset
 
 
 class BaseTask(ABC):
@@ -21,7 +23,17 @@ class BaseTask(ABC):
         config_path: str,
         extract_label: Union[Callable[[str], str], None] = None,
         from_register: Union[Register, None] = None,
+        data_cache_dir: Union[str, None] = None,
     ):
+        """
+        Parameters:
+            config_path: Path to the task config.yaml file
+            extract_label: Function that extracts the label from a response
+            from_register: Register to build `extract_label` from by task name, if `extract_label` is not given
+            data_cache_dir: If given, data splits are converted once into a memory-mapped columnar
+                format in this directory, and `get_data` samples from it instead of loading the JSON files.
+                The sampled rows are the same.
+        """
         if from_register is None and extract_label is None:
             raise ValueError("Either from_register or extract_label should be provided")
 
@@ -33,6 +45,7 @@ class BaseTask(ABC):
             data = yaml.safe_load(f)
 
         self.task_name = data["task_name"]
+        self.data_cache_dir = data_cache_dir
 
         # data paths
         self.train_data_path = data["train_data_path"]
@@ -52,44 +65,90 @@ class BaseTask(ABC):
             else from_register.build(self.task_name)
         )
 
-    def get_data(
-        self, num_train, num_test, num_val, seed=49
-    ) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
-        """
-        Loading the data from the paths we collected in the yaml file
+    def _sample_split(
+        self, split: str, num, seed=49
+    ) -> Tuple[List[int], Callable[[List[int]], pd.DataFrame]]:
         """
+        Samples the rows of a split ("train", "test" or "val") in random order.
 
-        # ----------------------------------------------------------------------
-        # define our function to read data
-        # ----------------------------------------------------------------------
-        def read_data(file_path, num, is_train=False):
-            # Read from json
-            file_path = os.path.join(os.path.dirname(self.config_path), file_path)
-            with open(file_path, "r") as f:
-                data = json.load(f)
-            # shuffle and subsample from data
-            if not is_train:
+        Returns:
+            indices: Sampled row indices
+            take: Function reading rows by index into a DataFrame
+        """
+        file_path = {
+            "train": self.train_data_path,
+            "test": self.test_data_path,
+            "val": self.val_data_path,
+        }[split]
+        file_path = os.path.join(os.path.dirname(self.config_path), file_path)
+        if self.data_cache_dir is not None:
+            dataset = ColumnarDataset.from_json(file_path, self.data_cache_dir)
+            if split != "train":
                 random.seed(seed)
+            return dataset.sample_indices(num), dataset.take
 
-            if num is None:
-                num_samples = len(data["label"])
-            else:
-                num_samples = min(num, len(data["label"]))
+        # Read from json
+        with open(file_path, "r") as f:
+            data = json.load(f)
+        # shuffle and subsample from data
+        if split != "train":
+            random.seed(seed)
 
-            sampled_data = zip(
-                *random.sample(list(zip(*list(data.values()))), num_samples)
-            )
+        if num is None:
+            num_samples = len(data["label"])
+        else:
+            num_samples = min(num, len(data["label"]))
+
+        rows = list(zip(*list(data.values())))
+
+        def take(indices):
+            sampled_data = zip(*[rows[idx] for idx in indices])
             processed_data = {
                 key: value for key, value in zip(data.keys(), sampled_data)
             }
             return pd.DataFrame.from_dict(processed_data)
 
-        # ----------------------------------------------------------------------
-        # use that function ot create our test sets
-        # ----------------------------------------------------------------------
+        # random.sample only uses the population through its length and indexing,
+        # so this draws the same rows as sampling `rows` itself
+        return random.sample(range(len(rows)), num_samples), take
 
-        train_data = read_data(self.train_data_path, num_train, is_train=True)
-        test_data = read_data(self.test_data_path, num_test)
-        val_data = read_data(self.val_data_path, num_val)
+    def get_split(self, split: str, num, seed=49) -> pd.DataFrame:
+        """
+        Loads a single split ("train", "test" or "val"), sampled the same way as in `get_data`.
+        The training split is sampled with the current random state, like in `get_data`.
+        """
+        indices, take = self._sample_split(split, num, seed)
+        return take(indices)
+
+    def get_data_chunks(
+        self, split: str, num, seed=49, chunk_size=1000, start_chunk=0
+    ) -> Iterator[Tuple[int, pd.DataFrame]]:
+        """
+        Yields the rows `get_split` would return in chunks of `chunk_size` rows, each
+        indexed from 0, starting from chunk `start_chunk`.
+
+        With `data_cache_dir` set, only the sampled indices and the current chunk are held in
+        memory. Otherwise the JSON file is still read whole, but only one chunk is a DataFrame
+        at a time.
+
+        Yields:
+            chunk_idx: Position of the chunk, the first row of chunk `i` is row `i * chunk_size`
+            data: The rows of the chunk
+        """
+        indices, take = self._sample_split(split, num, seed)
+        for chunk_idx in range(start_chunk, math.ceil(len(indices) / chunk_size)):
+            yield chunk_idx, take(
+                indices[chunk_idx * chunk_size : (chunk_idx + 1) * chunk_size]
+            )
+
+    def get_data(
+        self, num_train, num_test, num_val, seed=49
+    ) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        """
+        Loading the data from the paths we collected in the yaml file
+        """
+        train_data = self.get_split("train", num_train, seed)
+        test_data = self.get_split("test", num_test, seed)
+        val_data = self.get_split("val", num_val, seed)
 
         return train_data, test_data, val_data
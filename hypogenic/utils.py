@@ -1,30 +1,14 @@
 from abc import ABC, abstractmethod
 import pickle
 import math
+import sys
 from typing import Dict, List
-import torch
 import re
 import os
 import numpy as np
 import random
-import openai
-
-import vllm
 import asyncio
 import tqdm
-from openai import AsyncOpenAI, OpenAI
-from anthropic import AsyncAnthropic, Anthropic
-
-from sklearn.metrics import accuracy_score, f1_score
-
-from transformers import (
-    LlamaForCausalLM,
-    LlamaTokenizer,
-    LlamaConfig,
-    AutoModelForCausalLM,
-    AutoTokenizer,
-    pipeline,
-)
 from pprint import pprint
 
 from .LLM_cache import ClaudeAPICache, LocalModelAPICache, OpenAIAPICache
@@ -38,18 +22,41 @@ def get_results(pred_list, label_list):
     """
     Compute accuracy and F1 score for multi-class classification
     """
+    # imported here so that importing hypogenic does not load scikit-learn
+    from sklearn.metrics import accuracy_score, f1_score
+
     accuracy = accuracy_score(label_list, pred_list)
     f1 = f1_score(label_list, pred_list, average="macro")
 
     return {"accuracy": accuracy, "f1": f1}
 
 
+# seed of a set_seed call made before torch was imported, applied by seed_torch
+_pending_torch_seed = None
+
+
 def set_seed(seed):
+    global _pending_torch_seed
     logger = LoggerConfig.get_logger(logger_name)
     logger.info(f"Setting seed to {seed}")
     random.seed(seed)
-    torch.manual_seed(seed)
     np.random.seed(seed)
+    # torch is not imported here, to keep it out of runs with API models; if it is not
+    # loaded yet, local model wrappers seed it when they import it
+    _pending_torch_seed = seed
+    seed_torch()
+
+
+def seed_torch():
+    """
+    Seeds torch with the seed of the last `set_seed` call, if torch is imported and was not
+    seeded with it yet.
+    """
+    global _pending_torch_seed
+    if _pending_torch_seed is not None and "torch" in sys.modules:
+        sys.modules["torch"].manual_seed(_pending_torch_seed)
+        _pending_torch_seed = None
+
 
 def adjust_label(preds, labels):
     preds_out = []
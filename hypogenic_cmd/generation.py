@@ -51,7 +51,8 @@ def parse_args():
         "--old_hypothesis_file",
         type=str,
         default=None,
-        help="Path to the old hypothesis file to restart from.",
+        help="Path to the old hypothesis file to restart from. "
+        + "Ignored, with a warning, when an update checkpoint is resumed.",
     )
     parser.add_argument(
         "--num_init",
@@ -70,6 +71,12 @@ def parse_args():
     )
 
     parser.add_argument("--seed", type=int, default=49, help="Random seed.")
+    parser.add_argument(
+        "--data_cache_dir",
+        type=str,
+        default=None,
+        help="If set, data splits are converted once into a memory-mapped columnar format in this directory and sampled from there.",
+    )
 
     parser.add_argument(
         "--file_name_template",
@@ -131,6 +138,26 @@ def parse_args():
         default=10,
         help="Save hypotheses every n examples visited.",
     )
+    parser.add_argument(
+        "--lookahead_window",
+        type=int,
+        default=1,
+        help="Number of upcoming training examples the top hypotheses are evaluated on in one batch during the update. "
+        + "Gives the same hypotheses as 1, with fewer, larger API rounds. Needs the default inference style.",
+    )
+    parser.add_argument(
+        "--keep_checkpoints",
+        type=int,
+        default=2,
+        help="Number of most recent update checkpoints to keep in the output folder. 0 disables checkpointing.",
+    )
+    parser.add_argument(
+        "--no_resume",
+        action="store_true",
+        default=False,
+        help="Start from scratch even if the output folder has an update checkpoint for this seed. "
+        + "Checkpoints are only resumed with the settings they were saved with.",
+    )
 
     parser.add_argument(
         "--init_batch_size",
@@ -157,6 +184,45 @@ def parse_args():
         default=6832,
         help="Port for the redis server for LLM caching.",
     )
+    parser.add_argument(
+        "--cache_backend",
+        type=str,
+        default="redis",
+        choices=["redis", "sqlite"],
+        help="Storage backend for LLM caching. `sqlite` uses a local file and needs no server.",
+    )
+    parser.add_argument(
+        "--cache_path",
+        type=str,
+        default="./.hypogenic_cache.sqlite",
+        help="Path to the cache file when using the sqlite cache backend.",
+    )
+    parser.add_argument(
+        "--cache_lru_size",
+        type=int,
+        default=0,
+        help="Number of cache entries to keep in process memory. 0 disables the in-process cache.",
+    )
+    parser.add_argument(
+        "--cache_key_mode",
+        type=str,
+        default="migrate",
+        choices=["v1", "legacy", "migrate"],
+        help="Cache key scheme. `migrate` uses the new keys and falls back to (and migrates) entries written with the legacy keys.",
+    )
+    parser.add_argument(
+        "--cache_compression",
+        type=str,
+        default=None,
+        choices=["zstd", "zlib"],
+        help="Compress cached responses. `zstd` requires the `zstandard` package.",
+    )
+    parser.add_argument(
+        "--verify_cache",
+        action="store_true",
+        default=False,
+        help="Store full prompts in the cache and check them for equality on every hit.",
+    )
     parser.add_argument(
         "--generation_style",
         type=str,
@@ -238,18 +304,34 @@ def main():
     from hypogenic.algorithm.update import update_register, Update
     from hypogenic.logger_config import LoggerConfig
 
-    LoggerConfig.setup_logger(args.log_file, args.log_level)
+    LoggerConfig.setup_logger(level=args.log_level, log_file_path=args.log_file)
 
     logger = LoggerConfig.get_logger("HypoGenic")
 
-    task = BaseTask(args.task_config_path, from_register=extract_label_register)
+    task = BaseTask(
+        args.task_config_path,
+        from_register=extract_label_register,
+        data_cache_dir=args.data_cache_dir,
+    )
 
     if args.output_folder is None:
         args.output_folder = f"./outputs/{task.task_name}/{args.model_name}/hyp_{args.max_num_hypotheses}/"
 
     os.makedirs(args.output_folder, exist_ok=True)
+    redis_kwargs = {
+        "cache_backend": args.cache_backend,
+        "lru_cache_size": args.cache_lru_size,
+        "cache_key_mode": args.cache_key_mode,
+        "cache_compression": args.cache_compression,
+        "verify_cache": args.verify_cache,
+    }
+    if args.cache_backend == "sqlite":
+        redis_kwargs["cache_path"] = args.cache_path
     api = llm_wrapper_register.build(args.model_type)(
-        args.model_name, args.model_path, port=args.port
+        args.model_name,
+        path_name=args.model_path,
+        port=args.port,
+        redis_kwargs=redis_kwargs,
     )
 
     set_seed(args.seed)
@@ -282,10 +364,21 @@ def main():
         update_hypotheses_per_batch=args.update_hypotheses_per_batch,
         only_best_hypothesis=args.only_best_hypothesis,
         save_every_n_examples=args.save_every_n_examples,
+        lookahead_window=args.lookahead_window,
+        keep_checkpoints=args.keep_checkpoints,
     )
 
     hypotheses_bank = {}
-    if args.old_hypothesis_file is None:
+    checkpoint = None if args.no_resume else update_class.load_checkpoint(args.seed)
+    if checkpoint is not None:
+        logger.info(f"Found update checkpoint in {args.output_folder}")
+        if args.old_hypothesis_file is not None:
+            logger.warning(
+                f"Resuming the hypotheses of the update checkpoint, not {args.old_hypothesis_file}. "
+                + "Use --no_resume to start from the old hypothesis file."
+            )
+        hypotheses_bank = checkpoint["hypotheses_bank"]
+    elif args.old_hypothesis_file is None:
         hypotheses_bank = update_class.batched_initialize_hypotheses(
             num_init=args.num_init,
             init_batch_size=args.init_batch_size,
@@ -305,7 +398,8 @@ def main():
         dict = load_dict(args.old_hypothesis_file)
         for hypothesis in dict:
             hypotheses_bank[hypothesis] = SummaryInformation.from_dict(dict[hypothesis])
-    for epoch in range(1):
+    start_epoch = checkpoint["epoch"] if checkpoint is not None else 0
+    for epoch in range(start_epoch, 1):
         hypotheses_bank = update_class.update(
             current_epoch=epoch,
             hypotheses_bank=hypotheses_bank,
@@ -314,6 +408,7 @@ def main():
             max_concurrent=args.max_concurrent,
             max_tokens=args.max_tokens,
             temperature=args.temperature,
+            checkpoint=checkpoint,
         )
         update_class.save_to_json(
             hypotheses_bank,
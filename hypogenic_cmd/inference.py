@@ -60,6 +60,12 @@ def parse_args():
         "--num_val", type=int, default=100, help="Number of validation examples."
     )
 
+    parser.add_argument(
+        "--data_cache_dir",
+        type=str,
+        default=None,
+        help="If set, data splits are converted once into a memory-mapped columnar format in this directory and sampled from there.",
+    )
     parser.add_argument(
         "--use_valid",
         action="store_true",
@@ -91,6 +97,32 @@ def parse_args():
         default=0,
         help="The number of examples to use per hypothesis for the adaptive inference method.",
     )
+    parser.add_argument(
+        "--adaptive_selection_method",
+        type=str,
+        default="auto",
+        choices=["auto", "ilp", "greedy"],
+        help="How the adaptive inference method selects dissimilar hypotheses: exact ILP, greedy heuristic, "
+        + "or auto (ILP for small hypothesis banks, greedy for large ones).",
+    )
+    parser.add_argument(
+        "--adaptive_selection_time_budget",
+        type=float,
+        default=None,
+        help="Maximum seconds spent selecting hypotheses in the adaptive inference method.",
+    )
+    parser.add_argument(
+        "--calibration_temperature",
+        type=float,
+        default=1.0,
+        help="Temperature of the softmax over the label log-probabilities that gives the confidences of the scoring inference method.",
+    )
+    parser.add_argument(
+        "--fit_calibration_temperature",
+        action="store_true",
+        default=False,
+        help="Fit the calibration temperature of the scoring inference method on the validation data of each seed.",
+    )
 
     parser.add_argument(
         "--cache_seed",
@@ -105,6 +137,45 @@ def parse_args():
         default=6832,
         help="Port for the redis server for LLM caching.",
     )
+    parser.add_argument(
+        "--cache_backend",
+        type=str,
+        default="redis",
+        choices=["redis", "sqlite"],
+        help="Storage backend for LLM caching. `sqlite` uses a local file and needs no server.",
+    )
+    parser.add_argument(
+        "--cache_path",
+        type=str,
+        default="./.hypogenic_cache.sqlite",
+        help="Path to the cache file when using the sqlite cache backend.",
+    )
+    parser.add_argument(
+        "--cache_lru_size",
+        type=int,
+        default=0,
+        help="Number of cache entries to keep in process memory. 0 disables the in-process cache.",
+    )
+    parser.add_argument(
+        "--cache_key_mode",
+        type=str,
+        default="migrate",
+        choices=["v1", "legacy", "migrate"],
+        help="Cache key scheme. `migrate` uses the new keys and falls back to (and migrates) entries written with the legacy keys.",
+    )
+    parser.add_argument(
+        "--cache_compression",
+        type=str,
+        default=None,
+        choices=["zstd", "zlib"],
+        help="Compress cached responses. `zstd` requires the `zstandard` package.",
+    )
+    parser.add_argument(
+        "--verify_cache",
+        action="store_true",
+        default=False,
+        help="Store full prompts in the cache and check them for equality on every hit.",
+    )
 
     parser.add_argument(
         "--inference_style",
@@ -118,6 +189,42 @@ def parse_args():
         default=3,
         help="The maximum number of concurrent calls to the API.",
     )
+    parser.add_argument(
+        "--use_batch_api",
+        action="store_true",
+        default=False,
+        help="Send the test set as offline jobs through the provider's batch API (OpenAI only). "
+        + "Cheaper and not rate limited, but can take up to 24 hours.",
+    )
+    parser.add_argument(
+        "--stop_at_label",
+        action="store_true",
+        default=False,
+        help="Stream the label predictions and stop each one as soon as the task's label extractor finds a label in it "
+        + "(other requests, e.g. relevance checks, are not cut off). "
+        + "Saves output tokens and latency. Stopped responses are cached apart from full ones.",
+    )
+    parser.add_argument(
+        "--stream_chunk_size",
+        type=int,
+        default=None,
+        help="If set, run inference on chunks of this many testing examples at a time, appending predictions "
+        + "to a JSONL file as each chunk completes, and resume from the last completed chunk. "
+        + "Use with --data_cache_dir to also read the testing data one chunk at a time.",
+    )
+    parser.add_argument(
+        "--predictions_folder",
+        type=str,
+        default=None,
+        help="Folder for the JSONL predictions of --stream_chunk_size. If None, will use the folder of the hypothesis file.",
+    )
+    parser.add_argument(
+        "--no_resume",
+        action="store_true",
+        default=False,
+        help="With --stream_chunk_size, overwrite existing predictions instead of resuming from them. "
+        + "Predictions are only resumed by a run with the same hypotheses, model, data and inference settings.",
+    )
     parser.add_argument(
         "--log_file",
         type=str,
@@ -150,6 +257,8 @@ def parse_args():
 
 
 def main():
+    import hashlib
+    import os
     import time
 
     start_time = time.time()
@@ -158,7 +267,7 @@ def main():
 
     from typing import Dict, Union
 
-    from hypogenic.extract_label import extract_label_register
+    from hypogenic.extract_label import extract_label_register, label_stop_predicate
 
     from hypogenic.tasks import BaseTask
     from hypogenic.prompt import BasePrompt
@@ -168,14 +277,18 @@ def main():
     )
     from hypogenic.LLM_wrapper import llm_wrapper_register
     from hypogenic.algorithm.summary_information import SummaryInformation
-    from hypogenic.algorithm.inference import inference_register
+    from hypogenic.algorithm.inference import inference_register, PredictionSink
     from hypogenic.logger_config import LoggerConfig
 
-    LoggerConfig.setup_logger(args.log_file, args.log_level)
+    LoggerConfig.setup_logger(level=args.log_level, log_file_path=args.log_file)
 
     logger = LoggerConfig.get_logger("HypoGenic")
 
-    task = BaseTask(args.task_config_path, from_register=extract_label_register)
+    task = BaseTask(
+        args.task_config_path,
+        from_register=extract_label_register,
+        data_cache_dir=args.data_cache_dir,
+    )
     if args.hypothesis_file is None:
         args.hypothesis_file = f"./outputs/{task.task_name}/{args.model_name}/hyp_20/hypotheses_training_sample_final_seed_49_epoch_0.json"
 
@@ -183,6 +296,8 @@ def main():
     f1_all = []
 
     hyp_dict = load_dict(args.hypothesis_file)
+    with open(args.hypothesis_file, "rb") as f:
+        hypothesis_sha256 = hashlib.sha256(f.read()).hexdigest()
     hyp_bank: Dict[str, SummaryInformation] = {}
     for hypothesis in hyp_dict:
         hyp_bank[hypothesis] = SummaryInformation.from_dict(hyp_dict[hypothesis])
@@ -197,16 +312,51 @@ def main():
         hyp_bank
     ), f"The number of hypotheses chosen in adaptive inference must be less than the total number of hypotheses"
 
+    redis_kwargs = {
+        "cache_backend": args.cache_backend,
+        "lru_cache_size": args.cache_lru_size,
+        "cache_key_mode": args.cache_key_mode,
+        "cache_compression": args.cache_compression,
+        "verify_cache": args.verify_cache,
+    }
+    if args.cache_backend == "sqlite":
+        redis_kwargs["cache_path"] = args.cache_path
     api = llm_wrapper_register.build(args.model_type)(
-        args.model_name, args.model_path, port=args.port
+        args.model_name,
+        path_name=args.model_path,
+        port=args.port,
+        redis_kwargs=redis_kwargs,
     )
     prompt_class = BasePrompt(task)
 
+    inference_kwargs = {
+        "cache_seed": args.cache_seed,
+        "k": args.k,
+        "adaptive_threshold": args.adaptive_threshold,
+        "adaptive_num_hypotheses": args.adaptive_num_hypotheses,
+        "adaptive_num_examples": args.adaptive_num_examples,
+        "adaptive_selection_method": args.adaptive_selection_method,
+        "adaptive_selection_time_budget": args.adaptive_selection_time_budget,
+        "max_concurrent": args.max_concurrent,
+        "generate_kwargs": {
+            "max_tokens": args.max_tokens,
+            "temperature": args.temperature,
+            "use_batch_api": args.use_batch_api,
+        },
+    }
+    if args.stop_at_label:
+        # only the requests the labels are extracted from are cut off
+        inference_kwargs["stop_predicate"] = label_stop_predicate(task.extract_label)
+
     for seed in args.seeds:
         set_seed(seed)
-        train_data, test_data, val_data = task.get_data(
-            args.num_train, args.num_test, args.num_val, seed
-        )
+        if args.stream_chunk_size is not None:
+            # only the training data is loaded, the testing data is read chunk by chunk
+            train_data = task.get_split("train", args.num_train, seed)
+        else:
+            train_data, test_data, val_data = task.get_data(
+                args.num_train, args.num_test, args.num_val, seed
+            )
 
         inference_class = inference_register.build(args.inference_style)(
             api, prompt_class, train_data, task
@@ -214,35 +364,109 @@ def main():
 
         if args.use_valid:
             logger.info("Using validation data")
-            test_data = val_data
+            split, num_examples = "val", args.num_val
         else:
             logger.info("Using test data")
-
-        pred_list, label_list = inference_class.run_inference_final(
-            test_data,
-            hyp_bank,
-            cache_seed=args.cache_seed,
-            k=args.k,
-            adaptive_threshold=args.adaptive_threshold,
-            adaptive_num_hypotheses=args.adaptive_num_hypotheses,
-            adaptive_num_examples=args.adaptive_num_examples,
-            max_concurrent=args.max_concurrent,
-            generate_kwargs={
+            split, num_examples = "test", args.num_test
+
+        if args.inference_style == "scoring":
+            inference_class.calibration_temperature = args.calibration_temperature
+            if args.fit_calibration_temperature:
+                if args.use_valid:
+                    logger.warning(
+                        "Fitting the calibration temperature on the data it is evaluated on"
+                    )
+                inference_class.fit_calibration_temperature(
+                    (
+                        val_data
+                        if args.stream_chunk_size is None
+                        else task.get_split("val", args.num_val, seed)
+                    ),
+                    hyp_bank,
+                    cache_seed=args.cache_seed,
+                    max_concurrent=args.max_concurrent,
+                    generate_kwargs=inference_kwargs["generate_kwargs"],
+                )
+
+        if args.stream_chunk_size is not None:
+            predictions_folder = (
+                args.predictions_folder
+                if args.predictions_folder is not None
+                else os.path.dirname(args.hypothesis_file)
+            )
+            # a file is only resumed by a run that makes the same predictions
+            run_info = {
+                "task": task.task_name,
+                "model_type": args.model_type,
+                "model_name": args.model_name,
+                "hypothesis_file": os.path.abspath(args.hypothesis_file),
+                "hypothesis_sha256": hypothesis_sha256,
+                "inference_style": args.inference_style,
+                "split": split,
+                "seed": seed,
+                "num_examples": num_examples,
+                "num_train": args.num_train,
+                "cache_seed": args.cache_seed,
+                "k": args.k,
+                "adaptive_threshold": args.adaptive_threshold,
+                "adaptive_num_hypotheses": args.adaptive_num_hypotheses,
+                "adaptive_num_examples": args.adaptive_num_examples,
+                "adaptive_selection_method": args.adaptive_selection_method,
                 "max_tokens": args.max_tokens,
                 "temperature": args.temperature,
-            },
-        )
+                "stop_at_label": args.stop_at_label,
+                "calibration_temperature": getattr(
+                    inference_class, "calibration_temperature", None
+                ),
+            }
+            sink = PredictionSink(
+                os.path.join(
+                    predictions_folder,
+                    f"predictions_{args.inference_style}_{split}_seed_{seed}.jsonl",
+                ),
+                args.stream_chunk_size,
+                resume=not args.no_resume,
+                run_info=run_info,
+            )
+            try:
+                metrics = inference_class.run_inference_streaming(
+                    task.get_data_chunks(
+                        split,
+                        num_examples,
+                        seed,
+                        chunk_size=args.stream_chunk_size,
+                        start_chunk=sink.next_chunk,
+                    ),
+                    hyp_bank,
+                    sink,
+                    **inference_kwargs,
+                )
+            finally:
+                sink.close()
+            results_dict = metrics.results()
+            logger.info(f"Predictions written to {sink.file_path}")
+        else:
+            if args.use_valid:
+                test_data = val_data
+            pred_list, label_list = inference_class.run_inference_final(
+                test_data,
+                hyp_bank,
+                **inference_kwargs,
+            )
 
-        results_dict = get_results(pred_list, label_list)
+            results_dict = get_results(pred_list, label_list)
 
         logger.info(f"Accuracy for seed {seed}: {results_dict['accuracy']}")
         logger.info(f"F1 for seed {seed}: {results_dict['f1']}")
-
-        # print the wrong indices
-        wrong_indices = [
-            i for i in range(len(pred_list)) if pred_list[i] != label_list[i]
-        ]
-        logger.info(f"Wrong indices: {wrong_indices}")
+        accuracy_all.append(results_dict["accuracy"])
+        f1_all.append(results_dict["f1"])
+
+        if args.stream_chunk_size is None:
+            # print the wrong indices
+            wrong_indices = [
+                i for i in range(len(pred_list)) if pred_list[i] != label_list[i]
+            ]
+            logger.info(f"Wrong indices: {wrong_indices}")
 
     logger.info(f"Averaged accuracy: {sum(accuracy_all)/len(args.seeds)}")
     logger.info(f"Averaged F1: {sum(f1_all)/len(args.seeds)}")
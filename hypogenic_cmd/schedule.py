@@ -0,0 +1,625 @@
+def load_dict(file_path):
+    import json
+
+    with open(file_path, "r") as file:
+        data = json.load(file)
+    return data
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Run hypothesis generation and inference for every combination of tasks, seeds and inference styles."
+    )
+    parser.add_argument(
+        "--task_config_paths",
+        nargs="+",
+        type=str,
+        default=["./data/hotel_reviews/config.yaml"],
+        help="Paths to the task config.yaml files.",
+    )
+    parser.add_argument(
+        "--seeds",
+        nargs="+",
+        type=int,
+        default=[49],
+        help="Random seeds. Every seed is a separate generation and inference run.",
+    )
+    parser.add_argument(
+        "--inference_styles",
+        nargs="+",
+        type=str,
+        default=["default"],
+        help="Inference methods to evaluate the generated hypotheses with.",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=4,
+        help="Number of experiments running at the same time. They share one LLM wrapper, cache and rate budget.",
+    )
+    parser.add_argument(
+        "--results_file",
+        type=str,
+        default=None,
+        help="Path to the csv file with the results of every run. Defaults to ./outputs/schedule_results_<model>.csv",
+    )
+    parser.add_argument(
+        "--regenerate",
+        action="store_true",
+        default=False,
+        help="Generate hypotheses even if the final hypotheses of a task and seed already exist.",
+    )
+
+    parser.add_argument(
+        "--model_name",
+        type=str,
+        default="meta-llama/Meta-Llama-3.1-8B-Instruct",
+        help="Name of the model to use.",
+    )
+    parser.add_argument(
+        "--model_path",
+        type=str,
+        default=None,
+        help="Path to the local model. If None, will use the model from the HuggingFace model hub.",
+    )
+    parser.add_argument(
+        "--model_type",
+        type=str,
+        default="vllm",
+        choices=["gpt", "claude", "vllm", "huggingface"],
+        help="Type of model to use.",
+    )
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=None,
+        help="Requests-per-minute budget shared by all runs. None disables it.",
+    )
+    parser.add_argument(
+        "--tpm",
+        type=int,
+        default=None,
+        help="Tokens-per-minute budget shared by all runs. None disables it.",
+    )
+    parser.add_argument(
+        "--adaptive_concurrency",
+        action="store_true",
+        default=False,
+        help="Tune the number of concurrent API calls of all runs from latency and rate limit errors.",
+    )
+
+    parser.add_argument(
+        "--max_num_hypotheses",
+        type=int,
+        default=20,
+        help="Maximum number of hypotheses to keep in the hypothesis bank.",
+    )
+    parser.add_argument(
+        "--output_folder",
+        type=str,
+        default=None,
+        help="Path to the output folder for saving hypotheses. Every task gets its own subfolder <output_folder>/<task>/. Defaults to ./outputs/<task>/<model>/hyp_<max_num_hypotheses>/",
+    )
+    parser.add_argument(
+        "--num_init",
+        type=int,
+        default=10,
+        help="Number of examples to use for initializing hypotheses.",
+    )
+    parser.add_argument(
+        "--num_train", type=int, default=200, help="Number of training examples."
+    )
+    parser.add_argument(
+        "--num_test", type=int, default=100, help="Number of testing examples."
+    )
+    parser.add_argument(
+        "--num_val", type=int, default=100, help="Number of validation examples."
+    )
+    parser.add_argument(
+        "--data_cache_dir",
+        type=str,
+        default=None,
+        help="If set, data splits are converted once into a memory-mapped columnar format in this directory and sampled from there.",
+    )
+    parser.add_argument(
+        "--use_valid",
+        action="store_true",
+        default=False,
+        help="Whether to use the validation set as the testing set.",
+    )
+    parser.add_argument(
+        "--k",
+        type=int,
+        default=5,
+        help="The number of top hypotheses checked per example during training.",
+    )
+    parser.add_argument(
+        "--update_batch_size",
+        type=int,
+        default=10,
+        help="Number of examples to use per hypothesis-generation prompt.",
+    )
+    parser.add_argument(
+        "--num_hypotheses_to_update",
+        type=int,
+        default=1,
+        help="Number of lowest-ranking hypotheses to update once we reach the maximum number of hypotheses.",
+    )
+    parser.add_argument(
+        "--update_hypotheses_per_batch",
+        type=int,
+        default=5,
+        help="Number of hypotheses to generate per prompt.",
+    )
+    parser.add_argument(
+        "--init_batch_size",
+        type=int,
+        default=10,
+        help="Batch size to generate the initial hypotheses.",
+    )
+    parser.add_argument(
+        "--init_hypotheses_per_batch",
+        type=int,
+        default=10,
+        help="Number of hypotheses to generate per batch during initialization.",
+    )
+    parser.add_argument(
+        "--save_every_n_examples",
+        type=int,
+        default=10,
+        help="Save hypotheses every n examples visited.",
+    )
+    parser.add_argument(
+        "--lookahead_window",
+        type=int,
+        default=1,
+        help="Number of upcoming training examples the top hypotheses are evaluated on in one batch during the update.",
+    )
+    parser.add_argument(
+        "--generation_style",
+        type=str,
+        default="default",
+        help="Type of generation method.",
+    )
+    parser.add_argument(
+        "--update_style", type=str, default="default", help="Type of update method."
+    )
+    parser.add_argument(
+        "--replace_style", type=str, default="default", help="Type of replace method."
+    )
+
+    parser.add_argument(
+        "--inference_k",
+        type=int,
+        default=5,
+        help="The number of hypotheses to use for the filter_and_vote inference method.",
+    )
+    parser.add_argument(
+        "--adaptive_threshold",
+        type=float,
+        default=0.7,
+        help="The threshold for the hypotheses filtering step in the adaptive inference method.",
+    )
+    parser.add_argument(
+        "--adaptive_num_hypotheses",
+        type=int,
+        default=5,
+        help="The number of hypotheses to use for the adaptive inference method.",
+    )
+    parser.add_argument(
+        "--adaptive_num_examples",
+        type=int,
+        default=0,
+        help="The number of examples to use per hypothesis for the adaptive inference method.",
+    )
+
+    parser.add_argument(
+        "--cache_seed",
+        type=int,
+        default=None,
+        help="If `None`, will not use cache, otherwise will use cache with corresponding seed number",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=6832,
+        help="Port for the redis server for LLM caching.",
+    )
+    parser.add_argument(
+        "--cache_backend",
+        type=str,
+        default="redis",
+        choices=["redis", "sqlite"],
+        help="Storage backend for LLM caching. `sqlite` uses a local file and needs no server.",
+    )
+    parser.add_argument(
+        "--cache_path",
+        type=str,
+        default="./.hypogenic_cache.sqlite",
+        help="Path to the cache file when using the sqlite cache backend.",
+    )
+    parser.add_argument(
+        "--cache_lru_size",
+        type=int,
+        default=0,
+        help="Number of cache entries to keep in process memory. 0 disables the in-process cache.",
+    )
+    parser.add_argument(
+        "--max_concurrent",
+        type=int,
+        default=3,
+        help="The maximum number of concurrent calls to the API per run.",
+    )
+    parser.add_argument(
+        "--log_file",
+        type=str,
+        default=None,
+        help="Path to the log file. If None, will only log to stdout.",
+    )
+    parser.add_argument(
+        "--log_level",
+        type=str,
+        default="INFO",
+        help="Logging level.",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+    )
+    parser.add_argument(
+        "--max_tokens",
+        type=int,
+        default=4096,
+        help="The maximum number of tokens to generate.",
+    )
+    parser.add_argument(
+        "--temperature",
+        type=float,
+        default=1e-5,
+        help="The temperature for the generation.",
+    )
+    parser.add_argument(
+        "--stop_at_label",
+        action="store_true",
+        default=False,
+        help="Stream the label predictions and stop each one as soon as the task's label extractor finds a label in it "
+        + "(other requests, e.g. relevance checks, are not cut off). "
+        + "Saves output tokens and latency. Stopped responses are cached apart from full ones.",
+    )
+
+    args = parser.parse_args()
+
+    return args
+
+
+def output_folder(args, task):
+    import os
+
+    # hypotheses and checkpoints are only named by seed, so tasks must not share a folder
+    if args.output_folder is not None:
+        return os.path.join(args.output_folder, task.task_name)
+    return f"./outputs/{task.task_name}/{args.model_name}/hyp_{args.max_num_hypotheses}/"
+
+
+def load_data(args, task, seed, data_lock):
+    from hypogenic.utils import set_seed
+
+    # get_data and set_seed use the global random state, so runs load their data one at a time
+    with data_lock:
+        set_seed(seed)
+        return task.get_data(args.num_train, args.num_test, args.num_val, seed)
+
+
+def run_generation(args, api, task, seed, data_lock):
+    """Generates the hypotheses of one task and seed, and returns the path of the final hypotheses."""
+    import os
+
+    from hypogenic.prompt import BasePrompt
+    from hypogenic.algorithm.generation import generation_register
+    from hypogenic.algorithm.inference import inference_register
+    from hypogenic.algorithm.replace import replace_register
+    from hypogenic.algorithm.update import update_register, Update
+    from hypogenic.logger_config import LoggerConfig
+
+    logger = LoggerConfig.get_logger("HypoGenic - Schedule")
+
+    save_path = output_folder(args, task)
+    os.makedirs(save_path, exist_ok=True)
+    file_name_template = (
+        "hypotheses_training_sample_${sample}_seed_${seed}_epoch_${epoch}.json"
+    )
+    final_file = os.path.join(
+        save_path, f"hypotheses_training_sample_final_seed_{seed}_epoch_0.json"
+    )
+    if os.path.exists(final_file) and not args.regenerate:
+        logger.info(f"Using existing hypotheses {final_file}")
+        return final_file
+
+    train_data, _, _ = load_data(args, task, seed, data_lock)
+    prompt_class = BasePrompt(task)
+    inference_class = inference_register.build("default")(
+        api, prompt_class, train_data, task
+    )
+    generation_class = generation_register.build(args.generation_style)(
+        api, prompt_class, inference_class, task
+    )
+    replace_class = replace_register.build(args.replace_style)(args.max_num_hypotheses)
+    update_class: Update = update_register.build(args.update_style)(
+        generation_class=generation_class,
+        inference_class=inference_class,
+        replace_class=replace_class,
+        save_path=save_path,
+        file_name_template=file_name_template,
+        num_init=args.num_init,
+        k=args.k,
+        update_batch_size=args.update_batch_size,
+        num_hypotheses_to_update=args.num_hypotheses_to_update,
+        update_hypotheses_per_batch=args.update_hypotheses_per_batch,
+        save_every_n_examples=args.save_every_n_examples,
+        **(
+            {"lookahead_window": args.lookahead_window}
+            if args.lookahead_window != 1
+            else {}
+        ),
+    )
+    generate_kwargs = {"max_tokens": args.max_tokens, "temperature": args.temperature}
+
+    checkpoint = None if args.regenerate else update_class.load_checkpoint(seed)
+    if checkpoint is not None:
+        hypotheses_bank = checkpoint["hypotheses_bank"]
+    else:
+        hypotheses_bank = update_class.batched_initialize_hypotheses(
+            num_init=args.num_init,
+            init_batch_size=args.init_batch_size,
+            init_hypotheses_per_batch=args.init_hypotheses_per_batch,
+            cache_seed=args.cache_seed,
+            max_concurrent=args.max_concurrent,
+            **generate_kwargs,
+        )
+        update_class.save_to_json(
+            hypotheses_bank, sample=args.num_init, seed=seed, epoch=0
+        )
+    hypotheses_bank = update_class.update(
+        current_epoch=0,
+        hypotheses_bank=hypotheses_bank,
+        current_seed=seed,
+        cache_seed=args.cache_seed,
+        max_concurrent=args.max_concurrent,
+        checkpoint=checkpoint,
+        **generate_kwargs,
+    )
+    update_class.save_to_json(hypotheses_bank, sample="final", seed=seed, epoch=0)
+    return final_file
+
+
+def run_inference(args, api, task, seed, inference_style, hypothesis_file, data_lock):
+    """Evaluates the hypotheses in `hypothesis_file` on the test (or validation) data of one seed."""
+    from typing import Dict
+
+    from hypogenic.extract_label import label_stop_predicate
+    from hypogenic.prompt import BasePrompt
+    from hypogenic.utils import get_results
+    from hypogenic.algorithm.summary_information import SummaryInformation
+    from hypogenic.algorithm.inference import inference_register
+    from hypogenic.logger_config import LoggerConfig
+
+    logger = LoggerConfig.get_logger("HypoGenic - Schedule")
+
+    hyp_dict = load_dict(hypothesis_file)
+    hyp_bank: Dict[str, SummaryInformation] = {}
+    for hypothesis in hyp_dict:
+        hyp_bank[hypothesis] = SummaryInformation.from_dict(hyp_dict[hypothesis])
+
+    if inference_style in ["one_step_adaptive", "two_step_adaptive"] and all(
+        [len(hyp_bank[hyp].correct_examples) == 0 for hyp in hyp_bank]
+    ):
+        logger.info("All hypotheses have 0 correct examples, use default inference")
+        inference_style = "default"
+
+    train_data, test_data, val_data = load_data(args, task, seed, data_lock)
+    if args.use_valid:
+        test_data = val_data
+
+    inference_class = inference_register.build(inference_style)(
+        api, BasePrompt(task), train_data, task
+    )
+    generate_kwargs = {"max_tokens": args.max_tokens, "temperature": args.temperature}
+    pred_list, label_list = inference_class.run_inference_final(
+        test_data,
+        hyp_bank,
+        cache_seed=args.cache_seed,
+        k=args.inference_k,
+        adaptive_threshold=args.adaptive_threshold,
+        adaptive_num_hypotheses=min(args.adaptive_num_hypotheses, len(hyp_bank)),
+        adaptive_num_examples=args.adaptive_num_examples,
+        max_concurrent=args.max_concurrent,
+        stop_predicate=(
+            label_stop_predicate(task.extract_label) if args.stop_at_label else None
+        ),
+        generate_kwargs=generate_kwargs,
+    )
+    return get_results(pred_list, label_list)
+
+
+def main():
+    import os
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    import pandas as pd
+
+    start_time = time.time()
+
+    args = parse_args()
+
+    from hypogenic.extract_label import extract_label_register
+    from hypogenic.tasks import BaseTask
+    from hypogenic.LLM_wrapper import llm_wrapper_register
+    from hypogenic.logger_config import LoggerConfig
+
+    LoggerConfig.setup_logger(level=args.log_level, log_file_path=args.log_file)
+
+    logger = LoggerConfig.get_logger("HypoGenic - Schedule")
+
+    tasks = {
+        path: BaseTask(
+            path,
+            from_register=extract_label_register,
+            data_cache_dir=args.data_cache_dir,
+        )
+        for path in args.task_config_paths
+    }
+    task_names = [task.task_name for task in tasks.values()]
+    duplicates = sorted({name for name in task_names if task_names.count(name) > 1})
+    if len(duplicates) > 0:
+        raise ValueError(
+            f"Tasks {duplicates} are given more than once, their runs would share output folders"
+        )
+
+    # One wrapper for all runs: they share its cache, in-flight request deduplication,
+    # rate limiter and concurrency limiter
+    redis_kwargs = {
+        "cache_backend": args.cache_backend,
+        "lru_cache_size": args.cache_lru_size,
+    }
+    if args.cache_backend == "sqlite":
+        redis_kwargs["cache_path"] = args.cache_path
+    wrapper_kwargs = {}
+    if args.model_type in ["gpt", "claude"]:
+        wrapper_kwargs.update(
+            rpm=args.rpm,
+            tpm=args.tpm,
+            adaptive_concurrency=args.adaptive_concurrency,
+        )
+    elif args.model_type == "vllm":
+        # the continuous batching engine is safe to call from several runs at once,
+        # and decodes their requests together
+        wrapper_kwargs.update(use_async_engine=True)
+    api = llm_wrapper_register.build(args.model_type)(
+        args.model_name,
+        path_name=args.model_path,
+        port=args.port,
+        redis_kwargs=redis_kwargs,
+        **wrapper_kwargs,
+    )
+
+    data_lock = threading.Lock()
+    rows = []
+
+    def run_cell(task_path, seed, inference_style, hypothesis_file):
+        cell_start = time.time()
+        results_dict = run_inference(
+            args,
+            api,
+            tasks[task_path],
+            seed,
+            inference_style,
+            hypothesis_file,
+            data_lock,
+        )
+        return {
+            "task": tasks[task_path].task_name,
+            "seed": seed,
+            "inference_style": inference_style,
+            "accuracy": results_dict["accuracy"],
+            "f1": results_dict["f1"],
+            "inference_time": time.time() - cell_start,
+            "hypothesis_file": hypothesis_file,
+            "error": None,
+        }
+
+    with ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+        generation_futures = {
+            executor.submit(
+                run_generation, args, api, tasks[task_path], seed, data_lock
+            ): (task_path, seed)
+            for task_path in args.task_config_paths
+            for seed in args.seeds
+        }
+
+        # start the inference runs of a task and seed as soon as its hypotheses are ready
+        inference_futures = {}
+        for future in as_completed(generation_futures):
+            task_path, seed = generation_futures[future]
+            try:
+                hypothesis_file = future.result()
+            except Exception as e:
+                logger.error(
+                    f"Generation failed for {tasks[task_path].task_name}, seed {seed}: {e}"
+                )
+                for inference_style in args.inference_styles:
+                    rows.append(
+                        {
+                            "task": tasks[task_path].task_name,
+                            "seed": seed,
+                            "inference_style": inference_style,
+                            "error": f"generation: {e}",
+                        }
+                    )
+                continue
+            logger.info(
+                f"Hypotheses ready for {tasks[task_path].task_name}, seed {seed}"
+            )
+            for inference_style in args.inference_styles:
+                inference_futures[
+                    executor.submit(
+                        run_cell, task_path, seed, inference_style, hypothesis_file
+                    )
+                ] = (task_path, seed, inference_style)
+
+        for future in as_completed(inference_futures):
+            task_path, seed, inference_style = inference_futures[future]
+            try:
+                row = future.result()
+                logger.info(
+                    f"{row['task']}, seed {seed}, {inference_style}: "
+                    + f"accuracy {row['accuracy']}, F1 {row['f1']}"
+                )
+            except Exception as e:
+                logger.error(
+                    f"Inference failed for {tasks[task_path].task_name}, seed {seed}, {inference_style}: {e}"
+                )
+                row = {
+                    "task": tasks[task_path].task_name,
+                    "seed": seed,
+                    "inference_style": inference_style,
+                    "error": f"inference: {e}",
+                }
+            rows.append(row)
+
+    results = pd.DataFrame(
+        rows,
+        columns=[
+            "task",
+            "seed",
+            "inference_style",
+            "accuracy",
+            "f1",
+            "inference_time",
+            "hypothesis_file",
+            "error",
+        ],
+    ).sort_values(["task", "inference_style", "seed"])
+    if args.results_file is None:
+        args.results_file = (
+            f"./outputs/schedule_results_{args.model_name.replace('/', '_')}.csv"
+        )
+    os.makedirs(os.path.dirname(os.path.abspath(args.results_file)), exist_ok=True)
+    results.to_csv(args.results_file, index=False)
+    logger.info(f"Wrote results of {len(results)} runs to {args.results_file}")
+
+    if results["accuracy"].notna().any():
+        summary = results.groupby(["task", "inference_style"])[
+            ["accuracy", "f1"]
+        ].mean()
+        logger.info(f"Averaged over seeds:\n{summary.to_string()}")
+
+    metrics = api.concurrency_metrics()
+    if metrics is not None:
+        logger.info(f"Concurrency limiter: {metrics}")
+
+    logger.info(f"Total time: {time.time() - start_time} seconds")
+
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,7 @@ setuptools.setup(
         "console_scripts": [
             "hypogenic_generation=hypogenic_cmd.generation:main",
             "hypogenic_inference=hypogenic_cmd.inference:main",
+            "hypogenic_schedule=hypogenic_cmd.schedule:main",
         ],
     },
 )
@@ -0,0 +1,83 @@
+#!/bin/bash
+set -e
+
+# Batch API mode of the GPT wrapper against an in-memory Files/Batches client: requests are
+# uploaded in jobs of at most max_batch_requests, polled until completed, and the results are
+# put back in input order. Failed requests are retried in real time. Needs no API access.
+
+work_dir=$(mktemp -d)
+trap 'rm -rf "${work_dir}"' EXIT
+
+OPENAI_API_KEY=${OPENAI_API_KEY:-fake} python - "${work_dir}/cache.sqlite" <<'EOF'
+import sys
+
+from hypogenic.LLM_wrapper import FakeBatchClient, llm_wrapper_register
+
+
+def response_fn(body):
+    content = body["messages"][-1]["content"]
+    if content.startswith("bad"):
+        raise ValueError(f"invalid request {content}")
+    return f"answer to {content}"
+
+
+batch_client = FakeBatchClient(response_fn, num_polls=3)
+api = llm_wrapper_register.build("gpt")(
+    "gpt-4o-mini",
+    batch_client=batch_client,
+    batch_poll_interval=0,
+    redis_kwargs={"cache_backend": "sqlite", "cache_path": sys.argv[1]},
+)
+api.max_batch_requests = 3
+
+real_time_requests = []
+
+
+def batched_generate(messages, model, **kwargs):
+    real_time_requests.extend(messages)
+    return [f"real time answer to {msg[-1]['content']}" for msg in messages]
+
+
+api._batched_generate = batched_generate
+
+prompts = ["q0", "q1", "bad2", "q3", "q4", "bad5", "q6"]
+messages = [[{"role": "user", "content": prompt}] for prompt in prompts]
+responses = api.batched_generate(
+    messages, cache_seed=0, use_batch_api=True, max_tokens=7, temperature=0.5
+)
+
+# upload: three jobs, every request once, with the generation arguments in its body
+assert len(batch_client.batches.batches) == 3, batch_client.batches.batches
+assert sorted(request["custom_id"] for request in batch_client.requests) == sorted(
+    f"request-{idx}" for idx in range(len(prompts))
+), batch_client.requests
+for request in batch_client.requests:
+    assert request["url"] == "/v1/chat/completions", request
+    assert request["body"]["model"] == "gpt-4o-mini", request
+    assert request["body"]["max_tokens"] == 7, request
+    assert request["body"]["temperature"] == 0.5, request
+
+# polling: every job is retrieved until it completes
+assert batch_client.num_retrieved == 3 * 3, batch_client.num_retrieved
+
+# ordering and errors: results are in input order, failed requests are answered in real time
+assert real_time_requests == [messages[2], messages[5]], real_time_requests
+assert responses == [
+    "answer to q0",
+    "answer to q1",
+    "real time answer to bad2",
+    "answer to q3",
+    "answer to q4",
+    "real time answer to bad5",
+    "answer to q6",
+], responses
+
+# the responses are cached like real-time ones
+cached_responses = api.batched_generate(
+    messages, cache_seed=0, use_batch_api=True, max_tokens=7, temperature=0.5
+)
+assert cached_responses == responses, cached_responses
+assert len(batch_client.requests) == len(prompts), batch_client.requests
+
+print("Batch API mode uploads, polls and orders results as expected")
+EOF
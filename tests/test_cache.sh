@@ -0,0 +1,56 @@
+#!/bin/bash
+set -e
+
+# The LLM cache requests identical messages of a batch once and gives every copy the
+# response, unless the cache is overwritten, where every copy is a separate sample.
+# Runs against the sqlite backend, so no redis server is needed.
+
+work_dir=$(mktemp -d)
+trap 'rm -rf "${work_dir}"' EXIT
+
+python - "${work_dir}/cache.sqlite" <<'EOF'
+import sys
+
+from hypogenic.LLM_cache import LocalModelAPICache
+
+cache = LocalModelAPICache(cache_backend="sqlite", cache_path=sys.argv[1])
+requested = []
+
+
+def batched_api_call(messages, max_concurrent=3, **kwargs):
+    responses = [f"r{len(requested) + idx}" for idx in range(len(messages))]
+    requested.extend(messages)
+    return responses
+
+
+cache.batched_api_call = batched_api_call
+messages = [[{"role": "user", "content": "same prompt"}] for _ in range(3)]
+
+responses = cache.batched_generate(messages, cache_seed=0)
+assert responses == ["r0", "r0", "r0"], responses
+assert len(requested) == 1, requested
+
+responses = cache.batched_generate(messages, cache_seed=0)
+assert responses == ["r0", "r0", "r0"], responses
+assert len(requested) == 1, requested
+
+responses = cache.batched_generate(messages, cache_seed=0, overwrite_cache=True)
+assert responses == ["r1", "r2", "r3"], responses
+assert len(requested) == 4, requested
+
+# an API that drops responses fails the batch and leaves nothing in flight
+cache.batched_api_call = lambda messages, **kwargs: batched_api_call(messages)[:-1]
+messages = [[{"role": "user", "content": f"prompt {idx}"}] for idx in range(2)]
+try:
+    cache.batched_generate(messages, cache_seed=0)
+    raise AssertionError("missing responses were not detected")
+except ValueError as e:
+    assert "returned 1 responses for 2 messages" in str(e), e
+assert len(cache.inflight) == 0, cache.inflight
+
+cache.batched_api_call = batched_api_call
+responses = cache.batched_generate(messages, cache_seed=0)
+assert responses == ["r6", "r7"], responses
+
+print("LLM cache deduplicates and resamples as expected")
+EOF
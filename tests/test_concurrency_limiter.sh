@@ -0,0 +1,99 @@
+#!/bin/bash
+set -e
+
+# The adaptive concurrency limiter of the GPT and Claude wrappers is cut after a timeout and the
+# request is retried, while other retried errors (e.g. server errors) leave the limit unchanged.
+# The API clients are replaced by in-memory ones, so no API access is needed.
+
+work_dir=$(mktemp -d)
+trap 'rm -rf "${work_dir}"' EXIT
+
+OPENAI_API_KEY=${OPENAI_API_KEY:-fake} ANTHROPIC_API_KEY=${ANTHROPIC_API_KEY:-fake} python - "${work_dir}" <<'EOF'
+import sys
+from types import SimpleNamespace
+
+import anthropic
+import httpx
+import openai
+
+from hypogenic.LLM_wrapper import llm_wrapper_register
+
+request = httpx.Request("POST", "https://api.example.com")
+server_error = httpx.Response(500, request=request)
+
+
+def build(model_type, model, errors, response):
+    """Wrapper whose async client raises `errors` in turn, then returns `response`."""
+    api = llm_wrapper_register.build(model_type)(
+        model,
+        min_backoff=0,
+        max_backoff=0,
+        adaptive_concurrency=True,
+        redis_kwargs={
+            "cache_backend": "sqlite",
+            "cache_path": f"{sys.argv[1]}/{model_type}.sqlite",
+        },
+    )
+    api.concurrency_limiter.limit = 16.0
+    api.concurrency_limiter.cooldown = 0
+    remaining_errors = list(errors)
+
+    async def create(**kwargs):
+        if len(remaining_errors) > 0:
+            raise remaining_errors.pop(0)
+        return response
+
+    endpoint = SimpleNamespace(create=create)
+    client = SimpleNamespace(
+        chat=SimpleNamespace(completions=endpoint), messages=endpoint
+    )
+    api._get_async_client = lambda: client
+    return api
+
+
+gpt_response = SimpleNamespace(
+    choices=[SimpleNamespace(message=SimpleNamespace(content="answer"))],
+    usage=SimpleNamespace(total_tokens=10),
+)
+claude_response = SimpleNamespace(
+    content=[SimpleNamespace(text="answer")],
+    usage=SimpleNamespace(input_tokens=5, output_tokens=5),
+)
+
+
+def build_messages():
+    # a single message is sent through the synchronous client, two go through the async one.
+    # The Claude wrapper takes the system prompt out of the messages, so they are not reused.
+    return [
+        [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": f"question {idx}"},
+        ]
+        for idx in range(2)
+    ]
+
+
+cases = [
+    ("gpt", "gpt-4o-mini", openai.APITimeoutError(request), gpt_response),
+    ("claude", "claude-3-haiku-20240307", anthropic.APITimeoutError(request), claude_response),
+]
+for model_type, model, timeout, response in cases:
+    api = build(model_type, model, [timeout], response)
+    responses = api.batched_generate(build_messages(), cache_seed=None)
+    assert responses == ["answer", "answer"], (model_type, responses)
+    metrics = api.concurrency_metrics()
+    assert metrics["limit"] == 8, (model_type, metrics)
+    assert metrics["error_rate"] == 1 / 3, (model_type, metrics)
+
+server_errors = [
+    openai.InternalServerError("server error", response=server_error, body=None),
+    anthropic.APIConnectionError(request=request),
+]
+for (model_type, model, _, response), error in zip(cases, server_errors):
+    api = build(model_type, model, [error], response)
+    responses = api.batched_generate(build_messages(), cache_seed=None)
+    assert responses == ["answer", "answer"], (model_type, responses)
+    assert api.concurrency_metrics()["limit"] == 16, (model_type, api.concurrency_metrics())
+
+print("Timeouts reduce the concurrency limit of both wrappers, other errors do not")
+EOF
@@ -0,0 +1,39 @@
+#!/bin/bash
+set -e
+
+# Importing hypogenic and building an API wrapper must not load local model backends.
+# Prints the slowest imports reported by `python -X importtime` and fails if a heavy
+# backend is imported, or if the total import time exceeds MAX_IMPORT_MS.
+
+heavy_modules="torch|vllm|transformers|sklearn"
+max_import_ms=${MAX_IMPORT_MS:-2000}
+
+log_file=$(mktemp)
+trap 'rm -f "${log_file}"' EXIT
+
+python -X importtime -c "
+from hypogenic.LLM_wrapper import llm_wrapper_register
+from hypogenic.algorithm.generation import generation_register
+from hypogenic.algorithm.inference import inference_register
+from hypogenic.algorithm.update import update_register
+from hypogenic.utils import set_seed, get_results
+llm_wrapper_register.build('gpt')
+llm_wrapper_register.build('claude')
+" 2> "${log_file}"
+
+echo "Slowest imports (cumulative us):"
+grep "^import time:" "${log_file}" | sort -t '|' -k 2 -n -r | head -n 15
+
+heavy=$(grep -E "\|\s+(${heavy_modules})$" "${log_file}" || true)
+if [ -n "${heavy}" ]; then
+    echo "Heavy backends were imported:"
+    echo "${heavy}"
+    exit 1
+fi
+
+# sum of the cumulative times of the hypogenic modules imported at the top level
+total_us=$(grep -E "\| hypogenic(\.|$)" "${log_file}" | awk -F '|' '{total += $2} END {print total}')
+echo "Total hypogenic import time: $((total_us / 1000)) ms (limit ${max_import_ms} ms)"
+if [ "$((total_us / 1000))" -gt "${max_import_ms}" ]; then
+    exit 1
+fi
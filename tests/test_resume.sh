@@ -0,0 +1,66 @@
+#!/bin/bash
+set -e
+
+# A run resumed from an update checkpoint must end with the same hypothesis bank as an
+# uninterrupted run. Both runs share a sqlite LLM cache with a fixed cache seed, so the
+# second run replays the same responses. The crash is simulated by deleting every
+# checkpoint after RESUME_SAMPLE, and the final hypotheses, from a copy of the first run.
+# Resuming with different settings must be refused, and an --old_hypothesis_file is ignored.
+
+task=${TASK:-hotel_reviews}
+num_train=${NUM_TRAIN:-60}
+resume_sample=${RESUME_SAMPLE:-30}
+model_type=${MODEL_TYPE:-vllm}
+model_name=${MODEL_NAME:-meta-llama/Meta-Llama-3.1-8B-Instruct}
+
+work_dir=$(mktemp -d)
+trap 'rm -rf "${work_dir}"' EXIT
+
+run_generation() {
+    hypogenic_generation \
+        --task_config_path ./data/${task}/config.yaml \
+        --model_type ${model_type} \
+        --model_name ${model_name} \
+        --num_train ${num_train} \
+        --save_every_n_examples 10 \
+        --keep_checkpoints 1000 \
+        --cache_seed 0 \
+        --cache_backend sqlite \
+        --cache_path "${work_dir}/cache.sqlite" \
+        --output_folder "$1" \
+        "${@:2}" \
+        4096 1e-5
+}
+
+run_generation "${work_dir}/full" --no_resume
+
+cp -r "${work_dir}/full" "${work_dir}/resumed"
+rm "${work_dir}"/resumed/hypotheses_training_sample_final_*.json
+for checkpoint in "${work_dir}"/resumed/update_checkpoint_*.json; do
+    sample=${checkpoint##*_sample_}
+    if [ "${sample%.json}" -gt "${resume_sample}" ]; then
+        rm "${checkpoint}"
+    fi
+done
+
+if run_generation "${work_dir}/resumed" --k 1 > "${work_dir}/mismatch.log" 2>&1; then
+    echo "Resumed a checkpoint with different settings"
+    exit 1
+fi
+grep -q "belongs to a run with different settings" "${work_dir}/mismatch.log"
+
+# an old hypothesis file does not replace the checkpoint's hypotheses, but is reported
+old_hypothesis_file=$(ls "${work_dir}"/full/hypotheses_training_sample_final_*.json | head -n 1)
+if ! run_generation "${work_dir}/resumed" --old_hypothesis_file "${old_hypothesis_file}" > "${work_dir}/resumed.log" 2>&1; then
+    cat "${work_dir}/resumed.log"
+    exit 1
+fi
+grep -q "Use --no_resume to start from the old hypothesis file" "${work_dir}/resumed.log"
+
+for final in "${work_dir}"/full/hypotheses_training_sample_final_*.json; do
+    if ! cmp -s "${final}" "${work_dir}/resumed/$(basename "${final}")"; then
+        echo "Resumed run differs from the uninterrupted run: $(basename "${final}")"
+        exit 1
+    fi
+done
+echo "Resumed run matches the uninterrupted run"